@@ -9,12 +9,16 @@ from scrapy.exceptions import IgnoreRequest
 from scrapy import signals
 
 from scrapy_autoproxy.proxy_manager import ProxyManager
+from scrapy_autoproxy.proxy_buffer import ProxyPrefetchBuffer
 from scrapy_autoproxy.exception_manager import ExceptionManager
 from scrapy_autoproxy.util import parse_domain
 from scrapy_autoproxy.storage_manager import RedisDetailQueueEmpty
+from scrapy_autoproxy.latency import adaptive_timeout, histogram_quantile
 import sys
 import logging
 import twisted
+from twisted.internet import threads, defer
+from twisted.python.threadpool import ThreadPool
 import time
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -70,24 +74,163 @@ class AutoproxySpiderMiddleware(object):
 
 
 
+class HedgedDownload(object):
+    # one request raced over two proxies.  the request goes out through its
+    # proxy and, when no response has arrived after its domain's hedge delay,
+    # a copy goes out through a second proxy.  the first response wins and the
+    # other leg is cancelled.  each leg is downloaded with engine.download so
+    # it takes a downloader slot and runs the downloader middlewares, which
+    # leave it alone (autoproxy_hedge_leg) apart from this one setting its
+    # proxy.
+    # slots: the request itself stays in the downloader's active set (scrapy
+    # 1.8's Downloader.fetch) until the race is over, though it never reaches
+    # a domain slot, and every leg is fetched on its own.  a hedged request
+    # counts 2 against CONCURRENT_REQUESTS, 3 once hedged, and 1 or 2 against
+    # CONCURRENT_REQUESTS_PER_DOMAIN.
+    def __init__(self, mw, request, spider):
+        self.mw = mw
+        self.request = request
+        self.spider = spider
+        self.result = defer.Deferred()
+        self.legs = []
+        self.timer = None
+        self.done = False
+
+    def start(self):
+        d = defer.maybeDeferred(self.mw.run, self.mw.hedge_plan, self.request)
+        d.addCallbacks(self.start_primary, self.result.errback)
+        return self.result
+
+    def start_primary(self, plan):
+        proxy, delay = plan
+        self.send(proxy)
+        if delay is not None:
+            self.timer = self.mw.reactor.callLater(delay, self.hedge)
+
+    def hedge(self):
+        self.timer = None
+        if self.done or not self.mw.take_hedge():
+            return
+        d = defer.maybeDeferred(self.mw.run, self.mw.get_proxy, self.request.url)
+        d.addCallbacks(self.send_hedge, self.hedge_failed)
+
+    def hedge_failed(self, failure):
+        logger.info("could not hedge %s: %s" % (self.request.url, failure.value))
+
+    def send_hedge(self, proxy):
+        if self.done:
+            # the request finished while the second proxy was drawn
+            self.mw.run(proxy.callback, None, None, True)
+            return
+        logger.info("hedging %s with proxy %s" % (self.request.url, proxy.urlify()))
+        self.send(proxy)
+
+    def send(self, proxy):
+        leg = self.request.replace(dont_filter=True)
+        leg.meta['autoproxy_hedge_leg'] = True
+        self.mw.set_proxy(leg, proxy)
+        d = self.mw.crawler.engine.download(leg, self.spider)
+        self.legs.append((leg, d))
+        d.addCallbacks(self.leg_response, self.leg_failure, callbackArgs=(leg,), errbackArgs=(leg,))
+
+    def remove_leg(self, leg):
+        self.legs = [(l, d) for l, d in self.legs if l is not leg]
+
+    def finish(self):
+        self.done = True
+        if self.timer is not None and self.timer.active():
+            self.timer.cancel()
+        self.timer = None
+        for leg, d in list(self.legs):
+            d.cancel()
+
+    def leg_response(self, response, leg):
+        self.remove_leg(leg)
+        if self.done:
+            # got through despite being cancelled
+            self.mw.run(self.mw.record_response, leg, response, self.spider)
+            return
+        # the winner's outcome is recorded by process_response for the request
+        for key in ('proxy', 'proxy_obj', 'download_timeout', 'download_latency'):
+            if key in leg.meta:
+                self.request.meta[key] = leg.meta[key]
+        self.finish()
+        self.result.callback(response)
+
+    def leg_failure(self, failure, leg):
+        self.remove_leg(leg)
+        proxy = leg.meta['proxy_obj']
+        if self.done:
+            if failure.check(defer.CancelledError):
+                # lost the race: slow rather than bad, so neutral, but requeued
+                self.mw.run(proxy.callback, None, None, True)
+            else:
+                self.mw.run(self.mw.record_exception, leg, failure.value)
+            return
+        if self.legs:
+            # the other leg may still win, so it is recorded but not retried
+            self.mw.run(self.mw.record_exception, leg, failure.value)
+            return
+        # the last leg failed: process_exception records it and retries
+        self.request.meta['proxy'] = leg.meta['proxy']
+        self.request.meta['proxy_obj'] = proxy
+        self.finish()
+        self.result.errback(failure)
+
+
 class AutoproxyDownloaderMiddleware(object):
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
     # passed objects.
 
     def __init__(self,crawler):
+        self.crawler = crawler
         self.retry = crawler.settings.getbool('AUTOPROXY_RETRY',True)
         self.retry_times = crawler.settings.getint('AUTOPROXY_RETRY_TIMES', 2)
         default_neutral = crawler.settings.get('RETRY_HTTP_CODES',[]) + [404]
         self.neutral_codes = crawler.settings.get('NEUTRAL_HTTP_CODES', default_neutral)
         self.bad_codes = crawler.settings.get('BAD_HTTP_CODES',[400,401,402,403])
         self.good_codes = crawler.settings.get('GOOD_HTTP_CODES', [200])
+
+        # per request download_timeout from the proxy's latency history
+        self.adaptive_timeout = crawler.settings.getbool('AUTOPROXY_ADAPTIVE_TIMEOUT', False)
+        self.timeout_multiplier = crawler.settings.getfloat('AUTOPROXY_TIMEOUT_P99_MULTIPLIER', 3.0)
+        self.timeout_floor = crawler.settings.getfloat('AUTOPROXY_TIMEOUT_FLOOR', 2.0)
+        self.timeout_cap = crawler.settings.getfloat('AUTOPROXY_TIMEOUT_CAP', crawler.settings.getfloat('DOWNLOAD_TIMEOUT', 180))
+        self.probe_timeout = crawler.settings.getfloat('AUTOPROXY_PROBE_TIMEOUT', 8.0)
+        self.timeout_min_samples = crawler.settings.getint('AUTOPROXY_TIMEOUT_MIN_SAMPLES', 5)
+
+        # hedged requests, see HedgedDownload
+        self.hedging = crawler.settings.getbool('AUTOPROXY_HEDGE', False)
+        self.hedge_percentile = crawler.settings.getfloat('AUTOPROXY_HEDGE_PERCENTILE', 0.95)
+        self.hedge_budget = crawler.settings.getfloat('AUTOPROXY_HEDGE_BUDGET', 0.05)
+        self.hedge_min_samples = crawler.settings.getint('AUTOPROXY_HEDGE_MIN_SAMPLES', 20)
+        self.hedge_delay_ttl = crawler.settings.getint('AUTOPROXY_HEDGE_DELAY_TTL', 60)
+        self.hedge_delays = {}
+        self.hedged_requests = 0
+        self.hedges_sent = 0
         
 
         self.proxy_mgr = ProxyManager()
-        
-        
-        
+
+        self.prefetch_buffer = None
+        if crawler.settings.getbool('AUTOPROXY_PREFETCH', False):
+            self.prefetch_buffer = ProxyPrefetchBuffer(self.proxy_mgr,
+                size=crawler.settings.getint('AUTOPROXY_PREFETCH_SIZE', 8),
+                low_watermark=crawler.settings.getint('AUTOPROXY_PREFETCH_LOW_WATERMARK', 2))
+
+        # redis/postgres work runs on a bounded thread pool and the middleware
+        # returns Deferreds, so a slow redis or a running sync only delays the
+        # requests waiting on it instead of blocking the reactor
+        from twisted.internet import reactor
+        self.reactor = reactor
+        self.threadpool = None
+        if crawler.settings.getbool('AUTOPROXY_NONBLOCKING', False):
+            size = crawler.settings.getint('AUTOPROXY_THREADPOOL_SIZE', 10)
+            # ThreadPool's default minthreads is 5, more than a small pool allows
+            self.threadpool = ThreadPool(minthreads=min(5, size), maxthreads=size, name='autoproxy')
+            self.threadpool.start()
+            reactor.addSystemEventTrigger('during', 'shutdown', self.threadpool.stop)
         
 
     @classmethod
@@ -95,20 +238,81 @@ class AutoproxyDownloaderMiddleware(object):
         # This method is used by Scrapy to create your spiders.
         s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
         return s
 
+    def get_proxy(self, request_url):
+        if self.prefetch_buffer is not None:
+            return self.prefetch_buffer.get_proxy(request_url)
+        return self.proxy_mgr.get_proxy(request_url)
+
+    def run(self, fn, *args):
+        # with the thread pool, process_request, process_response and
+        # process_exception return a Deferred.  scrapy 1.8's
+        # DownloaderMiddlewareManager.download runs those chains as
+        # defer.inlineCallbacks and yields each method's result, so the chain
+        # waits on the Deferred.  that is how the manager is written, not a
+        # documented middleware contract: recheck it when upgrading scrapy
+        if self.threadpool is None:
+            return fn(*args)
+        return threads.deferToThreadPool(self.reactor, self.threadpool, fn, *args)
+
+    def assign_proxy(self, request):
+        proxy = self.get_proxy(request.url)
+        logger.info("using proxy %s" % proxy.urlify())
+        self.set_proxy(request, proxy)
+        return None
+
+    def set_proxy(self, request, proxy):
+        request.meta['proxy'] = proxy.urlify()
+        request.meta['proxy_obj'] = proxy
+        if self.adaptive_timeout:
+            # a dead proxy fails fast and frees its slot instead of holding it
+            # for the global DOWNLOAD_TIMEOUT
+            request.meta['download_timeout'] = adaptive_timeout(proxy.detail.latency_hist,
+                self.timeout_multiplier, self.timeout_floor, self.timeout_cap, self.probe_timeout, self.timeout_min_samples)
+
+    def hedge_delay(self, domain):
+        # seconds until a request to domain is hedged: the hedge percentile of
+        # its queue's latency histogram, None (no hedging) until the queue has
+        # enough samples.  cached for AUTOPROXY_HEDGE_DELAY_TTL seconds
+        cached = self.hedge_delays.get(domain)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+        redis_mgr = self.proxy_mgr.storage_mgr.redis_mgr
+        queue = redis_mgr.get_queue_by_domain(domain)
+        counts = redis_mgr.get_queue_latency(queue.queue_key)
+        delay = None
+        if sum(counts) >= self.hedge_min_samples:
+            delay = histogram_quantile(counts, self.hedge_percentile) / 1000.0
+        self.hedge_delays[domain] = (time.time() + self.hedge_delay_ttl, delay)
+        return delay
+
+    def hedge_plan(self, request):
+        return self.get_proxy(request.url), self.hedge_delay(parse_domain(request.url))
+
+    def take_hedge(self):
+        # at most AUTOPROXY_HEDGE_BUDGET extra requests per hedged request
+        if self.hedges_sent + 1 > self.hedge_budget * self.hedged_requests:
+            return False
+        self.hedges_sent += 1
+        return True
+
     def process_request(self, request, spider):
         # Called for each request that goes through the downloader
         # middleware.
         
+        if request.meta.get('autoproxy_hedge_leg'):
+            # its proxy was set by HedgedDownload
+            return None
+
         spider.logger.info("processing request for %s" % request.url)
         if parse_domain(request.url) not in spider.allowed_domains:
             raise IgnoreRequest("Bad domain, ignoring request.")
-        
-        proxy = self.proxy_mgr.get_proxy(request.url)
-        logger.info("using proxy %s" % proxy.urlify())
-        request.meta['proxy'] = proxy.urlify()
-        request.meta['proxy_obj'] = proxy
+
+        if self.hedging:
+            self.hedged_requests += 1
+            return HedgedDownload(self, request, spider).start()
 
         # Must either:
         # - return None: continue processing this request
@@ -116,7 +320,7 @@ class AutoproxyDownloaderMiddleware(object):
         # - or return a Request object
         # - or raise IgnoreRequest: process_exception() methods of
         #   installed downloader middleware will be called
-        return None
+        return self.run(self.assign_proxy, request)
 
     def process_response(self, request, response, spider):
         # Called with the response returned from the downloader.
@@ -126,47 +330,52 @@ class AutoproxyDownloaderMiddleware(object):
         # - return a Request object
         # - or raise IgnoreRequest
 
+        if request.meta.get('autoproxy_hedge_leg'):
+            # recorded by HedgedDownload, or for the request it won
+            return response
 
-        ## to do, use request.meta['download_latency']
         spider.logger.info("processing response for %s" % request.url)
-        proxy = request.meta.get('proxy_obj',None)
+        return self.run(self.record_response, request, response, spider)
 
-        
+    def record_response(self, request, response, spider):
+        proxy = request.meta.get('proxy_obj',None)
+        # seconds from sending the request to receiving the response headers
+        latency = request.meta.get('download_latency')
 
         
         if proxy:
 
             if parse_domain(request.url) not in spider.allowed_domains and parse_domain(response.url) not in spider.allowed_domains:
                 logger.info("proxy redirected to a bad domain, marking bad")
-                proxy.callback(success=False)
+                proxy.callback(success=False, latency=latency)
                 return response
 
             
             
             if response.status in self.good_codes:
                 logging.info("Got an explicitly good response code, marking good")
-                proxy.callback(success=True)
+                proxy.callback(success=True, latency=latency)
             
             elif response.status in self.neutral_codes:
                 logging.info("Got an explicitly neutral response, marking success=None")
-                proxy.callback(success=None)
+                proxy.callback(success=None, latency=latency)
 
             elif response.status in self.bad_codes:
                 logging.info("Got an explcitly bad response code, marking bad")
-                proxy.callback(success=False)
+                proxy.callback(success=False, latency=latency)
 
             elif response.status >= 400:
                 logging.info("status code > 399, marking bad")
-                proxy.callback(success=False)
+                proxy.callback(success=False, latency=latency)
             
             elif response.status < 400:
                 logging.info("Got a status code < 400, marking good")
-                proxy.callback(success=True)
+                proxy.callback(success=True, latency=latency)
             
 
             else:
                 logging.warn("Got a weird edge case for an HTTP status code")
-                proxy.callback(success=None)
+                proxy.callback(success=None, latency=latency)
 
             
             
@@ -182,38 +391,56 @@ class AutoproxyDownloaderMiddleware(object):
         # - return None: continue processing this exception
         # - return a Response object: stops process_exception() chain
         # - return a Request object: stops process_exception() chain
+        if request.meta.get('autoproxy_hedge_leg'):
+            return None
+
         spider.logger.info("processing exception for %s" % request.url)
-        proxy = request.meta.get('proxy_obj',None)
-        
-        if proxy is not None:
-            if type(exception) is twisted.internet.error.TimeoutError:
-                proxy.callback(success=False)
-                logger.error("Request tmed out with proxy %s." % proxy.urlify())
-                if self.retry:
-                    retried = request.meta.get('autoproxy_tries',0) + 1
-                    
-                    if retried > self.retry_times:
-                        logging.error("url %s has exceeded max autoproxy retry attempts.  giving up..." % request.url)
-                        return None
-                    else:
-                        new_proxy = self.proxy_mgr.get_proxy(request.url)
-                        request.meta['proxy_obj'] = new_proxy
-                        request.meta['proxy'] = new_proxy.urlify()
-                        request.meta['autoproxy_tries'] = retried
-                        logging.error("Retrying request with a new proxy.")
-                        return request
-            
+        return self.run(self.handle_exception, request, exception, spider)
 
+    def record_exception(self, request, exception):
+        # marks the request's proxy bad, unless no proxy could be drawn for
+        # it.  also records hedged legs that failed.  returns the proxy
         if type(exception) == RedisDetailQueueEmpty:
             return None
 
+        proxy = request.meta.get('proxy_obj',None)
         if proxy is None:
             logger.warn("no proxy object found in request.meta")
+            return None
 
+        if type(exception) is twisted.internet.error.TimeoutError:
+            logger.error("Request tmed out with proxy %s." % proxy.urlify())
         proxy.callback(success=False)
+        return proxy
+
+    def handle_exception(self, request, exception, spider):
+        proxy = self.record_exception(request, exception)
+        
+        if proxy is not None and type(exception) is twisted.internet.error.TimeoutError and self.retry:
+            retried = request.meta.get('autoproxy_tries',0) + 1
+            
+            if retried > self.retry_times:
+                logging.error("url %s has exceeded max autoproxy retry attempts.  giving up..." % request.url)
+                return None
+            else:
+                # process_request draws and dispatches the new proxy when the
+                # request comes back through the middleware
+                del request.meta['proxy_obj']
+                request.meta['autoproxy_tries'] = retried
+                logging.error("Retrying request with a new proxy.")
+                return request
         
         return None
 
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+        if self.prefetch_buffer is not None:
+            for domain in getattr(spider, 'allowed_domains', None) or []:
+                self.prefetch_buffer.warm('http://%s/' % domain)
+
+    def spider_closed(self, spider):
+        if self.prefetch_buffer is not None:
+            self.prefetch_buffer.close()
+        # writes outcomes still buffered by outcome_write_behind
+        self.proxy_mgr.close()
@@ -50,6 +50,39 @@ COOKIES_ENABLED = True
 AUTOPROXY_RETRY = True
 AUTOPROXY_RETRY_TIMES = 4
 
+# keep a few proxies per allowed domain leased in process, refilled in batches
+# by a background thread, so process_request does not wait on redis
+AUTOPROXY_PREFETCH = False
+AUTOPROXY_PREFETCH_SIZE = 8
+AUTOPROXY_PREFETCH_LOW_WATERMARK = 2
+
+# run the middleware's redis/postgres work on a bounded thread pool and
+# return Deferreds instead of blocking the reactor
+AUTOPROXY_NONBLOCKING = False
+AUTOPROXY_THREADPOOL_SIZE = 10
+
+# set each request's download_timeout from its proxy's latency history: its
+# p99 times the multiplier, between the floor and the cap (seconds).  proxies
+# with fewer than AUTOPROXY_TIMEOUT_MIN_SAMPLES successes get the probe timeout
+AUTOPROXY_ADAPTIVE_TIMEOUT = False
+AUTOPROXY_TIMEOUT_P99_MULTIPLIER = 3.0
+AUTOPROXY_TIMEOUT_FLOOR = 2.0
+AUTOPROXY_TIMEOUT_CAP = DOWNLOAD_TIMEOUT
+AUTOPROXY_PROBE_TIMEOUT = 8.0
+AUTOPROXY_TIMEOUT_MIN_SAMPLES = 5
+
+# resend a request through a second proxy when it has had no response after
+# the domain's AUTOPROXY_HEDGE_PERCENTILE latency; the first response wins.
+# at most AUTOPROXY_HEDGE_BUDGET extra requests per request are sent.
+# every request is downloaded as a separate leg, so with hedging on a request
+# takes 2 (3 when hedged) of CONCURRENT_REQUESTS; raise it to keep the same
+# number of downloads going
+AUTOPROXY_HEDGE = False
+AUTOPROXY_HEDGE_PERCENTILE = 0.95
+AUTOPROXY_HEDGE_BUDGET = 0.05
+AUTOPROXY_HEDGE_MIN_SAMPLES = 20
+AUTOPROXY_HEDGE_DELAY_TTL = 60
+
 # Disable Telnet Console (enabled by default)
 #TELNETCONSOLE_ENABLED = False
 
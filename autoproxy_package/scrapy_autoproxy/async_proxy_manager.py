@@ -0,0 +1,137 @@
+from datetime import datetime
+import logging
+
+from scrapy_autoproxy.util import parse_domain
+from scrapy_autoproxy.async_storage_manager import AsyncStorageManager
+from scrapy_autoproxy.storage_manager import RedisDetailQueueEmpty
+from scrapy_autoproxy.proxy_objects import Proxy
+from scrapy_autoproxy.latency import load_time_ms
+from scrapy_autoproxy.proxy_manager import GET_PROXY_ENGINE
+from scrapy_autoproxy.selection_policies import get_selection_policy, SELECTION_POLICIES, TARGET_ACTIVE_COUNT
+from scrapy_autoproxy.queue_refill import QueueRefiller
+
+# engines drawn with an async call of their lua script, 'python' draws
+# like 'lua'
+ASYNC_SCRIPT_ENGINES = ('python', 'lua', 'ranked')
+
+
+class AsyncProxyObject(Proxy):
+    # ProxyObject for AsyncProxyManager: dispatch, callback and release are
+    # coroutines
+    def __init__(self,detail,storage_manager,queue,active,proxy):
+        self.detail = detail
+        self.storage_mgr = storage_manager
+        self.queue = queue
+        self.active = active
+        self.proxy = proxy
+        self._dispatch_time = None
+        self._lease = None
+
+        super().__init__(self.proxy.address, self.proxy.port,
+                         self.proxy.protocol, self.proxy.proxy_id)
+
+    async def dispatch(self):
+        self._dispatch_time = datetime.utcnow()
+        self._lease = await self.storage_mgr.redis_mgr.lease_in_flight(self.detail.proxy_key)
+
+    async def release(self):
+        if self._dispatch_time is not None:
+            raise Exception("Cannot release a dispatched proxy, call callback instead.")
+        await self.storage_mgr.enqueue(self.queue, self.active, self.detail)
+
+    async def callback(self, success, latency=None, requeue=None):
+        logging.info("callback=%s for proxy %s" % (success,self.urlify()))
+        if self._dispatch_time is None:
+            raise Exception("Proxy not properly dispatched prior to callback.")
+
+        # a neutral outcome only touches last_used and is not requeued, unless
+        # requeue says otherwise
+        if requeue is None:
+            requeue = success is not None
+        load_time = load_time_ms(self._dispatch_time, latency)
+        lease = self._lease
+        self._dispatch_time = None
+        self._lease = None
+        if self.storage_mgr.outcome_write_behind:
+            # the process' buffer belongs to the sync StorageManager, and add
+            # may flush a full buffer, so it is called on the executor
+            detail = self.detail
+            await self.storage_mgr.run_sync(lambda sm: sm.outcome_buffer.add(detail, success, load_time, requeue, lease))
+            return
+
+        if self.storage_mgr.outcome_stream is not None:
+            await self.storage_mgr.outcome_stream.append(self.detail, success, load_time, requeue, lease)
+            return
+
+        detail = await self.storage_mgr.redis_mgr.record_outcome(self.detail, success, load_time, requeue, lease)
+        if detail is None:
+            logging.warning("detail %s is no longer cached, outcome not recorded" % self.detail.detail_key)
+            return
+        self.detail = detail
+
+    def to_dict(self,redis_format=False):
+        return self.detail.to_dict(redis_format)
+
+
+class AsyncProxyManager(object):
+    # asyncio counterpart of ProxyManager for the asyncio reactor and plain
+    # aiohttp/httpx scrapers.  'lua' and 'ranked' draws go through their lua
+    # scripts on redis.asyncio, 'python' draws like 'lua'.  the other
+    # engines draw through their selection policy on the sync StorageManager
+    # in the loop's default executor.
+    def __init__(self):
+        if GET_PROXY_ENGINE not in ASYNC_SCRIPT_ENGINES and GET_PROXY_ENGINE not in SELECTION_POLICIES:
+            raise Exception("Unknown get_proxy_engine %s" % GET_PROXY_ENGINE)
+        self.storage_mgr = AsyncStorageManager()
+        self.logger = logging.getLogger(__name__)
+        self.policy = None
+        self.refiller = None
+
+    def sync_policy(self,sm):
+        if self.policy is None:
+            self.policy = get_selection_policy(GET_PROXY_ENGINE, sm.redis_mgr)
+        return self.policy
+
+    def sync_refiller(self,sm):
+        if self.refiller is None:
+            self.refiller = QueueRefiller(sm)
+        return self.refiller
+
+    async def draw_many(self,queue,count):
+        redis_mgr = self.storage_mgr.redis_mgr
+        if GET_PROXY_ENGINE not in ASYNC_SCRIPT_ENGINES:
+            await redis_mgr.wait_for_sync()
+            return await self.storage_mgr.run_sync(lambda sm: self.sync_policy(sm).draw_many(queue,count))
+        if GET_PROXY_ENGINE == 'ranked':
+            return await redis_mgr.draw_ranked_details(queue, count)
+        return await redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, count)
+
+    async def get_proxy(self,request_url):
+        proxy = (await self.get_proxies(request_url,1))[0]
+        await proxy.dispatch()
+        return proxy
+
+    async def get_proxies(self,request_url,count):
+        # leases up to count undispatched proxies, see ProxyManager.get_proxies
+        domain = parse_domain(request_url)
+        queue = await self.storage_mgr.get_queue_by_domain(domain)
+
+        draws = await self.draw_many(queue,count)
+        draw = draws[0]
+        # the refill decision is ProxyManager's (QueueRefiller), run on the
+        # executor: an inline refill reads postgres, and waiting for the
+        # refill worker blocks for up to refill_wait_timeout
+        refilled = await self.storage_mgr.run_sync(lambda sm: self.sync_refiller(sm).refill(queue,draw.queue_count,draw.inactive_length))
+        if draw.detail is None and (refilled or await self.storage_mgr.run_sync(lambda sm: self.sync_refiller(sm).wait(queue))):
+            draws = await self.draw_many(queue,count)
+
+        proxies = [AsyncProxyObject(d.detail, self.storage_mgr, queue, d.active, d.proxy) for d in draws if d.detail is not None]
+        if not proxies:
+            raise RedisDetailQueueEmpty("No proxies available for queue key %s" % queue.queue_key)
+        return proxies
+
+    async def new_proxy(self,address,port,protocol='http'):
+        return await self.storage_mgr.new_proxy(address,port,protocol)
+
+    async def close(self):
+        await self.storage_mgr.close()
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import logging
+
+import redis.asyncio
+
+from scrapy_autoproxy.config import configuration
+from scrapy_autoproxy.proxy_objects import Proxy, Queue
+from scrapy_autoproxy.redis_scripts import RedisScripts
+from scrapy_autoproxy.outcome_stream import OutcomeStream
+from scrapy_autoproxy.storage_manager import StorageManager, RedisManager, RedisDetailQueue, DetailDraw, QUEUE_DOMAIN_INDEX_KEY, PROXY_ADDRESS_INDEX_KEY, IN_FLIGHT_LEASE_TTL, OUTCOME_WRITE_BEHIND, OUTCOME_STREAM, OUTCOME_STREAM_MAXLEN
+
+logger = logging.getLogger(__name__)
+
+SYNC_POLL_INTERVAL = 5
+
+# redis.asyncio clients, shared like get_redis's.  a client's connections
+# belong to the event loop that opened them, so use one loop per process.
+_async_redis_clients = {}
+_async_redis_clients_lock = threading.Lock()
+
+
+def get_async_redis(**overrides):
+    params = dict(configuration.redis_config)
+    params.update(overrides)
+    registry_key = tuple(sorted(params.items()))
+    with _async_redis_clients_lock:
+        client = _async_redis_clients.get(registry_key)
+        if client is None:
+            pool = redis.asyncio.BlockingConnectionPool(decode_responses=True, **params)
+            client = redis.asyncio.Redis(connection_pool=pool)
+            _async_redis_clients[registry_key] = client
+    return client
+
+
+class AsyncRedisManager(object):
+    # the hot path of RedisManager (queue lookup, draws, outcomes) on
+    # redis.asyncio.  draws and outcomes run the same lua scripts with the
+    # same keys and args as the sync manager.
+    def __init__(self):
+        self.redis = get_async_redis()
+        self.scripts = RedisScripts(self.redis)
+
+    async def is_syncing(self):
+        return await self.redis.get('syncing') is not None
+
+    async def wait_for_sync(self):
+        # block_if_syncing without tying up a thread
+        while await self.is_syncing():
+            logger.info("awaiting sync")
+            await asyncio.sleep(SYNC_POLL_INTERVAL)
+
+    async def get_queue_by_domain(self,domain):
+        queue_key = await self.redis.hget(QUEUE_DOMAIN_INDEX_KEY,domain)
+        if queue_key is None:
+            return None
+        return Queue.from_redis(await self.redis.hgetall(queue_key), queue_key)
+
+    async def get_proxy_by_address_and_port(self,address,port):
+        proxy_key = await self.redis.hget(PROXY_ADDRESS_INDEX_KEY, RedisManager.proxy_address_field(address,port))
+        if proxy_key is None:
+            return None
+        return Proxy.from_redis(await self.redis.hgetall(proxy_key), proxy_key)
+
+    async def draw_details(self,queue,target_active_count,count):
+        await self.wait_for_sync()
+        keys, args = RedisManager.draw_details_call(queue,target_active_count,count)
+        return DetailDraw.batch(await self.scripts.draw_detail(keys=keys, args=args))
+
+    async def draw_ranked_details(self,queue,count):
+        await self.wait_for_sync()
+        keys, args = RedisManager.draw_ranked_detail_call(queue,count)
+        return DetailDraw.batch(await self.scripts.draw_ranked_detail(keys=keys, args=args))
+
+    async def lease_in_flight(self,proxy_key):
+        lease, expires = RedisManager.new_lease()
+        in_flight_key = RedisManager.in_flight_key(proxy_key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(in_flight_key, {lease: expires})
+        pipe.expire(in_flight_key, IN_FLIGHT_LEASE_TTL)
+        await pipe.execute()
+        return lease
+
+    async def record_outcome(self,detail,success,load_time,requeue=True,lease=None):
+        keys, args = RedisManager.record_outcome_call(detail,success,load_time,requeue,lease)
+        return DetailDraw.outcome_detail(await self.scripts.record_outcome(keys=keys, args=args))
+
+
+class AsyncStorageManager(object):
+    # the cold paths (registering queues and proxies, refilling queues from
+    # postgres, loading the cache) are rare, take locks and reserve ids, so
+    # they run on the sync StorageManager in the loop's default executor
+    # rather than being duplicated against an async postgres driver
+    def __init__(self):
+        self.redis_mgr = AsyncRedisManager()
+        self._storage_mgr = None
+        self._storage_mgr_lock = threading.Lock()
+        # outcomes go the way StorageManager's do: to its write-behind
+        # buffer, to the outcome stream (appended on redis.asyncio), or
+        # straight to the record_outcome script
+        self.outcome_write_behind = OUTCOME_WRITE_BEHIND
+        self.outcome_stream = None
+        if OUTCOME_STREAM:
+            self.outcome_stream = OutcomeStream(self.redis_mgr.redis, OUTCOME_STREAM_MAXLEN)
+
+    def sync_storage_manager(self):
+        with self._storage_mgr_lock:
+            if self._storage_mgr is None:
+                self._storage_mgr = StorageManager()
+        return self._storage_mgr
+
+    async def run_sync(self,fn):
+        # fn is called with the sync StorageManager on an executor thread
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: fn(self.sync_storage_manager()))
+
+    async def close(self):
+        # writes any buffered outcomes, call when the crawl is finished
+        if self._storage_mgr is not None:
+            await self.run_sync(lambda sm: sm.close())
+
+    async def get_queue_by_domain(self,domain):
+        queue = await self.redis_mgr.get_queue_by_domain(domain)
+        if queue is None:
+            queue = await self.run_sync(lambda sm: sm.redis_mgr.get_queue_by_domain(domain))
+        return queue
+
+    async def initialize_queue(self,queue):
+        return await self.run_sync(lambda sm: sm.redis_mgr.initialize_queue(queue=queue))
+
+    async def create_new_details(self,queue,count=None):
+        if count is None:
+            return await self.run_sync(lambda sm: sm.create_new_details(queue=queue))
+        return await self.run_sync(lambda sm: sm.create_new_details(queue=queue,count=count))
+
+    async def enqueue(self,queue,active,detail):
+        return await self.run_sync(lambda sm: RedisDetailQueue(queue,active=active,redis_mgr=sm.redis_mgr).enqueue(detail))
+
+    async def new_proxy(self,address,port,protocol='http'):
+        existing = await self.redis_mgr.get_proxy_by_address_and_port(address,port)
+        if existing is not None:
+            logger.warn("proxy with address %s and port %s already exists in the cache/db." % (address, port))
+            return
+        return await self.run_sync(lambda sm: sm.new_proxy(address,port,protocol))
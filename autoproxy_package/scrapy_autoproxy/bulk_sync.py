@@ -0,0 +1,176 @@
+import csv
+import io
+import itertools
+import time
+import logging
+
+from scrapy_autoproxy.latency import format_histogram
+
+logger = logging.getLogger(__name__)
+
+DETAIL_COLUMNS = ('active', 'load_time', 'last_used', 'last_active', 'bad_count', 'blacklisted', 'blacklisted_count', 'lifetime_good', 'lifetime_bad', 'latency_ewma', 'latency_hist')
+
+CREATE_STAGING_TABLES = """
+CREATE TEMP TABLE staging_queues (
+    queue_key VARCHAR(100),
+    queue_id INTEGER,
+    domain VARCHAR(100)
+) ON COMMIT DROP;
+
+CREATE TEMP TABLE staging_proxies (
+    proxy_key VARCHAR(100),
+    proxy_id INTEGER,
+    address VARCHAR(40),
+    port INT,
+    protocol VARCHAR(10)
+) ON COMMIT DROP;
+
+CREATE TEMP TABLE staging_details (
+    detail_key VARCHAR(200),
+    detail_id INTEGER,
+    is_new BOOLEAN,
+    queue_key VARCHAR(100),
+    proxy_key VARCHAR(100),
+    queue_id INTEGER,
+    proxy_id INTEGER,
+    active BOOLEAN,
+    load_time INT,
+    last_used TIMESTAMP,
+    last_active TIMESTAMP,
+    bad_count INT,
+    blacklisted BOOLEAN,
+    blacklisted_count INTEGER,
+    lifetime_good INTEGER,
+    lifetime_bad INTEGER,
+    latency_ewma REAL,
+    latency_hist INT[]
+) ON COMMIT DROP;
+"""
+
+# ids are allocated ahead of time by IdAllocator and inserted as is
+MERGE_QUEUES = """
+INSERT INTO queues (queue_id, domain)
+SELECT DISTINCT ON (domain) COALESCE(queue_id, nextval('queues_queue_id_seq')), domain FROM staging_queues
+ON CONFLICT DO NOTHING;
+"""
+
+MERGE_PROXIES = """
+INSERT INTO proxies (proxy_id, address, port, protocol)
+SELECT DISTINCT ON (address, port) COALESCE(proxy_id, nextval('proxies_proxy_id_seq')), address, port, protocol FROM staging_proxies
+ON CONFLICT DO NOTHING;
+"""
+
+# a queue or proxy that another cache already wrote under a different id is
+# resolved through its natural key, so its details attach to the existing row
+RESOLVE_DETAIL_IDS = """
+UPDATE staging_details d SET queue_id = q.queue_id
+FROM staging_queues sq JOIN queues q ON q.domain = sq.domain
+WHERE sq.queue_key = d.queue_key AND d.queue_id IS DISTINCT FROM q.queue_id;
+
+UPDATE staging_details d SET proxy_id = p.proxy_id
+FROM staging_proxies sp JOIN proxies p ON p.address = sp.address AND p.port = sp.port
+WHERE sp.proxy_key = d.proxy_key AND d.proxy_id IS DISTINCT FROM p.proxy_id;
+"""
+
+MERGE_NEW_DETAILS = """
+INSERT INTO details (detail_id, queue_id, proxy_id, active, load_time, last_used, last_active, bad_count, blacklisted, blacklisted_count, lifetime_good, lifetime_bad, latency_ewma, latency_hist)
+SELECT COALESCE(detail_id, nextval('details_detail_id_seq')), queue_id, proxy_id, active, load_time, last_used, last_active, bad_count, blacklisted, blacklisted_count, lifetime_good, lifetime_bad, latency_ewma, latency_hist
+FROM staging_details
+WHERE is_new AND queue_id IS NOT NULL AND proxy_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+"""
+
+MERGE_CHANGED_DETAILS = """
+UPDATE details t SET
+    active = s.active,
+    load_time = s.load_time,
+    last_used = s.last_used,
+    last_active = s.last_active,
+    bad_count = s.bad_count,
+    blacklisted = s.blacklisted,
+    blacklisted_count = s.blacklisted_count,
+    lifetime_good = s.lifetime_good,
+    lifetime_bad = s.lifetime_bad,
+    latency_ewma = s.latency_ewma,
+    latency_hist = s.latency_hist
+FROM staging_details s
+WHERE NOT s.is_new AND t.queue_id = s.queue_id AND t.proxy_id = s.proxy_id;
+"""
+
+
+class CopyStream(object):
+    # file-like object over an iterator of rows so COPY can stream them
+    # without building the whole payload in memory
+    def __init__(self,rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.row_count = 0
+        self.line = io.StringIO()
+        self.writer = csv.writer(self.line)
+
+    def format_row(self,row):
+        self.line.seek(0)
+        self.line.truncate()
+        self.writer.writerow(row)
+        return self.line.getvalue()
+
+    def read(self,size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                break
+            self.row_count += 1
+            self.buffer += self.format_row(row)
+
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+class BulkSync(object):
+    def __init__(self,db_mgr):
+        self.db_mgr = db_mgr
+
+    @staticmethod
+    def detail_row(detail,is_new):
+        obj_dict = detail.to_dict()
+        row = [detail.detail_key, detail.detail_id, is_new, detail.queue_key, detail.proxy_key, detail.queue_id, detail.proxy_id]
+        # csv COPY takes arrays as postgres array literals
+        obj_dict['latency_hist'] = '{%s}' % format_histogram(detail.latency_hist)
+        row.extend([obj_dict[c] for c in DETAIL_COLUMNS])
+        return row
+
+    def copy(self,cursor,table,columns,rows):
+        stream = CopyStream(rows)
+        cursor.copy_expert("COPY %s (%s) FROM STDIN WITH (FORMAT csv)" % (table, ', '.join(columns)), stream)
+        return stream.row_count
+
+    def sync(self,new_queues,new_proxies,new_details,changed_details):
+        start = time.time()
+        with self.db_mgr.transaction() as cursor:
+            cursor.execute(CREATE_STAGING_TABLES)
+
+            row_count = self.copy(cursor, 'staging_queues', ('queue_key', 'queue_id', 'domain'),
+                ((q.queue_key, q.queue_id, q.domain) for q in new_queues))
+            row_count += self.copy(cursor, 'staging_proxies', ('proxy_key', 'proxy_id', 'address', 'port', 'protocol'),
+                ((p.proxy_key, p.proxy_id, p.address, p.port, p.protocol) for p in new_proxies))
+
+            detail_rows = itertools.chain(
+                (self.detail_row(d, True) for d in new_details),
+                (self.detail_row(d, False) for d in changed_details))
+            detail_columns = ('detail_key', 'detail_id', 'is_new', 'queue_key', 'proxy_key', 'queue_id', 'proxy_id') + DETAIL_COLUMNS
+            row_count += self.copy(cursor, 'staging_details', detail_columns, detail_rows)
+
+            cursor.execute("ANALYZE staging_queues; ANALYZE staging_proxies; ANALYZE staging_details;")
+            cursor.execute(MERGE_QUEUES)
+            cursor.execute(MERGE_PROXIES)
+            cursor.execute(RESOLVE_DETAIL_IDS)
+            cursor.execute(MERGE_NEW_DETAILS)
+            cursor.execute(MERGE_CHANGED_DETAILS)
+
+        elapsed = time.time() - start
+        rate = row_count / elapsed if elapsed > 0 else row_count
+        logger.info("bulk synced %s rows in %.2f seconds (%.0f rows/sec)" % (row_count, elapsed, rate))
+        return row_count
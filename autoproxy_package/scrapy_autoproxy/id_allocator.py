@@ -0,0 +1,55 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+ID_POOL_PREFIX = 'id_pool_'
+
+# redis key prefix -> postgres sequence the ids are reserved from
+ID_SEQUENCES = {
+    'q': 'queues_queue_id_seq',
+    'p': 'proxies_proxy_id_seq',
+    'd': 'details_detail_id_seq',
+}
+
+
+class IdAllocator(object):
+    # hi/lo style allocator: blocks of ids are reserved from the postgres
+    # sequences and handed out from a redis list shared by every process, so
+    # new objects get their permanent id (and key) as soon as they are created
+    def __init__(self,redis,db_mgr,block_size):
+        self.redis = redis
+        self.db_mgr = db_mgr
+        self.block_size = block_size
+
+    @staticmethod
+    def pool_key(prefix):
+        return "%s%s" % (ID_POOL_PREFIX, prefix)
+
+    def allocate(self,prefix):
+        if prefix not in ID_SEQUENCES:
+            raise Exception("No id sequence for object prefix %s" % prefix)
+
+        pool_key = self.pool_key(prefix)
+        obj_id = self.redis.lpop(pool_key)
+        while obj_id is None:
+            lock = self.redis.lock("%s_lock" % pool_key, timeout=60)
+            if lock.acquire(blocking=True, blocking_timeout=30):
+                try:
+                    # another process may have refilled the pool while we waited
+                    obj_id = self.redis.lpop(pool_key)
+                    if obj_id is None:
+                        obj_id = self.reserve_block(prefix, pool_key)
+                finally:
+                    lock.release()
+            else:
+                obj_id = self.redis.lpop(pool_key)
+
+        return int(obj_id)
+
+    def reserve_block(self,prefix,pool_key):
+        ids = self.db_mgr.reserve_ids(ID_SEQUENCES[prefix], self.block_size)
+        logger.info("reserved %s ids from %s" % (len(ids), ID_SEQUENCES[prefix]))
+        obj_id = ids.pop(0)
+        if ids:
+            self.redis.rpush(pool_key, *ids)
+        return obj_id
@@ -0,0 +1,73 @@
+import math
+from datetime import datetime
+
+# upper bounds in ms of the latency histogram buckets, log spaced from 25ms to
+# about 55s.  the last bucket takes everything slower.  histograms are plain
+# per bucket counts, so the histograms of several details (or processes) merge
+# by adding them up.  changing the bounds invalidates the stored histograms.
+LATENCY_BUCKETS_MS = tuple(int(round(25 * 1.5 ** i)) for i in range(20))
+LATENCY_BUCKET_COUNT = len(LATENCY_BUCKETS_MS) + 1
+
+
+def load_time_ms(dispatch_time,latency=None):
+    # latency is in seconds, e.g. scrapy's download_latency.  without it the
+    # time since dispatch_time is used
+    if latency is None:
+        latency = (datetime.utcnow() - dispatch_time).total_seconds()
+    return int(round(latency * 1000))
+
+def bucket_index(latency_ms):
+    for index, bound in enumerate(LATENCY_BUCKETS_MS):
+        if latency_ms <= bound:
+            return index
+    return len(LATENCY_BUCKETS_MS)
+
+def parse_histogram(val):
+    # redis stores the counts comma separated, postgres as an INT[]
+    if val is None or val == '':
+        return []
+    if isinstance(val, str):
+        val = val.split(',')
+    return list(map(int, val))
+
+def format_histogram(counts):
+    return ','.join(map(str, counts))
+
+def merge_histograms(histograms):
+    merged = [0] * LATENCY_BUCKET_COUNT
+    for counts in histograms:
+        for index, count in enumerate(parse_histogram(counts)):
+            merged[index] += count
+    return merged
+
+def histogram_quantile(counts,q):
+    # upper bound of the bucket holding the q quantile, None without samples.
+    # the overflow bucket reports twice the last bound.
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = max(int(math.ceil(q * total)), 1)
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= rank:
+            break
+    if index < len(LATENCY_BUCKETS_MS):
+        return LATENCY_BUCKETS_MS[index]
+    return LATENCY_BUCKETS_MS[-1] * 2
+
+def latency_summary(counts):
+    return {
+        'samples': sum(counts),
+        'p50': histogram_quantile(counts, 0.5),
+        'p95': histogram_quantile(counts, 0.95),
+        'p99': histogram_quantile(counts, 0.99),
+    }
+
+def adaptive_timeout(counts,multiplier,floor,cap,probe_timeout,min_samples):
+    # download timeout in seconds for a proxy with this latency histogram: a
+    # multiple of its p99 between floor and cap, or the short probe_timeout
+    # (never above cap) until it has min_samples successes
+    if sum(counts) < min_samples:
+        return min(probe_timeout, cap)
+    return min(max(histogram_quantile(counts, 0.99) * multiplier / 1000.0, floor), cap)
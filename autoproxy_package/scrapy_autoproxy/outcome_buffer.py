@@ -0,0 +1,131 @@
+import atexit
+import time
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# one write-behind buffer (and flush thread) per process, shared by every
+# StorageManager like the redis clients are
+_outcome_buffer = None
+_outcome_buffer_lock = threading.Lock()
+
+
+def get_outcome_buffer(redis_mgr,flush_interval_ms=250,batch_size=100,max_buffered=1000,outcome_stream=None):
+    # a closed buffer (the crawl that used it finished) is replaced
+    global _outcome_buffer
+    with _outcome_buffer_lock:
+        if _outcome_buffer is None or _outcome_buffer.closed:
+            _outcome_buffer = OutcomeWriteBehind(redis_mgr, flush_interval_ms, batch_size, max_buffered, outcome_stream)
+    return _outcome_buffer
+
+
+class OutcomeWriteBehind(object):
+    # buffers callback outcomes in memory and writes them to redis in one
+    # pipelined batch of record_outcome script calls, every flush_interval_ms
+    # or as soon as batch_size outcomes are waiting.  when max_buffered
+    # outcomes are waiting the callback flushes inline instead of growing
+    # the buffer.  with an outcome_stream the batch is appended to the
+    # stream for the aggregators instead.  a batch that fails to write is
+    # put back in front of the buffer and retried with the next flush.
+    def __init__(self,redis_mgr,flush_interval_ms=250,batch_size=100,max_buffered=1000,outcome_stream=None):
+        self.redis_mgr = redis_mgr
+        self.outcome_stream = outcome_stream
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.outcomes = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.worker = None
+
+    def start(self):
+        # the flush thread is started by the first outcome, so managers that
+        # never record one do not start a thread.  called with lock held
+        self.worker = threading.Thread(target=self.flush_loop, name='autoproxy-outcomes', daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def add(self,detail,success,load_time,requeue,lease=None):
+        outcome = (detail, success, load_time, requeue, lease, datetime.utcnow())
+        with self.lock:
+            self.outcomes.append(outcome)
+            pending = len(self.outcomes)
+            if self.worker is None and not self.closed:
+                self.start()
+            if pending >= self.batch_size:
+                self.wakeup.notify()
+        if pending >= self.max_buffered or self.closed:
+            try:
+                self.flush()
+            except Exception:
+                # kept in the buffer for the next flush
+                logger.exception("error while flushing buffered outcomes")
+
+    def take(self):
+        with self.lock:
+            outcomes, self.outcomes = self.outcomes, []
+        return outcomes
+
+    def restore(self,outcomes):
+        # puts a batch that failed back in front of the outcomes added since.
+        # past max_buffered the oldest are dropped, their leases expire
+        with self.lock:
+            self.outcomes[:0] = outcomes
+            dropped = len(self.outcomes) - self.max_buffered
+            if dropped > 0:
+                del self.outcomes[:dropped]
+                logger.error("outcome buffer is full, dropped the %s oldest outcomes" % dropped)
+
+    def flush(self):
+        # flush_lock keeps batches in order when the callback path and the
+        # worker flush at the same time
+        with self.flush_lock:
+            outcomes = self.take()
+            if not outcomes:
+                return 0
+            try:
+                pipe = self.redis_mgr.redis.pipeline(transaction=False)
+                for detail, success, load_time, requeue, lease, now in outcomes:
+                    if self.outcome_stream is not None:
+                        self.outcome_stream.append(detail, success, load_time, requeue, lease, now, client=pipe)
+                        continue
+                    keys, args = self.redis_mgr.record_outcome_call(detail, success, load_time, requeue, lease, now)
+                    self.redis_mgr.scripts.record_outcome(keys=keys, args=args, client=pipe)
+                # an outcome the script rejects is logged, not retried with
+                # the batch, since the others were already applied
+                results = pipe.execute(raise_on_error=False)
+            except Exception:
+                self.restore(outcomes)
+                raise
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error("error while writing a buffered outcome: %s" % result)
+        logger.debug("flushed %s buffered outcomes" % len(outcomes))
+        return len(outcomes)
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                if len(self.outcomes) < self.batch_size and not self.closed:
+                    self.wakeup.wait(self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("error while flushing buffered outcomes")
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.wakeup.notify()
+        if self.worker is not None:
+            self.worker.join(timeout=30)
+        self.flush()
@@ -0,0 +1,187 @@
+import os
+import socket
+import time
+import logging
+from datetime import datetime
+
+import redis
+
+from scrapy_autoproxy.proxy_objects import Detail
+
+logger = logging.getLogger(__name__)
+
+OUTCOME_STREAM_KEY = 'outcome_stream'
+OUTCOME_GROUP = 'outcome_aggregators'
+# events that failed to apply max_deliveries times, with their stream id in 'id'
+OUTCOME_DEAD_LETTER_KEY = 'outcome_stream_dead'
+QUEUE_STATS_PREFIX = 'queue_stats_'
+
+SUCCESS_CODES = {True: '1', False: '0', None: ''}
+SUCCESS_VALUES = {'1': True, '0': False, '': None}
+
+
+class OutcomeStream(object):
+    # append-only log of callback outcomes.  each event is one XADD of a few
+    # short fields:
+    #   q: queue key, p: proxy key, s: '1' / '0' / '' (neutral),
+    #   l: load time in ms, r: requeue '1' / '0', t: epoch seconds,
+    #   k: in flight lease to release ('' for none)
+    # the aggregators trim the events they have applied.  maxlen is only a
+    # cap for when they fall behind or are not running: past it XADD trims
+    # the oldest events whether they were read or not, and those are lost.
+    def __init__(self,redis_client,maxlen=1000000):
+        self.redis = redis_client
+        self.maxlen = maxlen
+
+    def append(self,detail,success,load_time,requeue,lease=None,now=None,client=None):
+        if now is None:
+            now = datetime.utcnow()
+        event = {
+            'q': detail.queue_key,
+            'p': detail.proxy_key,
+            's': SUCCESS_CODES[success],
+            'l': load_time,
+            'r': int(requeue),
+            't': '%.3f' % (now - datetime(1970,1,1)).total_seconds(),
+            'k': lease or '',
+        }
+        client = client or self.redis
+        return client.xadd(OUTCOME_STREAM_KEY, event, maxlen=self.maxlen, approximate=True)
+
+
+class OutcomeAggregator(object):
+    # consumer group worker that applies outcome events to the cache: the
+    # detail counters, blacklist and requeue (via the record_outcome script),
+    # changed_details, and the per queue totals in queue_stats_<queue key>.
+    # run as many as needed, each with its own consumer name.  an event is
+    # acked once applied, one that fails stays pending and is claimed again
+    # after claim_idle_ms, until max_deliveries moves it to the dead letter
+    # stream.
+    def __init__(self,redis_mgr,consumer=None,batch_size=500,block_ms=5000,claim_idle_ms=60000,max_deliveries=5,trim_interval=60):
+        self.redis_mgr = redis_mgr
+        self.redis = redis_mgr.redis
+        self.consumer = consumer or '%s-%s' % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.trim_interval = trim_interval
+
+    def create_group(self):
+        try:
+            self.redis.xgroup_create(OUTCOME_STREAM_KEY, OUTCOME_GROUP, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def apply(self,messages):
+        # returns the number of events applied.  events of details that are
+        # no longer cached are acked, but not counted or added to the stats
+        pipe = self.redis.pipeline(transaction=False)
+        outcomes = []
+        for message_id, event in messages:
+            try:
+                detail = Detail(queue_key=event['q'], proxy_key=event['p'])
+                success = SUCCESS_VALUES[event['s']]
+                load_time = int(event['l'])
+                now = datetime.utcfromtimestamp(float(event['t']))
+                requeue = event['r'] == '1'
+                lease = event.get('k')
+            except (KeyError, ValueError) as e:
+                logger.error("malformed outcome event %s: %r" % (message_id, e))
+                continue
+            keys, args = self.redis_mgr.record_outcome_call(detail, success, load_time, requeue, lease, now)
+            self.redis_mgr.scripts.record_outcome(keys=keys, args=args, client=pipe)
+            outcomes.append((message_id, event['q'], success, load_time))
+        results = pipe.execute(raise_on_error=False)
+
+        applied = []
+        acked = []
+        for (message_id, queue_key, success, load_time), result in zip(outcomes, results):
+            if isinstance(result, Exception):
+                logger.error("error while applying outcome event %s: %s" % (message_id, result))
+                continue
+            acked.append(message_id)
+            if not result:
+                # record_outcome's empty reply: the detail is no longer cached
+                logger.warning("outcome event %s is for a detail no longer cached, dropped" % message_id)
+                continue
+            stats_key = "%s%s" % (QUEUE_STATS_PREFIX, queue_key)
+            outcome_field = {True: 'good', False: 'bad', None: 'neutral'}[success]
+            pipe.hincrby(stats_key, 'requests', 1)
+            pipe.hincrby(stats_key, outcome_field, 1)
+            pipe.hincrby(stats_key, 'load_time_total', load_time)
+            applied.append(message_id)
+        if acked:
+            pipe.xack(OUTCOME_STREAM_KEY, OUTCOME_GROUP, *acked)
+            pipe.execute()
+        return len(applied)
+
+    def dead_letter(self):
+        # moves the oldest pending events that were delivered max_deliveries
+        # times to the dead letter stream, rather than claiming them forever
+        pending = self.redis.xpending_range(OUTCOME_STREAM_KEY, OUTCOME_GROUP, min='-', max='+', count=self.batch_size)
+        dead = [p['message_id'] for p in pending if p['times_delivered'] >= self.max_deliveries and p['time_since_delivered'] >= self.claim_idle_ms]
+        if not dead:
+            return 0
+        pipe = self.redis.pipeline(transaction=False)
+        for message_id in dead:
+            pipe.xrange(OUTCOME_STREAM_KEY, message_id, message_id)
+        for message_id, entries in zip(dead, pipe.execute()):
+            # the event itself may be gone already, trimmed by maxlen
+            event = dict(entries[0][1]) if entries else {}
+            event['id'] = message_id
+            pipe.xadd(OUTCOME_DEAD_LETTER_KEY, event)
+        pipe.xack(OUTCOME_STREAM_KEY, OUTCOME_GROUP, *dead)
+        pipe.execute()
+        logger.error("moved %s outcome events to %s after %s deliveries" % (len(dead), OUTCOME_DEAD_LETTER_KEY, self.max_deliveries))
+        return len(dead)
+
+    def trim(self):
+        # drops the events before the oldest pending one, or before the
+        # group's last delivered id when none is pending: every event before
+        # it was read and acked
+        pending = self.redis.xpending(OUTCOME_STREAM_KEY, OUTCOME_GROUP)
+        min_id = pending['min'] if pending['pending'] else None
+        if min_id is None:
+            for group in self.redis.xinfo_groups(OUTCOME_STREAM_KEY):
+                if group['name'] == OUTCOME_GROUP:
+                    min_id = group['last-delivered-id']
+        if min_id is None:
+            return 0
+        return self.redis.xtrim(OUTCOME_STREAM_KEY, minid=min_id, approximate=False)
+
+    def claim_stale(self):
+        # events read by a consumer that died before acking them
+        self.dead_letter()
+        result = self.redis.xautoclaim(OUTCOME_STREAM_KEY, OUTCOME_GROUP, self.consumer, self.claim_idle_ms, start_id='0-0', count=self.batch_size)
+        return [m for m in result[1] if m[1]]
+
+    def process_batch(self):
+        messages = self.claim_stale()
+        if not messages:
+            response = self.redis.xreadgroup(OUTCOME_GROUP, self.consumer, {OUTCOME_STREAM_KEY: '>'}, count=self.batch_size, block=self.block_ms)
+            for stream, stream_messages in response or []:
+                messages.extend(stream_messages)
+        if not messages:
+            return 0
+        return self.apply(messages)
+
+    def run(self):
+        self.create_group()
+        logger.info("outcome aggregator %s started" % self.consumer)
+        next_trim = time.time() + self.trim_interval
+        while True:
+            try:
+                processed = self.process_batch()
+                if processed:
+                    logger.debug("aggregated %s outcome events" % processed)
+                if time.time() >= next_trim:
+                    self.trim()
+                    next_trim = time.time() + self.trim_interval
+            except redis.exceptions.ConnectionError as e:
+                logger.error("lost connection to redis: %s" % e)
+                time.sleep(1)
+            except Exception:
+                logger.exception("error in outcome aggregator %s" % self.consumer)
+                time.sleep(1)
@@ -0,0 +1,102 @@
+import threading
+import logging
+from collections import deque
+
+from scrapy_autoproxy.util import parse_domain
+from scrapy_autoproxy.storage_manager import RedisDetailQueueEmpty
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyPrefetchBuffer(object):
+    # keeps a few leased (drawn but not yet dispatched) proxies per domain in
+    # process, so handing one to a request is a local pop.  buffers that fall
+    # below low_watermark are topped back up to size by a background thread,
+    # one batched draw per domain.
+    def __init__(self,proxy_mgr,size=8,low_watermark=2):
+        self.proxy_mgr = proxy_mgr
+        self.size = size
+        self.low_watermark = low_watermark
+        self.buffers = {}
+        self.request_urls = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.closed = False
+        self.worker = threading.Thread(target=self.refill_loop, name='autoproxy-prefetch', daemon=True)
+        self.worker.start()
+
+    def get_proxy(self,request_url):
+        domain = parse_domain(request_url)
+        with self.lock:
+            buffer = self.buffers.setdefault(domain, deque())
+            self.request_urls[domain] = request_url
+            proxy = buffer.popleft() if buffer else None
+            if len(buffer) < self.low_watermark:
+                self.schedule(domain)
+
+        if proxy is None:
+            # buffer ran dry, draw one directly rather than wait for the refill
+            logger.info("prefetch buffer for %s is empty, drawing a proxy directly" % domain)
+            proxy = self.proxy_mgr.get_proxy(request_url,dispatch=False)
+
+        proxy.dispatch()
+        return proxy
+
+    def warm(self,request_url):
+        # fills a domain's buffer ahead of its first request
+        domain = parse_domain(request_url)
+        with self.lock:
+            self.buffers.setdefault(domain, deque())
+            self.request_urls[domain] = request_url
+            self.schedule(domain)
+
+    def schedule(self,domain):
+        # caller holds self.lock
+        if domain not in self.pending:
+            self.pending.add(domain)
+            self.wakeup.notify()
+
+    def refill_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.wakeup.wait()
+                if self.closed:
+                    return
+                domain = self.pending.pop()
+                request_url = self.request_urls[domain]
+                needed = self.size - len(self.buffers[domain])
+
+            if needed <= 0:
+                continue
+            try:
+                proxies = self.proxy_mgr.get_proxies(request_url,needed)
+            except RedisDetailQueueEmpty:
+                logger.warning("no proxies available to prefetch for %s" % domain)
+                continue
+            except Exception:
+                logger.exception("error while prefetching proxies for %s" % domain)
+                continue
+
+            with self.lock:
+                if self.closed:
+                    release = proxies
+                else:
+                    self.buffers[domain].extend(proxies)
+                    release = []
+            for proxy in release:
+                proxy.release()
+            logger.debug("prefetched %s proxies for %s" % (len(proxies), domain))
+
+    def close(self):
+        # stops the refill thread and hands every unused lease back to its queue
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+            leased = [proxy for buffer in self.buffers.values() for proxy in buffer]
+            self.buffers.clear()
+        self.worker.join(timeout=30)
+        for proxy in leased:
+            proxy.release()
+        logger.info("released %s prefetched proxies" % len(leased))
@@ -1,7 +1,9 @@
 from scrapy_autoproxy.util import parse_domain, flip_coin
-from scrapy_autoproxy.storage_manager import StorageManager, RedisDetailQueue
+from scrapy_autoproxy.storage_manager import StorageManager, RedisDetailQueue, RedisDetailQueueEmpty
 from scrapy_autoproxy.config import configuration
 from scrapy_autoproxy.proxy_objects import ProxyObject
+from scrapy_autoproxy.selection_policies import get_selection_policy, LuaPolicy, TARGET_ACTIVE_COUNT
+from scrapy_autoproxy.queue_refill import QueueRefiller
 from datetime import datetime
 import sys
 import logging
@@ -20,7 +22,7 @@ ACTIVE_PROXIES_PER_QUEUE = app_config('active_proxies_per_queue')
 INACTIVE_PROXIES_PER_QUEUE = app_config('inactive_proxies_per_queue')
 SEED_QUEUE_ID = app_config('seed_queue')
 PROXY_INTERVAL = app_config('proxy_interval')
-TARGET_ACTIVE_COUNT = 200
+GET_PROXY_ENGINE = app_config('get_proxy_engine')
 import logging
 
 
@@ -28,16 +30,39 @@ class ProxyManager(object):
     def __init__(self):
         self.storage_mgr = StorageManager()
         self.logger = logging.getLogger(__name__)
+        self.policy = None
+        if GET_PROXY_ENGINE != 'python':
+            self.policy = get_selection_policy(GET_PROXY_ENGINE, self.storage_mgr.redis_mgr)
+        # get_proxies batches are drawn by the policy.  the python engine has
+        # none, its batches are drawn in one call of the lua draw script,
+        # which picks queues the same way
+        self.batch_policy = self.policy or LuaPolicy(self.storage_mgr.redis_mgr)
+        self.refiller = QueueRefiller(self.storage_mgr)
+
+    def refill(self,queue,queue_count,inactive_length):
+        return self.refiller.refill(queue,queue_count,inactive_length)
+
+    def wait_for_refill(self,queue):
+        return self.refiller.wait(queue)
+
+    def dequeue_either(self,draw_queue,fallback_queue):
+        # returns the detail and the queue it was dequeued from
+        try:
+            return draw_queue.dequeue(), draw_queue
+        except RedisDetailQueueEmpty:
+            self.logger.info("all proxies in the chosen RDQ are cooling down, trying the other RDQ")
+            return fallback_queue.dequeue(), fallback_queue
+
+    def get_proxy(self,request_url,dispatch=True):
+        if self.policy is not None:
+            if not dispatch:
+                return self.lease_proxies(request_url,1)[0]
+            return self.get_proxy_from_policy(request_url)
 
-    def get_proxy(self,request_url):
-        is_seed = False
         domain = parse_domain(request_url)
         # get the queue for the request url's domain. If a queue doesn't exist, one will be created.
         queue = self.storage_mgr.redis_mgr.get_queue_by_domain(domain)
         
-        if queue.id() == SEED_QUEUE_ID:
-            is_seed = True
-        
         # self logger name to requst url domain
         self.logger = logging.getLogger(queue.domain)
         
@@ -47,15 +72,8 @@ class ProxyManager(object):
         num_details = self.storage_mgr.redis_mgr.get_queue_count(queue)
         #logging.debug("\n\n\n\n\nafter get num details for queue")
         
-        
-        if num_details == 0 and is_seed:
-            self.storage_mgr.initialize_seed_queue()
-        
-        if num_details == 0 and not is_seed:
-            self.storage_mgr.redis_mgr.initialize_queue(queue=queue)
-        
-        rdq_active = RedisDetailQueue(queue,active=True)
-        rdq_inactive = RedisDetailQueue(queue,active=False)
+        rdq_active = RedisDetailQueue(queue,active=True,redis_mgr=self.storage_mgr.redis_mgr)
+        rdq_inactive = RedisDetailQueue(queue,active=False,redis_mgr=self.storage_mgr.redis_mgr)
         num_enqueued = rdq_active.length() + rdq_inactive.length()
 
         not_enqueued = num_details - num_enqueued
@@ -68,13 +86,9 @@ class ProxyManager(object):
         -----------------------------------------------|
         """ % (num_details,not_enqueued,rdq_active.length(),rdq_inactive.length()))
 
-        if rdq_inactive.length() < MIN_QUEUE_SIZE and not is_seed:
-            self.logger.info("rdq is less than the min queue size, creating some new details...")
-            self.storage_mgr.create_new_details(queue=queue)
-            # will return a list of new seed details that have not yet been used for this queue
-
-        elif flip_coin(SEED_FREQUENCY) and not is_seed:
-            self.storage_mgr.create_new_details(queue=queue,count=1)
+        # will add new seed details that have not yet been used for this queue,
+        # or fill the seed queue the first time it is used
+        self.refill(queue,num_details,rdq_inactive.length())
 
         use_active = False
 
@@ -90,30 +104,79 @@ class ProxyManager(object):
     
 
         draw_queue = None
+        fallback_queue = None
         
         if use_active:
             self.logger.info("using active RDQ")
             draw_queue = rdq_active
+            fallback_queue = rdq_inactive
         
         else:
             self.logger.info("using inactive RDQ")
             draw_queue = rdq_inactive
+            fallback_queue = rdq_active
+        
+        # proxies used within PROXY_INTERVAL wait in the queue's cooldown set,
+        # so a dequeued detail is always ready to use
+        try:
+            detail, draw_queue = self.dequeue_either(draw_queue,fallback_queue)
+        except RedisDetailQueueEmpty:
+            if not self.wait_for_refill(queue):
+                raise
+            # the refilled details may be cooling down, or taken by another
+            # process already, so both queues are tried again
+            detail, draw_queue = self.dequeue_either(draw_queue,fallback_queue)
+
+        proxy = ProxyObject(detail, self.storage_mgr, draw_queue)
+        if dispatch:
+            proxy.dispatch()
+        return proxy
         
         
-        detail = draw_queue.dequeue()
-        proxy = ProxyObject(detail, StorageManager(), draw_queue)
-        
-        now = datetime.utcnow()
-        elapsed_time = now - proxy.detail.last_used
-        if elapsed_time.seconds < PROXY_INTERVAL:
-            self.logger.warn("Proxy %s was last used against %s %s seconds ago, using a different proxy." % (proxy.address, domain, elapsed_time.seconds))
-            return self.get_proxy(request_url)            
-        
+
+    def get_proxy_from_policy(self,request_url):
+        proxy = self.lease_proxies(request_url,1)[0]
         proxy.dispatch()
         return proxy
-        
-        
+
+    def lease_proxies(self,request_url,count,policy=None):
+        # draws up to count proxies without dispatching them
+        policy = policy or self.policy
+        domain = parse_domain(request_url)
+        redis_mgr = self.storage_mgr.redis_mgr
+        queue = redis_mgr.get_queue_by_domain(domain)
+        self.logger = logging.getLogger(queue.domain)
+
+        # queue choice, blacklist/socks/interval checks and the claim are all
+        # left to the selection policy
+        draws = policy.draw_many(queue,count)
+        draw = draws[0]
+        refilled = self.refill(queue,draw.queue_count,draw.inactive_length)
+
+        if draw.detail is None and (refilled or self.wait_for_refill(queue)):
+            draws = policy.draw_many(queue,count)
+
+        proxies = []
+        for draw in draws:
+            if draw.detail is None:
+                continue
+            self.logger.info("using %s RDQ" % ("active" if draw.active else "inactive"))
+            rdq = RedisDetailQueue(queue,active=draw.active,redis_mgr=redis_mgr)
+            proxies.append(ProxyObject(draw.detail, self.storage_mgr, rdq, proxy=draw.proxy))
+
+        if not proxies:
+            raise RedisDetailQueueEmpty("No proxies available for queue key %s" % queue.queue_key)
+        return proxies
+
+    def get_proxies(self,request_url,count):
+        # leases up to count undispatched proxies for the request url's domain,
+        # e.g. to prefetch them.  call dispatch() when one is put to use, or
+        # release() to hand it back to its queue
+        return self.lease_proxies(request_url,count,self.batch_policy)
 
     def new_proxy(self,address,port,protocol='http'):
         return self.storage_mgr.new_proxy(address,port,protocol)
+
+    def close(self):
+        self.storage_mgr.close()
         
\ No newline at end of file
@@ -7,7 +7,8 @@ import re
 import sys
 
 from scrapy_autoproxy.config import configuration
-from scrapy_autoproxy.util import format_redis_boolean, format_redis_timestamp, parse_boolean, parse_timestamp
+from scrapy_autoproxy.util import parse_boolean, parse_epoch
+from scrapy_autoproxy.latency import parse_histogram, format_histogram, histogram_quantile, load_time_ms
 
 DEFAULT_TIMESTAMP = datetime.fromtimestamp(946684800)
 BOOLEAN_VALS = (True,'1',False,'0')
@@ -25,6 +26,7 @@ import logging
 
 class Proxy(object):
     AVAILABLE_PROTOCOLS = ('http', 'https', 'socks5', 'socks4')
+    __slots__ = ('address', 'port', 'protocol', 'proxy_id', '_proxy_key')
 
     def __init__(self, address, port, protocol='http', proxy_id=None, proxy_key=None):
         self.address = address
@@ -36,7 +38,19 @@ class Proxy(object):
         ifn = lambda x: int(x) if x is not None else None
         self.proxy_id = ifn(proxy_id)
         self._proxy_key = proxy_key
-        
+
+    @classmethod
+    def from_redis(cls,data,proxy_key=None):
+        # builds a proxy from the hash to_dict(redis_format=True) wrote,
+        # skipping the validation __init__ does for new proxies
+        proxy = cls.__new__(cls)
+        proxy.address = data['address']
+        proxy.port = int(data['port'])
+        proxy.protocol = data['protocol']
+        proxy_id = data.get('proxy_id')
+        proxy.proxy_id = int(proxy_id) if proxy_id is not None else None
+        proxy._proxy_key = proxy_key
+        return proxy
 
     def urlify(self):
         return "%s://%s:%s" % (self.protocol, self.address, self.port)
@@ -65,7 +79,22 @@ class Proxy(object):
             obj_dict.update({'proxy_id': self.proxy_id})
         return obj_dict
 
+
+# fields of a detail's redis hash, in the order to_redis writes them.  ids
+# follow when they are set.
+DETAIL_REDIS_FIELDS = ('active', 'load_time', 'last_used', 'last_active', 'bad_count', 'blacklisted', 'blacklisted_count', 'lifetime_good', 'lifetime_bad', 'latency_ewma', 'latency_hist', 'queue_key', 'proxy_key')
+DEFAULT_EPOCH = parse_epoch(DEFAULT_TIMESTAMP)
+
 class Detail(object):
+    # last_used and last_active are kept as epoch seconds, the way redis
+    # stores them, and only turned into datetimes when read.  latency_hist
+    # likewise stays the comma separated string from redis until it is read.
+    __slots__ = (
+        '_active', 'load_time', 'last_used_epoch', 'last_active_epoch', 'bad_count', '_blacklisted',
+        'blacklisted_count', 'lifetime_good', 'lifetime_bad', 'latency_ewma', '_latency_hist',
+        'proxy_id', 'queue_id', 'detail_id', '_proxy_key', '_queue_key', '_detail_key'
+    )
+
     def proxy_object_id(self,object_or_id):
         if isinstance(object_or_id,int) or object_or_id is None:
             return object_or_id
@@ -73,29 +102,78 @@ class Detail(object):
             return int(object_or_id)
         return object_or_id.id()
 
-    def __init__(self, active=False, load_time=60000, last_updated=None, last_active=DEFAULT_TIMESTAMP, last_used=DEFAULT_TIMESTAMP, bad_count=0, blacklisted=False, blacklisted_count=0, lifetime_good=0, lifetime_bad=0, proxy_id=None, queue_id=None, detail_id=None, queue_key=None, proxy_key=None, detail_key=None):
+    def __init__(self, active=False, load_time=60000, last_updated=None, last_active=DEFAULT_TIMESTAMP, last_used=DEFAULT_TIMESTAMP, bad_count=0, blacklisted=False, blacklisted_count=0, lifetime_good=0, lifetime_bad=0, latency_ewma=0, latency_hist=None, random_key=None, proxy_id=None, queue_id=None, detail_id=None, queue_key=None, proxy_key=None, detail_key=None):
         self.active = active
-        self.load_time = load_time
-        self._last_active = parse_timestamp(last_active)
-        self._last_used = parse_timestamp(last_used)
+        self.load_time = int(load_time)
+        self.last_active_epoch = parse_epoch(last_active)
+        self.last_used_epoch = parse_epoch(last_used)
         self.bad_count = int(bad_count)
         self.blacklisted = blacklisted
         self.blacklisted_count = int(blacklisted_count)
         self.lifetime_good = int(lifetime_good)
         self.lifetime_bad = int(lifetime_bad)
+        # load_time is the latest successful latency in ms, latency_ewma its
+        # moving average and latency_hist the counts per LATENCY_BUCKETS_MS bucket
+        self.latency_ewma = float(latency_ewma or 0)
+        self.latency_hist = parse_histogram(latency_hist)
         
         self.proxy_id = self.proxy_object_id(proxy_id)
         self.queue_id = self.proxy_object_id(queue_id)
         self._proxy_key = proxy_key
         self._queue_key = queue_key
+        self._detail_key = None
 
         ifn = lambda x: int(x) if x is not None else None
         self.detail_id = ifn(detail_id)
 
-    
+    @classmethod
+    def from_redis(cls,data,detail_key=None):
+        # the hot path counterpart of Detail(**hgetall): builds a detail from
+        # the hash to_redis wrote with no validation, and takes its keys from
+        # the hash instead of formatting them.  iso timestamps and hashes
+        # without the latency fields, from older versions, still load.
+        detail = cls.__new__(cls)
+        get = data.get
+        detail._active = data['active'] == '1'
+        detail.load_time = int(data['load_time'])
+        detail.last_used_epoch = parse_epoch(data['last_used'])
+        detail.last_active_epoch = parse_epoch(data['last_active'])
+        detail.bad_count = int(data['bad_count'])
+        detail._blacklisted = data['blacklisted'] == '1'
+        detail.blacklisted_count = int(data['blacklisted_count'])
+        detail.lifetime_good = int(data['lifetime_good'])
+        detail.lifetime_bad = int(data['lifetime_bad'])
+        detail.latency_ewma = float(get('latency_ewma') or 0)
+        detail._latency_hist = get('latency_hist')
+        proxy_id = get('proxy_id')
+        queue_id = get('queue_id')
+        detail_id = get('detail_id')
+        detail.proxy_id = int(proxy_id) if proxy_id is not None else None
+        detail.queue_id = int(queue_id) if queue_id is not None else None
+        detail.detail_id = int(detail_id) if detail_id is not None else None
+        detail._proxy_key = data['proxy_key']
+        detail._queue_key = data['queue_key']
+        detail._detail_key = detail_key
+        return detail
+
+    def to_redis(self):
+        obj_dict = dict(zip(DETAIL_REDIS_FIELDS, (
+            '1' if self._active else '0', self.load_time, self.last_used_epoch, self.last_active_epoch,
+            self.bad_count, '1' if self._blacklisted else '0', self.blacklisted_count,
+            self.lifetime_good, self.lifetime_bad, self.latency_ewma, self.redis_latency_hist(),
+            self.queue_key, self.proxy_key
+        )))
+        if self.detail_id is not None:
+            obj_dict['detail_id'] = self.detail_id
+        if self.proxy_id is not None:
+            obj_dict['proxy_id'] = self.proxy_id
+        if self.queue_id is not None:
+            obj_dict['queue_id'] = self.queue_id
+        return obj_dict
+
     @property
     def proxy_key(self):
-        if self.proxy_id is not None:
+        if self._proxy_key is None and self.proxy_id is not None:
             self._proxy_key = "%s_%s" % ("p",self.proxy_id)
         return self._proxy_key
         
@@ -103,26 +181,51 @@ class Detail(object):
     @proxy_key.setter
     def proxy_key(self,pkey):
         self._proxy_key = pkey
+        self._detail_key = None
 
     @property
     def queue_key(self):
-        if self.queue_id is not None:
+        if self._queue_key is None and self.queue_id is not None:
             self._queue_key = "%s_%s" % ('q',self.queue_id)
         return self._queue_key
             
     @queue_key.setter
     def queue_key(self,qkey):
         self._queue_key = qkey
+        self._detail_key = None
 
     @property
     def detail_key(self):
-        return "%s_%s_%s" % ('d',self.queue_key,self.proxy_key)
+        if self._detail_key is None:
+            self._detail_key = "%s_%s_%s" % ('d',self.queue_key,self.proxy_key)
+        return self._detail_key
 
 
 
     def id(self):
         return self.detail_id
 
+    @property
+    def latency_hist(self):
+        if not isinstance(self._latency_hist, list):
+            self._latency_hist = parse_histogram(self._latency_hist)
+        return self._latency_hist
+
+    @latency_hist.setter
+    def latency_hist(self,val):
+        self._latency_hist = parse_histogram(val)
+
+    def redis_latency_hist(self):
+        if isinstance(self._latency_hist, list):
+            return format_histogram(self._latency_hist)
+        return self._latency_hist or ''
+
+    def latency_samples(self):
+        return sum(self.latency_hist)
+
+    def latency_quantile(self,q):
+        return histogram_quantile(self.latency_hist,q)
+
     @property
     def active(self):        
         return self._active
@@ -141,22 +244,25 @@ class Detail(object):
 
     @property
     def last_active(self):
-        return self._last_active
+        return datetime.utcfromtimestamp(self.last_active_epoch)
 
     @last_active.setter
     def last_active(self,val):
-        self._last_active = parse_timestamp(val)
+        self.last_active_epoch = parse_epoch(val)
 
     @property
     def last_used(self):
-        return self._last_used
+        return datetime.utcfromtimestamp(self.last_used_epoch)
 
     @last_used.setter
     def last_used(self,val):
-        self._last_used = parse_timestamp(val)
+        self.last_used_epoch = parse_epoch(val)
             
 
     def to_dict(self,redis_format=False):
+        if redis_format:
+            return self.to_redis()
+
         obj_dict =  {
             "active": self.active,
             "load_time": self.load_time,
@@ -167,16 +273,10 @@ class Detail(object):
             "blacklisted_count": self.blacklisted_count,
             "lifetime_good": self.lifetime_good,
             "lifetime_bad": self.lifetime_bad, 
+            "latency_ewma": self.latency_ewma,
+            "latency_hist": self.latency_hist,
         }
 
-        if redis_format:
-            obj_dict['active'] = format_redis_boolean(self.active)
-            obj_dict['blacklisted'] = format_redis_boolean(self.blacklisted)
-            obj_dict['last_used'] =  format_redis_timestamp(self.last_used)
-            obj_dict['last_active'] =format_redis_timestamp(self.last_active)
-            obj_dict['queue_key'] = self.queue_key
-            obj_dict['proxy_key'] = self.proxy_key
-
         if self.detail_id is not None:
             obj_dict.update({'detail_id': self.detail_id})
 
@@ -195,23 +295,34 @@ class Detail(object):
 
 
 class Queue(object):
+    __slots__ = ('domain', 'queue_id', '_queue_key')
+
     def __init__(self, domain, queue_id=None, queue_key=None):
         self.domain = domain
         ifn = lambda x: int(x) if x is not None else None
         self.queue_id = ifn(queue_id)
         self._queue_key = queue_key
 
+    @classmethod
+    def from_redis(cls,data,queue_key=None):
+        queue = cls.__new__(cls)
+        queue.domain = data['domain']
+        queue_id = data.get('queue_id')
+        queue.queue_id = int(queue_id) if queue_id is not None else None
+        queue._queue_key = queue_key
+        return queue
+
     def id(self):
         return self.queue_id
 
     @property
     def queue_key(self):
         if self._queue_key is None and self.queue_id is not None:
-            self._queue_key = "%s_%s" % (QUEUE_PREFIX,self.queue_id)
+            self._queue_key = "%s_%s" % ('q',self.queue_id)
         return self._queue_key
             
     @queue_key.setter
-    def proxy_key(self,qkey):
+    def queue_key(self,qkey):
         self._queue_key = qkey
     
     def to_dict(self, redis_format=False):
@@ -244,11 +355,14 @@ class Queue(object):
 """
 
 class ProxyObject(Proxy):
-    def __init__(self,detail,storage_manager,rdq):
+    def __init__(self,detail,storage_manager,rdq,proxy=None):
         self.detail = detail
         self.storage_mgr = storage_manager
-        self.proxy = self.storage_mgr.redis_mgr.get_proxy(detail.proxy_key)
+        if proxy is None:
+            proxy = self.storage_mgr.redis_mgr.get_proxy(detail.proxy_key)
+        self.proxy = proxy
         self._dispatch_time = None
+        self._lease = None
         self.rdq = rdq
 
         super().__init__(self.proxy.address, self.proxy.port,
@@ -256,73 +370,55 @@ class ProxyObject(Proxy):
 
     def dispatch(self):
         self._dispatch_time = datetime.utcnow()
+        # released again by the callback's record_outcome
+        self._lease = self.storage_mgr.redis_mgr.lease_in_flight(self.detail.proxy_key)
 
-    def callback(self, success):
+    def release(self):
+        # hands an undispatched proxy back to its queue, no outcome is recorded
+        if self._dispatch_time is not None:
+            raise Exception("Cannot release a dispatched proxy, call callback instead.")
+        self.rdq.enqueue(self.detail)
+
+    def callback(self, success, latency=None, requeue=None):
         logging.info("callback=%s for proxy %s" % (success,self.urlify()))
         if self._dispatch_time is None:
             raise Exception("Proxy not properly dispatched prior to callback.")
 
-        requeue = True
-        self.detail.last_used = datetime.utcnow()
-
-        
-
-        if success is None:
-            requeue = False
-
-        
-
-        elif success:
-            logging.info("proxy.callback(success=True)")
-            load_time_delta = datetime.utcnow() - self._dispatch_time
-            self.detail.load_time = load_time_delta.seconds
-            self.detail.active = True
-            self.detail.last_active = datetime.utcnow()
-            #self.detail.decrement_bad_count()
-            self.detail.lifetime_good += 1
-            if DECREMENT_BLACKLIST:
-                if self.detail.blacklisted_count > 0:
-                    self.detail.blacklisted_count -= 1
-            
-        else:
-            logging.info("proxy.callback(success=False)")
-            self.detail.bad_count += 1
-            self.detail.lifetime_bad += 1
-            if self.detail.bad_count > BLACKLIST_THRESHOLD:
-
-                self.detail.blacklisted = True
-                self.detail.active = False
-                self.detail.blacklisted_count += 1
-        
-        self.storage_mgr.redis_mgr.update_detail(self.detail)
-        
-
-
-        self.detail = self.storage_mgr.redis_mgr.get_detail(self.detail.detail_key)
+        # a neutral outcome only touches last_used and is not requeued, unless
+        # requeue says otherwise
+        if requeue is None:
+            requeue = success is not None
+        load_time = load_time_ms(self._dispatch_time, latency)
+        lease = self._lease
+        self._dispatch_time = None
+        self._lease = None
+        if self.storage_mgr.outcome_buffer is not None:
+            # write-behind: the outcome is written with the next batch
+            self.storage_mgr.outcome_buffer.add(self.detail, success, load_time, requeue, lease)
+            return
+
+        if self.storage_mgr.outcome_stream is not None:
+            # the outcome is applied to the cache by an OutcomeAggregator
+            self.storage_mgr.outcome_stream.append(self.detail, success, load_time, requeue, lease)
+            return
+
+        detail = self.storage_mgr.redis_mgr.record_outcome(self.detail, success, load_time, requeue, lease)
+        if detail is None:
+            logging.warning("detail %s is no longer cached, outcome not recorded" % self.detail.detail_key)
+            return
 
+        self.detail = detail
 
         logging.info("""
         ----------|---------------------------------------------------------------------|
         ----------|  proxy address/port     : %s  
         ----------|  successful requests    : %s" 
         ----------|  unsuccessful requests  : %s" 
+        ----------|  latency ewma / p95 (ms): %.0f / %s" 
         ----------|  last active            : %s" 
         ----------|  last used              : %s" 
         ----------|---------------------------------------------------------------------| 
-        """ % (self.urlify(), self.detail.lifetime_good, self.detail.lifetime_bad, self.detail.last_active, self.detail.last_used))
-
-
-
-
-
-
-        if requeue:
-            self.rdq.enqueue(self.detail)
-
-        self._dispatch_time = None
-
-
-
+        """ % (self.urlify(), self.detail.lifetime_good, self.detail.lifetime_bad, self.detail.latency_ewma, self.detail.latency_quantile(0.95), self.detail.last_active, self.detail.last_used))
 
     def to_dict(self,redis_format=False):
         return self.detail.to_dict(redis_format)
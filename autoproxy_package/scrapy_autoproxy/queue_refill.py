@@ -0,0 +1,204 @@
+import time
+import logging
+
+import redis
+
+from scrapy_autoproxy.config import configuration
+from scrapy_autoproxy.util import flip_coin
+from scrapy_autoproxy.proxy_objects import Queue
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, QUEUE_DETAIL_COUNT_KEY, SEED_QUEUE_ID, AGGREGATE_QUEUE_ID, MIN_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+app_config = lambda config_val: configuration.app_config[config_val]['value']
+
+REFILL_HIGH_WATERMARK = app_config('refill_high_watermark')
+REFILL_SCAN_INTERVAL = app_config('refill_scan_interval')
+QUEUE_REFILL_WORKER = app_config('queue_refill_worker')
+REFILL_WAIT_TIMEOUT = app_config('refill_wait_timeout')
+SEED_FREQUENCY = app_config('seed_frequency')
+
+# queue keys waiting for the worker.  a queue is pushed at most once until the
+# worker picks it up, the pending set dedupes the requests
+REFILL_REQUESTS_KEY = 'queue_refill_requests'
+REFILL_PENDING_KEY = 'queue_refill_pending'
+# seed details asked for per queue key (the seed_frequency trickle)
+REFILL_SEED_COUNTS_KEY = 'queue_refill_seed_counts'
+# one token per detail added by a refill, for callers waiting on an empty queue
+REFILLED_PREFIX = 'queue_refilled_'
+REFILLED_TOKENS_MAX = 100
+REFILLED_TOKENS_TTL = 10
+
+
+class QueueRefillClient(object):
+    # the request path side of QueueRefillWorker: asks for refills and waits
+    # for them, never touching postgres
+    def __init__(self,redis_mgr):
+        self.redis = redis_mgr.redis
+
+    def request(self,queue,seed=0):
+        pipe = self.redis.pipeline(transaction=False)
+        if seed:
+            pipe.hincrby(REFILL_SEED_COUNTS_KEY, queue.queue_key, seed)
+        pipe.sadd(REFILL_PENDING_KEY, queue.queue_key)
+        if pipe.execute()[-1]:
+            self.redis.rpush(REFILL_REQUESTS_KEY, queue.queue_key)
+
+    def wait(self,queue,timeout):
+        # blocks until the worker has added details to the queue, or for
+        # timeout seconds.  returns True if it did
+        return self.redis.blpop("%s%s" % (REFILLED_PREFIX, queue.queue_key), timeout=timeout) is not None
+
+
+class QueueRefiller(object):
+    # what a draw does about its queue running low, for ProxyManager and
+    # AsyncProxyManager alike.  refills inline from postgres, or with
+    # use_worker (queue_refill_worker by default) only asks
+    # QueueRefillWorker for a refill
+    def __init__(self,storage_mgr,use_worker=None):
+        self.storage_mgr = storage_mgr
+        self.client = None
+        if use_worker is None:
+            use_worker = QUEUE_REFILL_WORKER
+        if use_worker:
+            self.client = QueueRefillClient(storage_mgr.redis_mgr)
+
+    def refill(self,queue,queue_count,inactive_length):
+        # returns True if the queue was refilled inline.  the seed queue is
+        # only ever filled once, when it is first used
+        if queue.id() == SEED_QUEUE_ID:
+            if queue_count == 0:
+                self.storage_mgr.initialize_seed_queue()
+                return True
+            return False
+
+        if self.client is not None:
+            if queue_count == 0 or inactive_length < MIN_QUEUE_SIZE:
+                self.client.request(queue)
+            elif flip_coin(SEED_FREQUENCY):
+                self.client.request(queue,seed=1)
+            return False
+
+        refilled = False
+        if queue_count == 0:
+            self.storage_mgr.redis_mgr.initialize_queue(queue=queue)
+            inactive_length = RedisDetailQueue(queue,active=False,redis_mgr=self.storage_mgr.redis_mgr).length()
+            refilled = True
+
+        if inactive_length < MIN_QUEUE_SIZE:
+            logger.info("rdq is less than the min queue size, creating some new details...")
+            self.storage_mgr.create_new_details(queue=queue)
+            refilled = True
+
+        elif flip_coin(SEED_FREQUENCY):
+            self.storage_mgr.create_new_details(queue=queue,count=1)
+        return refilled
+
+    def wait(self,queue):
+        # a short blocking wait for the refill worker instead of failing the
+        # draw.  returns True if details were added in the meantime
+        if self.client is None or queue.id() == SEED_QUEUE_ID:
+            return False
+        logger.info("queue %s is empty, waiting for the refill worker" % queue.domain)
+        return self.client.wait(queue,REFILL_WAIT_TIMEOUT)
+
+
+class QueueRefillWorker(object):
+    # keeps the inactive queue of every queue between the low and high
+    # watermark.  a queue is refilled once it drops below low_watermark, up
+    # to high_watermark, so a queue being drained is refilled in batches
+    # rather than by a few details on every draw.  queues are picked up when a
+    # ProxyManager requests it and by a scan every scan_interval seconds.
+    def __init__(self,storage_mgr,low_watermark=MIN_QUEUE_SIZE,high_watermark=REFILL_HIGH_WATERMARK,scan_interval=REFILL_SCAN_INTERVAL):
+        self.storage_mgr = storage_mgr
+        self.redis_mgr = storage_mgr.redis_mgr
+        self.redis = storage_mgr.redis_mgr.redis
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.scan_interval = scan_interval
+        self.last_scan = 0
+
+    def take_seed_count(self,queue_key):
+        pipe = self.redis.pipeline()
+        pipe.hget(REFILL_SEED_COUNTS_KEY, queue_key)
+        pipe.hdel(REFILL_SEED_COUNTS_KEY, queue_key)
+        return int(pipe.execute()[0] or 0)
+
+    def get_queue(self,queue_key):
+        # None for a stale key whose queue hash is gone, e.g. after a flush
+        data = self.redis.hgetall(queue_key)
+        if not data:
+            return None
+        return Queue.from_redis(data, queue_key)
+
+    def queue_length(self,queue):
+        return RedisDetailQueue(queue,active=True,redis_mgr=self.redis_mgr).length() + RedisDetailQueue(queue,active=False,redis_mgr=self.redis_mgr).length()
+
+    def refill(self,queue_key):
+        self.redis.srem(REFILL_PENDING_KEY, queue_key)
+        queue = self.get_queue(queue_key)
+        if queue is None:
+            logger.warning("not refilling %s, the queue is not cached" % queue_key)
+            return 0
+        if queue.id() in (SEED_QUEUE_ID, AGGREGATE_QUEUE_ID):
+            return 0
+
+        length = self.queue_length(queue)
+        if self.redis_mgr.get_queue_count(queue) == 0:
+            self.redis_mgr.initialize_queue(queue=queue)
+
+        inactive_length = RedisDetailQueue(queue,active=False,redis_mgr=self.redis_mgr).length()
+        count = self.take_seed_count(queue_key)
+        if inactive_length < self.low_watermark:
+            count += self.high_watermark - inactive_length
+        if count > 0:
+            self.storage_mgr.create_new_details(queue=queue,count=count)
+
+        added = self.queue_length(queue) - length
+        if added > 0:
+            tokens_key = "%s%s" % (REFILLED_PREFIX, queue_key)
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.rpush(tokens_key, *[1] * min(added, REFILLED_TOKENS_MAX))
+            pipe.expire(tokens_key, REFILLED_TOKENS_TTL)
+            pipe.execute()
+            logger.info("refilled %s with %s details" % (queue.domain, added))
+        return added
+
+    def scan(self):
+        # keys of the queues in use (with cached details) whose inactive queue
+        # is below the low watermark
+        self.last_scan = time.time()
+        low = []
+        for queue_key in self.redis.hkeys(QUEUE_DETAIL_COUNT_KEY):
+            queue = self.get_queue(queue_key)
+            if queue is None:
+                continue
+            if RedisDetailQueue(queue,active=False,redis_mgr=self.redis_mgr).length() < self.low_watermark:
+                low.append(queue_key)
+        return low
+
+    def try_refill(self,queue_key):
+        # a queue that fails to refill (postgres down, a bad row) is logged
+        # and left for the next request or scan, the other queues go on
+        try:
+            return self.refill(queue_key)
+        except Exception:
+            logger.exception("error while refilling queue %s" % queue_key)
+            return 0
+
+    def run(self):
+        logger.info("queue refill worker started")
+        while True:
+            try:
+                if time.time() - self.last_scan >= self.scan_interval:
+                    for queue_key in self.scan():
+                        self.try_refill(queue_key)
+                item = self.redis.blpop(REFILL_REQUESTS_KEY, timeout=self.scan_interval)
+                if item is not None:
+                    self.try_refill(item[1])
+            except redis.exceptions.ConnectionError as e:
+                logger.error("lost connection to redis: %s" % e)
+                time.sleep(1)
+            except Exception:
+                logger.exception("error in queue refill worker")
+                time.sleep(1)
@@ -0,0 +1,420 @@
+# Lua scripts executed server side by redis (EVALSHA with an EVAL fallback via
+# redis-py's Script objects).  Each script runs atomically, so several
+# scrapyd processes sharing one redis cannot race between reads and writes.
+
+LUA_HELPERS = """
+local function to_map(flat)
+    local map = {}
+    for i = 1, #flat, 2 do
+        map[flat[i]] = flat[i + 1]
+    end
+    return map
+end
+
+-- timestamps are stored as epoch seconds (see format_redis_timestamp), older
+-- caches may still hold naive utc iso strings
+local function to_epoch(ts)
+    if not ts then
+        return 0
+    end
+    local numeric = tonumber(ts)
+    if numeric then
+        return numeric
+    end
+    local y, m, d, hh, mm, ss = string.match(ts, '^(%d+)-(%d+)-(%d+)T(%d+):(%d+):([%d%.]+)')
+    if not y then
+        return 0
+    end
+    y = tonumber(y)
+    m = tonumber(m)
+    d = tonumber(d)
+    if m <= 2 then
+        y = y - 1
+    end
+    local era = math.floor(y / 400)
+    local yoe = y - era * 400
+    local doy = math.floor((153 * ((m + 9) % 12) + 2) / 5) + d - 1
+    local doe = yoe * 365 + math.floor(yoe / 4) - math.floor(yoe / 100) + doy
+    local days = era * 146097 + doe - 719468
+    return days * 86400 + tonumber(hh) * 3600 + tonumber(mm) * 60 + tonumber(ss)
+end
+
+-- moves the details whose cooldown has expired from a cooldown sorted set
+-- (scored by next eligible time) to the tail of its detail queue
+local function promote(queue_key, cooldown_key, now, limit)
+    local eligible = redis.call('ZRANGEBYSCORE', cooldown_key, '-inf', now, 'LIMIT', 0, limit)
+    if #eligible > 0 then
+        redis.call('RPUSH', queue_key, unpack(eligible))
+        redis.call('ZREM', cooldown_key, unpack(eligible))
+    end
+    return #eligible
+end
+"""
+
+# KEYS: active detail queue, inactive detail queue, active cooldown set,
+#       inactive cooldown set, queue detail counts hash, changed details set
+# ARGV: queue_key, now, proxy_interval, blacklist_time, max_blacklist_count,
+#       min_queue_size, target_active_count, rand, max_attempts, promote_limit,
+#       count
+#
+# queue lengths include the details that are cooling down
+# returns {found, active_length, inactive_length, queue_count, drawn_active,
+#          detail_hash, proxy_hash}, followed by another drawn_active,
+#          detail_hash, proxy_hash triple for each further detail drawn when
+#          count > 1.  max_attempts is shared by the whole batch.
+DRAW_DETAIL_SCRIPT = LUA_HELPERS + """
+local queue_key = ARGV[1]
+local now = tonumber(ARGV[2])
+local proxy_interval = tonumber(ARGV[3])
+local blacklist_time = tonumber(ARGV[4])
+local max_blacklist_count = tonumber(ARGV[5])
+local min_queue_size = tonumber(ARGV[6])
+local target_active_count = tonumber(ARGV[7])
+local rand = tonumber(ARGV[8])
+local max_attempts = tonumber(ARGV[9])
+local promote_limit = tonumber(ARGV[10])
+local count = tonumber(ARGV[11] or 1)
+
+promote(KEYS[1], KEYS[3], now, promote_limit)
+promote(KEYS[2], KEYS[4], now, promote_limit)
+
+local active_length = redis.call('LLEN', KEYS[1]) + redis.call('ZCARD', KEYS[3])
+local inactive_length = redis.call('LLEN', KEYS[2]) + redis.call('ZCARD', KEYS[4])
+local queue_count = tonumber(redis.call('HGET', KEYS[5], queue_key) or 0)
+
+local result = {0, active_length, inactive_length, queue_count}
+local attempts_left = max_attempts
+
+for n = 1, count do
+    -- spread the picks of a batch evenly over [0, 1) from the random start
+    local pick_rand = (rand + (n - 1) * 0.6180339887) % 1
+    local draw_key = KEYS[2]
+    local cooldown_key = KEYS[4]
+    local drawn_active = 0
+    if active_length >= min_queue_size and pick_rand < active_length / target_active_count then
+        draw_key = KEYS[1]
+        cooldown_key = KEYS[3]
+        drawn_active = 1
+    end
+
+    local attempts = math.min(attempts_left, redis.call('LLEN', draw_key))
+    for i = 1, attempts do
+        attempts_left = attempts_left - 1
+        local detail_key = redis.call('LPOP', draw_key)
+        if not detail_key then
+            break
+        end
+        local detail = redis.call('HGETALL', detail_key)
+        if #detail > 0 then
+            local fields = to_map(detail)
+            local usable = true
+            local last_used = to_epoch(fields['last_used'])
+            local since_used = now - last_used
+
+            if fields['blacklisted'] == '1' then
+                if since_used > blacklist_time and tonumber(fields['blacklisted_count'] or 0) < max_blacklist_count then
+                    redis.call('HSET', detail_key, 'blacklisted', '0')
+                    redis.call('SADD', KEYS[6], detail_key)
+                    detail = redis.call('HGETALL', detail_key)
+                else
+                    usable = false
+                end
+            end
+
+            local proxy = {}
+            if usable then
+                proxy = redis.call('HGETALL', fields['proxy_key'])
+                local protocol = to_map(proxy)['protocol']
+                if #proxy == 0 or (protocol and string.find(protocol, 'socks')) then
+                    usable = false
+                end
+            end
+
+            if usable then
+                if since_used < proxy_interval then
+                    -- still cooling down, it comes back once its interval has passed
+                    redis.call('ZADD', cooldown_key, last_used + proxy_interval, detail_key)
+                else
+                    result[1] = result[1] + 1
+                    table.insert(result, drawn_active)
+                    table.insert(result, detail)
+                    table.insert(result, proxy)
+                    break
+                end
+            end
+        end
+    end
+end
+
+if result[1] == 0 then
+    table.insert(result, 0)
+    table.insert(result, {})
+    table.insert(result, {})
+end
+return result
+"""
+
+# ranked queues: one sorted set per queue scored by reliability, paired with a
+# cooldown set like the fifo queues
+RANKED_HELPERS = """
+-- success ratio (laplace smoothed) * latency factor * recency factor.
+-- latency is the detail's latency_ewma in ms, or its load_time before it has
+-- one.  untested details get a neutral latency factor so they are not buried
+-- under the default load_time.
+local function reliability_score(fields, now, latency_ref, half_life)
+    local good = tonumber(fields['lifetime_good'] or 0)
+    local bad = tonumber(fields['lifetime_bad'] or 0)
+    local ratio = (good + 1) / (good + bad + 2)
+
+    local latency = 0.5
+    if good > 0 then
+        local latency_ms = tonumber(fields['latency_ewma'] or 0)
+        if latency_ms <= 0 then
+            latency_ms = tonumber(fields['load_time'] or 0)
+        end
+        latency = latency_ref / (latency_ref + math.max(latency_ms, 0))
+    end
+
+    local since_active = math.max(now - to_epoch(fields['last_active']), 0)
+    local recency = 0.5 + 0.5 * math.pow(0.5, since_active / half_life)
+
+    return ratio * latency * recency
+end
+
+-- like promote, but members are scored by reliability as they enter the queue
+local function promote_ranked(queue_key, cooldown_key, now, limit, latency_ref, half_life)
+    local eligible = redis.call('ZRANGEBYSCORE', cooldown_key, '-inf', now, 'LIMIT', 0, limit)
+    for _, detail_key in ipairs(eligible) do
+        local detail = redis.call('HGETALL', detail_key)
+        if #detail > 0 then
+            redis.call('ZADD', queue_key, reliability_score(to_map(detail), now, latency_ref, half_life), detail_key)
+        end
+    end
+    if #eligible > 0 then
+        redis.call('ZREM', cooldown_key, unpack(eligible))
+    end
+    return #eligible
+end
+"""
+
+# KEYS: ranked detail queue, ranked cooldown set, queue detail counts hash,
+#       changed details set
+# ARGV: queue_key, now, proxy_interval, blacklist_time, max_blacklist_count,
+#       top_band, explore_pct, rand_explore, rand_pick, max_attempts,
+#       promote_limit, latency_ref, recency_half_life, count
+#
+# draws uniformly from the top_band best scored details, or from the whole
+# queue explore_pct of the time.  returns the same shape as DRAW_DETAIL_SCRIPT,
+# batches included, with the queue's total length in both length slots.
+DRAW_RANKED_DETAIL_SCRIPT = LUA_HELPERS + RANKED_HELPERS + """
+local queue_key = ARGV[1]
+local now = tonumber(ARGV[2])
+local proxy_interval = tonumber(ARGV[3])
+local blacklist_time = tonumber(ARGV[4])
+local max_blacklist_count = tonumber(ARGV[5])
+local top_band = tonumber(ARGV[6])
+local explore = tonumber(ARGV[8]) < tonumber(ARGV[7])
+local rand_pick = tonumber(ARGV[9])
+local max_attempts = tonumber(ARGV[10])
+local count = tonumber(ARGV[14] or 1)
+
+promote_ranked(KEYS[1], KEYS[2], now, tonumber(ARGV[11]), tonumber(ARGV[12]), tonumber(ARGV[13]))
+
+local queue_length = redis.call('ZCARD', KEYS[1]) + redis.call('ZCARD', KEYS[2])
+local queue_count = tonumber(redis.call('HGET', KEYS[3], queue_key) or 0)
+
+local result = {0, queue_length, queue_length, queue_count}
+
+for i = 1, max_attempts do
+    local ranked_length = redis.call('ZCARD', KEYS[1])
+    if ranked_length == 0 or result[1] == count then
+        break
+    end
+    local band = ranked_length
+    if not explore then
+        band = math.min(top_band, ranked_length)
+    end
+    -- spread the picks of a batch over the band as DRAW_DETAIL_SCRIPT does
+    local index = math.floor(((rand_pick + result[1] * 0.6180339887) % 1) * band)
+    local detail_key = redis.call('ZREVRANGE', KEYS[1], index, index)[1]
+    redis.call('ZREM', KEYS[1], detail_key)
+
+    local detail = redis.call('HGETALL', detail_key)
+    if #detail > 0 then
+        local fields = to_map(detail)
+        local usable = true
+        local last_used = to_epoch(fields['last_used'])
+        local since_used = now - last_used
+
+        if fields['blacklisted'] == '1' then
+            if since_used > blacklist_time and tonumber(fields['blacklisted_count'] or 0) < max_blacklist_count then
+                redis.call('HSET', detail_key, 'blacklisted', '0')
+                redis.call('SADD', KEYS[4], detail_key)
+                detail = redis.call('HGETALL', detail_key)
+            else
+                usable = false
+            end
+        end
+
+        local proxy = {}
+        if usable then
+            proxy = redis.call('HGETALL', fields['proxy_key'])
+            local protocol = to_map(proxy)['protocol']
+            if #proxy == 0 or (protocol and string.find(protocol, 'socks')) then
+                usable = false
+            end
+        end
+
+        if usable then
+            if since_used < proxy_interval then
+                redis.call('ZADD', KEYS[2], last_used + proxy_interval, detail_key)
+            else
+                local drawn_active = 0
+                if fields['active'] == '1' then
+                    drawn_active = 1
+                end
+                result[1] = result[1] + 1
+                table.insert(result, drawn_active)
+                table.insert(result, detail)
+                table.insert(result, proxy)
+            end
+        end
+    end
+end
+
+if result[1] == 0 then
+    table.insert(result, 0)
+    table.insert(result, {})
+    table.insert(result, {})
+end
+return result
+"""
+
+# KEYS: detail key, changed details set, in flight leases of the detail's proxy
+# ARGV: success ('1', '0' or '' for a neutral outcome), now, load_time,
+#       blacklist_threshold, decrement_blacklist, requeue,
+#       active cooldown set prefix, inactive cooldown set prefix, proxy_interval,
+#       in flight lease to release ('' for none),
+#       load_time's latency bucket (1 based), latency ewma alpha,
+#       latency bucket count, queue latency histogram prefix
+#
+# a success folds load_time (ms) into the detail's latency_ewma and
+# latency_hist, and into its queue's histogram hash (field = bucket).
+# a requeued detail goes to its queue's cooldown set and becomes drawable
+# again proxy_interval seconds after this outcome
+# returns the updated detail hash, or an empty reply if the detail no longer
+# exists in the cache
+RECORD_OUTCOME_SCRIPT = LUA_HELPERS + """
+local detail_key = KEYS[1]
+local success = ARGV[1]
+local now = ARGV[2]
+local load_time = ARGV[3]
+local blacklist_threshold = tonumber(ARGV[4])
+local decrement_blacklist = ARGV[5] == '1'
+local requeue = ARGV[6] == '1'
+local bucket = tonumber(ARGV[11])
+local ewma_alpha = tonumber(ARGV[12])
+local bucket_count = tonumber(ARGV[13])
+
+if ARGV[10] ~= '' then
+    redis.call('ZREM', KEYS[3], ARGV[10])
+end
+
+if redis.call('EXISTS', detail_key) == 0 then
+    return {}
+end
+
+redis.call('HSET', detail_key, 'last_used', now)
+
+if success == '1' then
+    redis.call('HSET', detail_key, 'load_time', load_time, 'active', '1', 'last_active', now)
+    redis.call('HINCRBY', detail_key, 'lifetime_good', 1)
+
+    local hist = {}
+    local samples = 0
+    for count in string.gmatch(redis.call('HGET', detail_key, 'latency_hist') or '', '%d+') do
+        table.insert(hist, tonumber(count))
+        samples = samples + tonumber(count)
+    end
+    for i = #hist + 1, bucket_count do
+        hist[i] = 0
+    end
+    hist[bucket] = hist[bucket] + 1
+    local ewma = tonumber(load_time)
+    if samples > 0 then
+        local previous = tonumber(redis.call('HGET', detail_key, 'latency_ewma') or 0)
+        ewma = previous + ewma_alpha * (ewma - previous)
+    end
+    redis.call('HSET', detail_key, 'latency_ewma', string.format('%.1f', ewma), 'latency_hist', table.concat(hist, ','))
+    redis.call('HINCRBY', ARGV[14] .. redis.call('HGET', detail_key, 'queue_key'), bucket, 1)
+
+    if decrement_blacklist and tonumber(redis.call('HGET', detail_key, 'blacklisted_count') or 0) > 0 then
+        redis.call('HINCRBY', detail_key, 'blacklisted_count', -1)
+    end
+elseif success == '0' then
+    redis.call('HINCRBY', detail_key, 'lifetime_bad', 1)
+    local bad_count = redis.call('HINCRBY', detail_key, 'bad_count', 1)
+    if bad_count > blacklist_threshold then
+        redis.call('HSET', detail_key, 'blacklisted', '1', 'active', '0')
+        redis.call('HINCRBY', detail_key, 'blacklisted_count', 1)
+    end
+end
+
+redis.call('SADD', KEYS[2], detail_key)
+local detail = redis.call('HGETALL', detail_key)
+
+if requeue then
+    local fields = to_map(detail)
+    local protocol = redis.call('HGET', fields['proxy_key'], 'protocol')
+    if fields['blacklisted'] ~= '1' and not (protocol and string.find(protocol, 'socks')) then
+        local eligible_at = to_epoch(now) + tonumber(ARGV[9])
+        if fields['active'] == '1' then
+            redis.call('ZADD', ARGV[7] .. fields['queue_key'], eligible_at, detail_key)
+        else
+            redis.call('ZADD', ARGV[8] .. fields['queue_key'], eligible_at, detail_key)
+        end
+    end
+end
+
+return detail
+"""
+
+# moves the dirty sets aside so an incremental sync works on a stable snapshot
+# while callbacks keep marking objects in fresh sets.  a snapshot left behind
+# by a failed sync is merged rather than overwritten.
+#
+# KEYS: dirty sets followed by their snapshot sets
+# returns the size of each snapshot
+SNAPSHOT_DIRTY_SETS_SCRIPT = """
+local count = #KEYS / 2
+local sizes = {}
+for i = 1, count do
+    local src = KEYS[i]
+    local dst = KEYS[i + count]
+    if redis.call('EXISTS', src) == 1 then
+        if redis.call('EXISTS', dst) == 1 then
+            redis.call('SUNIONSTORE', dst, dst, src)
+            redis.call('DEL', src)
+        else
+            redis.call('RENAME', src, dst)
+        end
+    end
+    sizes[i] = redis.call('SCARD', dst)
+end
+return sizes
+"""
+
+# KEYS: detail queue, cooldown set
+# ARGV: now, promote_limit
+# returns the number of details promoted
+PROMOTE_COOLDOWN_SCRIPT = LUA_HELPERS + """
+return promote(KEYS[1], KEYS[2], tonumber(ARGV[1]), tonumber(ARGV[2]))
+"""
+
+class RedisScripts(object):
+    def __init__(self,redis):
+        self.draw_detail = redis.register_script(DRAW_DETAIL_SCRIPT)
+        self.record_outcome = redis.register_script(RECORD_OUTCOME_SCRIPT)
+        self.snapshot_dirty_sets = redis.register_script(SNAPSHOT_DIRTY_SETS_SCRIPT)
+        self.promote_cooldown = redis.register_script(PROMOTE_COOLDOWN_SCRIPT)
+        self.draw_ranked_detail = redis.register_script(DRAW_RANKED_DETAIL_SCRIPT)
@@ -0,0 +1,255 @@
+import time
+import random
+import logging
+from abc import ABC, abstractmethod
+
+from scrapy_autoproxy.config import configuration
+from scrapy_autoproxy.proxy_objects import Detail, Proxy
+from scrapy_autoproxy.util import parse_epoch
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, DetailDraw, QUEUE_DETAIL_COUNT_KEY, DRAW_MAX_ATTEMPTS, BLACKLIST_TIME, MAX_BLACKLIST_COUNT
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+app_config = lambda config_val: configuration.app_config[config_val]['value']
+
+TARGET_ACTIVE_COUNT = 200
+BANDIT_MAX_CANDIDATES = app_config('bandit_max_candidates')
+BANDIT_PRIOR_ALPHA = app_config('bandit_prior_alpha')
+BANDIT_PRIOR_BETA = app_config('bandit_prior_beta')
+MAX_PROXY_CONCURRENCY = app_config('max_proxy_concurrency')
+
+
+def sample_beta(alphas,betas):
+    # one draw per candidate. numpy samples the whole vector at once, the
+    # fallback keeps the policy usable without it
+    if np is not None:
+        return np.random.beta(np.asarray(alphas, dtype=float), np.asarray(betas, dtype=float))
+    return [random.betavariate(a,b) for a,b in zip(alphas,betas)]
+
+def rank_samples(samples):
+    if np is not None:
+        return np.argsort(-np.asarray(samples)).tolist()
+    return sorted(range(len(samples)), key=samples.__getitem__, reverse=True)
+
+
+class SelectionPolicy(ABC):
+    # picks and claims one detail from a queue.  draw returns a DetailDraw,
+    # whose detail is None when nothing could be drawn
+    def __init__(self,redis_mgr):
+        self.redis_mgr = redis_mgr
+
+    @abstractmethod
+    def draw(self,queue):
+        pass
+
+    def usable(self,detail_key,blacklisted,last_used,blacklisted_count,now):
+        # the blacklist rule of the draw scripts: a blacklisted detail is
+        # unblacklisted once blacklist_time has passed since it was last
+        # used, unless it was blacklisted max_blacklist_count times already
+        if blacklisted != '1':
+            return True
+        if now - parse_epoch(last_used) > BLACKLIST_TIME and int(blacklisted_count or 0) < MAX_BLACKLIST_COUNT:
+            self.redis_mgr.unblacklist_detail(detail_key)
+            return True
+        return False
+
+    def draw_many(self,queue,count):
+        # returns the draws that found a detail, or a single empty draw
+        # (still carrying the queue lengths) when none did
+        draws = []
+        for i in range(count):
+            draw = self.draw(queue)
+            if draw.detail is None:
+                break
+            draws.append(draw)
+        return draws or [draw]
+
+
+class LuaPolicy(SelectionPolicy):
+    # flip between the active and inactive queues, weighted by the active
+    # queue's length, and pop the first usable detail
+    def draw(self,queue):
+        return self.redis_mgr.draw_detail(queue, TARGET_ACTIVE_COUNT)
+
+    def draw_many(self,queue,count):
+        # the whole batch comes from a single script call
+        return self.redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, count)
+
+
+class RankedPolicy(SelectionPolicy):
+    def draw(self,queue):
+        return self.redis_mgr.draw_ranked_detail(queue)
+
+    def draw_many(self,queue,count):
+        return self.redis_mgr.draw_ranked_details(queue, count)
+
+
+class ThompsonSamplingPolicy(SelectionPolicy):
+    # keeps a Beta(lifetime_good + alpha, lifetime_bad + beta) posterior per
+    # detail and takes the candidate with the highest sample. proxies with
+    # few outcomes sample widely and still get tried, exploration tapers off
+    # as their counts grow.
+    def candidates(self,rdqs):
+        redis = self.redis_mgr.redis
+        pipe = redis.pipeline(transaction=False)
+        for rdq in rdqs:
+            pipe.lrange(rdq.redis_key, 0, BANDIT_MAX_CANDIDATES - 1)
+        detail_keys = []
+        for rdq, keys in zip(rdqs, pipe.execute()):
+            detail_keys.extend((key, rdq) for key in keys)
+
+        for key, rdq in detail_keys:
+            pipe.hmget(key, 'lifetime_good', 'lifetime_bad', 'blacklisted', 'last_used', 'blacklisted_count')
+
+        now = time.time()
+        candidates = []
+        dropped = []
+        for (key, rdq), (good, bad, blacklisted, last_used, blacklisted_count) in zip(detail_keys, pipe.execute()):
+            if good is None or not self.usable(key, blacklisted, last_used, blacklisted_count, now):
+                dropped.append((key, rdq))
+                continue
+            candidates.append((key, rdq, int(good), int(bad)))
+
+        # details still blacklisted are dropped from the queue, as the draw
+        # scripts pop them
+        for key, rdq in dropped:
+            pipe.lrem(rdq.redis_key, 1, key)
+        pipe.execute()
+        return candidates
+
+    def draw(self,queue):
+        return self.draw_many(queue,1)[0]
+
+    def draw_many(self,queue,count):
+        # the candidates are read and sampled once, the batch is the count
+        # best samples that could be claimed
+        redis = self.redis_mgr.redis
+        rdq_active = RedisDetailQueue(queue, active=True, redis_mgr=self.redis_mgr)
+        rdq_inactive = RedisDetailQueue(queue, active=False, redis_mgr=self.redis_mgr)
+        rdqs = (rdq_active, rdq_inactive)
+        for rdq in rdqs:
+            rdq.promote()
+
+        candidates = self.candidates(rdqs)
+        queue_count = int(redis.hget(QUEUE_DETAIL_COUNT_KEY, queue.queue_key) or 0)
+        lengths = (rdq_active.length(), rdq_inactive.length(), queue_count)
+        if not candidates:
+            return [DetailDraw.empty(*lengths)]
+
+        samples = sample_beta([c[2] + BANDIT_PRIOR_ALPHA for c in candidates], [c[3] + BANDIT_PRIOR_BETA for c in candidates])
+        draws = []
+        # max attempts is shared by the whole batch, as in the draw scripts
+        for index in rank_samples(samples)[:DRAW_MAX_ATTEMPTS]:
+            if len(draws) == count:
+                break
+            detail_key, rdq = candidates[index][:2]
+            # LREM is the claim: only one process can remove a given entry
+            if not redis.lrem(rdq.redis_key, 1, detail_key):
+                continue
+            detail = Detail.from_redis(redis.hgetall(detail_key), detail_key)
+            proxy = Proxy.from_redis(redis.hgetall(detail.proxy_key), detail.proxy_key)
+            if 'socks' in proxy.protocol:
+                continue
+            draw = DetailDraw.empty(*lengths)
+            draw.detail = detail
+            draw.proxy = proxy
+            draw.active = rdq.active
+            draws.append(draw)
+
+        return draws or [DetailDraw.empty(*lengths)]
+
+
+class PowerOfTwoChoicesPolicy(SelectionPolicy):
+    # samples two queued details at random and takes the one whose proxy has
+    # fewer requests in flight across all crawler processes.  proxies at
+    # MAX_PROXY_CONCURRENCY are never picked.
+    def sample(self,rdqs,lengths,pairs=1):
+        # up to pairs pairs of distinct queued details, as (key, rdq, pair)
+        total = sum(lengths)
+        picks = random.sample(range(total), min(2 * pairs, total))
+        pipe = self.redis_mgr.redis.pipeline(transaction=False)
+        sampled = []
+        for n, pick in enumerate(picks):
+            rdq = rdqs[0] if pick < lengths[0] else rdqs[1]
+            index = pick if pick < lengths[0] else pick - lengths[0]
+            pipe.lindex(rdq.redis_key, index)
+            sampled.append((rdq, n // 2))
+        return [(key, rdq, pair) for key, (rdq, pair) in zip(pipe.execute(), sampled) if key is not None]
+
+    def draw(self,queue):
+        return self.draw_many(queue,1)[0]
+
+    def draw_many(self,queue,count):
+        # each round samples a pair for every proxy still needed, in one
+        # pipeline, and claims the less loaded detail of each pair
+        redis = self.redis_mgr.redis
+        rdq_active = RedisDetailQueue(queue, active=True, redis_mgr=self.redis_mgr)
+        rdq_inactive = RedisDetailQueue(queue, active=False, redis_mgr=self.redis_mgr)
+        rdqs = (rdq_active, rdq_inactive)
+        for rdq in rdqs:
+            rdq.promote()
+
+        queue_count = int(redis.hget(QUEUE_DETAIL_COUNT_KEY, queue.queue_key) or 0)
+        lengths = (rdq_active.length(), rdq_inactive.length(), queue_count)
+        draws = []
+
+        for attempt in range(DRAW_MAX_ATTEMPTS):
+            if len(draws) == count:
+                break
+            queued = [redis.llen(rdq.redis_key) for rdq in rdqs]
+            if sum(queued) == 0:
+                break
+
+            pipe = redis.pipeline(transaction=False)
+            sampled = self.sample(rdqs, queued, count - len(draws))
+            for key, rdq, pair in sampled:
+                pipe.hmget(key, 'proxy_key', 'blacklisted', 'last_used', 'blacklisted_count')
+            now = time.time()
+            choices = []
+            for (key, rdq, pair), (proxy_key, blacklisted, last_used, blacklisted_count) in zip(sampled, pipe.execute()):
+                if proxy_key is None or not self.usable(key, blacklisted, last_used, blacklisted_count, now):
+                    # details still blacklisted are dropped from the queue rather than drawn
+                    redis.lrem(rdq.redis_key, 1, key)
+                    continue
+                choices.append((key, rdq, proxy_key, pair))
+
+            in_flight = self.redis_mgr.get_in_flight([c[2] for c in choices])
+            # within each pair the detail with fewer requests in flight goes first
+            ranked = sorted((c[3], in_flight_count, index) for index, (c, in_flight_count) in enumerate(zip(choices, in_flight)))
+            claimed = set()
+            for pair, in_flight_count, index in ranked:
+                if pair in claimed or in_flight_count >= MAX_PROXY_CONCURRENCY:
+                    continue
+                detail_key, rdq, proxy_key = choices[index][:3]
+                if not redis.lrem(rdq.redis_key, 1, detail_key):
+                    continue
+                detail = Detail.from_redis(redis.hgetall(detail_key), detail_key)
+                proxy = Proxy.from_redis(redis.hgetall(proxy_key), proxy_key)
+                if 'socks' in proxy.protocol:
+                    continue
+                draw = DetailDraw.empty(*lengths)
+                draw.detail = detail
+                draw.proxy = proxy
+                draw.active = rdq.active
+                draws.append(draw)
+                claimed.add(pair)
+
+        return draws or [DetailDraw.empty(*lengths)]
+
+
+SELECTION_POLICIES = {
+    'lua': LuaPolicy,
+    'ranked': RankedPolicy,
+    'thompson': ThompsonSamplingPolicy,
+    'p2c': PowerOfTwoChoicesPolicy,
+}
+
+def get_selection_policy(name,redis_mgr):
+    if name not in SELECTION_POLICIES:
+        raise Exception("Unknown selection policy %s, expected one of %s" % (name, ', '.join(sorted(SELECTION_POLICIES))))
+    return SELECTION_POLICIES[name](redis_mgr)
@@ -0,0 +1,188 @@
+import sys
+import gzip
+import time
+import struct
+import argparse
+import logging
+
+from scrapy_autoproxy.storage_manager import get_redis, PROXY_IN_FLIGHT_PREFIX
+from scrapy_autoproxy.id_allocator import ID_POOL_PREFIX
+from scrapy_autoproxy.queue_refill import REFILL_REQUESTS_KEY, REFILL_PENDING_KEY, REFILLED_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# a snapshot is the header followed by one record per key:
+#   key length (4 bytes), key, ttl in ms (8 bytes, 0 for none),
+#   value length (4 bytes), value (the key's DUMP payload)
+# and a key length of 0 to end it.  DUMP payloads are tied to the redis
+# version, restore into the same major version the snapshot was taken from.
+SNAPSHOT_HEADER = b'AUTOPROXY-SNAPSHOT\x01'
+GZIP_MAGIC = b'\x1f\x8b'
+SNAPSHOT_BATCH_SIZE = 1000
+
+# locks, in flight leases, reserved ids and refill hand offs belong to the
+# processes running against the cache at the time, not to its contents
+EXCLUDED_KEYS = (b'syncing', REFILL_REQUESTS_KEY.encode(), REFILL_PENDING_KEY.encode())
+EXCLUDED_PREFIXES = (b'syncing_', PROXY_IN_FLIGHT_PREFIX.encode(), ID_POOL_PREFIX.encode(), REFILLED_PREFIX.encode())
+
+
+def is_excluded(key):
+    return key in EXCLUDED_KEYS or key.startswith(EXCLUDED_PREFIXES)
+
+def binary_redis():
+    # DUMP payloads are binary, so they need a client that does not decode
+    return get_redis(decode_responses=False)
+
+def read_exact(stream,size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise Exception("Snapshot is truncated")
+    return data
+
+
+def save(path,compress=False,redis=None):
+    # streams every cached key to path, batch by batch over SCAN.  keys
+    # written while the snapshot runs may or may not be in it.
+    redis = redis or binary_redis()
+    start = time.time()
+    count = 0
+    size = 0
+    opener = gzip.open if compress else open
+    with opener(path, 'wb') as out:
+        out.write(SNAPSHOT_HEADER)
+        batch = []
+        for key in redis.scan_iter(count=SNAPSHOT_BATCH_SIZE):
+            if is_excluded(key):
+                continue
+            batch.append(key)
+            if len(batch) >= SNAPSHOT_BATCH_SIZE:
+                written, nbytes = write_batch(redis, out, batch)
+                count += written
+                size += nbytes
+                batch = []
+        written, nbytes = write_batch(redis, out, batch)
+        count += written
+        size += nbytes
+        out.write(struct.pack('>I', 0))
+
+    elapsed = time.time() - start
+    rate = count / elapsed if elapsed > 0 else count
+    logger.info("saved %s keys (%.1f MB of dumps) to %s in %.2f seconds (%.0f keys/sec)" % (count, size / 1e6, path, elapsed, rate))
+    return count
+
+def write_batch(redis,out,keys):
+    if not keys:
+        return 0, 0
+    pipe = redis.pipeline(transaction=False)
+    for key in keys:
+        pipe.dump(key)
+        pipe.pttl(key)
+    results = pipe.execute()
+    count = 0
+    size = 0
+    for key, value, ttl in zip(keys, results[::2], results[1::2]):
+        if value is None:
+            # deleted since the scan
+            continue
+        out.write(struct.pack('>I', len(key)))
+        out.write(key)
+        out.write(struct.pack('>q', max(ttl, 0)))
+        out.write(struct.pack('>I', len(value)))
+        out.write(value)
+        count += 1
+        size += len(value)
+    return count, size
+
+
+def records(stream):
+    if read_exact(stream, len(SNAPSHOT_HEADER)) != SNAPSHOT_HEADER:
+        raise Exception("Not an autoproxy snapshot")
+    while True:
+        key_length = struct.unpack('>I', read_exact(stream, 4))[0]
+        if key_length == 0:
+            return
+        key = read_exact(stream, key_length)
+        ttl = struct.unpack('>q', read_exact(stream, 8))[0]
+        value = read_exact(stream, struct.unpack('>I', read_exact(stream, 4))[0])
+        yield key, ttl, value
+
+def snapshot_opener(path):
+    with open(path, 'rb') as raw:
+        compressed = raw.read(2) == GZIP_MAGIC
+    return gzip.open if compressed else open
+
+def validate(path):
+    # walks every record up to the end marker, so a truncated or corrupt
+    # file is rejected before the cache is touched.  returns the key count
+    count = 0
+    try:
+        with snapshot_opener(path)(path, 'rb') as stream:
+            for record in records(stream):
+                count += 1
+    except (OSError, EOFError, struct.error) as e:
+        raise Exception("Snapshot is corrupt: %s" % e)
+    return count
+
+def restore(path,flush=False,redis=None):
+    # loads a snapshot, replacing the keys it holds.  clients wait on the
+    # syncing lock (block_if_syncing) until it is done.  with flush the cache
+    # is emptied first, so it ends up exactly as snapshotted.  the file is
+    # validated in full before either.
+    redis = redis or binary_redis()
+    start = time.time()
+    opener = snapshot_opener(path)
+    validate(path)
+
+    lock = redis.lock('syncing')
+    if not lock.acquire(blocking=True, blocking_timeout=0):
+        raise Exception("The cache is being synced, try again later")
+    try:
+        if flush:
+            pipe = redis.pipeline(transaction=False)
+            for i, key in enumerate(redis.scan_iter(count=SNAPSHOT_BATCH_SIZE), 1):
+                if key != b'syncing':
+                    pipe.delete(key)
+                if i % SNAPSHOT_BATCH_SIZE == 0:
+                    pipe.execute()
+            pipe.execute()
+
+        count = 0
+        with opener(path, 'rb') as stream:
+            pipe = redis.pipeline(transaction=False)
+            for key, ttl, value in records(stream):
+                pipe.restore(key, ttl, value, replace=True)
+                count += 1
+                if count % SNAPSHOT_BATCH_SIZE == 0:
+                    pipe.execute()
+            pipe.execute()
+    finally:
+        lock.release()
+
+    elapsed = time.time() - start
+    rate = count / elapsed if elapsed > 0 else count
+    logger.info("restored %s keys from %s in %.2f seconds (%.0f keys/sec)" % (count, path, elapsed, rate))
+    return count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Snapshot the autoproxy redis cache to a file, or restore it from one")
+    commands = parser.add_subparsers(dest='command')
+    save_parser = commands.add_parser('save')
+    save_parser.add_argument('path')
+    save_parser.add_argument('--compress', action='store_true', help="gzip the snapshot")
+    restore_parser = commands.add_parser('restore')
+    restore_parser.add_argument('path')
+    restore_parser.add_argument('--flush', action='store_true', help="empty the cache before restoring")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    if args.command == 'save':
+        save(args.path, compress=args.compress)
+    elif args.command == 'restore':
+        restore(args.path, flush=args.flush)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,15 +6,26 @@ import os
 import time
 import json
 import re
+import random
+import uuid
 from functools import wraps
+from contextlib import contextmanager
 from copy import deepcopy
 from datetime import datetime, timedelta
 import traceback
+import threading
 
 from psycopg2.extras import DictCursor
 from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 from scrapy_autoproxy.proxy_objects import Proxy, Detail, Queue
-from scrapy_autoproxy.util import parse_domain
+from scrapy_autoproxy.util import parse_domain, format_redis_timestamp
+from scrapy_autoproxy.redis_scripts import RedisScripts
+from scrapy_autoproxy.bulk_sync import BulkSync
+from scrapy_autoproxy.id_allocator import IdAllocator
+from scrapy_autoproxy.outcome_buffer import get_outcome_buffer
+from scrapy_autoproxy.outcome_stream import OutcomeStream
+from scrapy_autoproxy.latency import bucket_index, LATENCY_BUCKET_COUNT
 import logging
 logger = logging.getLogger(__name__)
 
@@ -30,20 +41,59 @@ SEED_QUEUE_DOMAIN = parse_domain(app_config('designated_endpoint'))
 AGGREGATE_QUEUE_DOMAIN = 'RESERVED_AGGREGATE_QUEUE'
 ACTIVE_LIMIT = app_config('active_proxies_per_queue')
 INACTIVE_LIMIT = app_config('inactive_proxies_per_queue')
-TEMP_ID_COUNTER = 'temp_id_counter'
 
 BLACKLIST_THRESHOLD = app_config('blacklist_threshold')
 MAX_BLACKLIST_COUNT = app_config('max_blacklist_count')
 BLACKLIST_TIME = app_config('blacklist_time')
 MAX_DB_CONNECT_ATTEMPTS = app_config('max_db_connect_attempts')
 DB_CONNECT_ATTEMPT_INTERVAL = app_config("db_connect_attempt_interval")
+DB_POOL_MIN_CONNECTIONS = app_config('db_pool_min_connections')
+DB_POOL_MAX_CONNECTIONS = app_config('db_pool_max_connections')
+BULK_SYNC = app_config('bulk_sync')
+BULK_LOAD_BATCH_SIZE = app_config('bulk_load_batch_size')
+STREAM_ITERSIZE = 10000
+ID_BLOCK_SIZE = app_config('id_block_size')
+DECREMENT_BLACKLIST = app_config('decrement_blacklist')
 PROXY_INTERVAL = app_config('proxy_interval')
 LAST_USED_CUTOFF = datetime.utcnow() - timedelta(seconds=PROXY_INTERVAL)
+NEW_QUEUES_SET_KEY = 'new_queues'
+NEW_PROXIES_SET_KEY = 'new_proxies'
 NEW_DETAILS_SET_KEY = 'new_details'
 CHANGED_DETAILS_SET_KEY = 'changed_details'
+DIRTY_SET_KEYS = (NEW_QUEUES_SET_KEY, NEW_PROXIES_SET_KEY, NEW_DETAILS_SET_KEY, CHANGED_DETAILS_SET_KEY)
+SNAPSHOT_SUFFIX = '_syncing'
 INITIAL_SEED_COUNT = app_config('initial_seed_count')
 MIN_QUEUE_SIZE = app_config('min_queue_size')
 NEW_QUEUE_PROXY_IDS_PREFIX = 'new_proxy_ids_'
+DRAW_MAX_ATTEMPTS = app_config('draw_max_attempts')
+COOLDOWN_PROMOTE_LIMIT = app_config('cooldown_promote_limit')
+OUTCOME_WRITE_BEHIND = app_config('outcome_write_behind')
+OUTCOME_FLUSH_INTERVAL_MS = app_config('outcome_flush_interval_ms')
+OUTCOME_FLUSH_BATCH_SIZE = app_config('outcome_flush_batch_size')
+OUTCOME_BUFFER_MAX = app_config('outcome_buffer_max')
+OUTCOME_STREAM = app_config('outcome_stream')
+OUTCOME_STREAM_MAXLEN = app_config('outcome_stream_maxlen')
+GET_PROXY_ENGINE = app_config('get_proxy_engine')
+RANKED_QUEUES = GET_PROXY_ENGINE == 'ranked'
+RANKED_TOP_BAND = app_config('ranked_top_band')
+RANKED_EXPLORE_PCT = app_config('ranked_explore_pct')
+RANKED_LATENCY_REF = app_config('ranked_latency_ref')
+RANKED_RECENCY_HALF_LIFE = app_config('ranked_recency_half_life')
+LATENCY_EWMA_ALPHA = app_config('latency_ewma_alpha')
+IN_FLIGHT_LEASE_TTL = app_config('in_flight_lease_ttl')
+
+# secondary indexes maintained alongside the queue/proxy/detail hashes so that
+# lookups never need to scan the keyspace
+QUEUE_DETAILS_PREFIX = 'queue_details_'
+QUEUE_DOMAIN_INDEX_KEY = 'queue_domain_index'
+PROXY_ADDRESS_INDEX_KEY = 'proxy_address_index'
+QUEUE_DETAIL_COUNT_KEY = 'queue_detail_counts'
+# requests currently in flight through a proxy, across every crawler process:
+# a sorted set per proxy key of lease ids scored by the time they expire.  a
+# lease whose callback never comes stops counting once it has expired.
+PROXY_IN_FLIGHT_PREFIX = 'proxy_in_flight_'
+# merged latency histogram of each queue's details, field = bucket (1 based)
+QUEUE_LATENCY_PREFIX = 'queue_latency_'
 
 import logging
 logger = logging.getLogger(__name__)
@@ -54,6 +104,83 @@ class DetailExistsException(Exception):
     pass
 
 
+# process wide registry of redis clients.  every manager, queue and decorator
+# in this module shares the same connection pool instead of building its own.
+_redis_clients = {}
+_redis_clients_lock = threading.Lock()
+
+# marks the thread currently loading the cache from the database
+_sync_state = threading.local()
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+
+def get_redis(**overrides):
+    params = dict(configuration.redis_config)
+    params.update(overrides)
+    registry_key = tuple(sorted(params.items()))
+    with _redis_clients_lock:
+        client = _redis_clients.get(registry_key)
+        if client is None:
+            client = Redis(**params)
+            _redis_clients[registry_key] = client
+    return client
+
+
+def connect_with_retry(connect):
+    # the database may still be starting up (e.g. first docker-compose up), so
+    # retry with an exponential backoff capped at db_connect_attempt_interval
+    attempts = 0
+    while True:
+        try:
+            return connect()
+        except psycopg2.OperationalError as e:
+            attempts += 1
+            if attempts >= MAX_DB_CONNECT_ATTEMPTS:
+                raise Exception("Failed to connect to the database: %s" % e)
+            delay = min(2 ** (attempts - 1), DB_CONNECT_ATTEMPT_INTERVAL)
+            logger.warning("database connection attempt %s failed, retrying in %s seconds" % (attempts, delay))
+            time.sleep(delay)
+
+
+class PostgresPool(object):
+    def __init__(self,connect_params,minconn=DB_POOL_MIN_CONNECTIONS,maxconn=DB_POOL_MAX_CONNECTIONS):
+        self.pool = connect_with_retry(lambda: ThreadedConnectionPool(minconn, maxconn, **connect_params))
+        # ThreadedConnectionPool raises instead of waiting once exhausted
+        self.available = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.available.acquire()
+        try:
+            conn = connect_with_retry(self.pool.getconn)
+            if conn.closed:
+                self.pool.putconn(conn, close=True)
+                conn = connect_with_retry(self.pool.getconn)
+            if not conn.autocommit:
+                conn.autocommit = True
+            return conn
+        except Exception:
+            self.available.release()
+            raise
+
+    def putconn(self,conn):
+        try:
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.available.release()
+
+
+def get_db_pool():
+    global _db_pool
+    with _db_pool_lock:
+        if _db_pool is None:
+            connect_params = dict(configuration.db_config)
+            connect_params.update({'cursor_factory':DictCursor})
+            _db_pool = PostgresPool(connect_params)
+    return _db_pool
+
+
 # decorator for RedisManager methods
 def block_if_syncing(func):
     @wraps(func)
@@ -67,24 +194,28 @@ def block_if_syncing(func):
 
 # To do - acquire queue sync lock
 
+# callers that lose the race for a queue's lock wait for it to be released
+QUEUE_LOCK_POLL_INTERVAL = 0.1
+
 def queue_lock(func):
     @wraps(func)
     def wrapper(self,*args,**kwargs):
-        redis = Redis(**configuration.redis_config)
+        redis = get_redis()
         queue = kwargs.get('queue',None)
         if queue is None:
             raise Exception("queue_lock function must have a queue kwrargs")
         lock_key = 'syncing_%s' % queue.domain
         lock = redis.lock(lock_key)
         if lock.acquire(blocking=True,blocking_timeout=0):
-
-            func(self,*args,**kwargs)
-            lock.release()
+            try:
+                func(self,*args,**kwargs)
+            finally:
+                lock.release()
         
         else:
             while redis.get(lock_key) is not None:
 
-                time.sleep(5)
+                time.sleep(QUEUE_LOCK_POLL_INTERVAL)
         return
         
 
@@ -93,41 +224,77 @@ def queue_lock(func):
 
     
 
+# seed queue proxy ids in one random_key window that have no detail in the
+# queue yet.  the anti-join uses the details (proxy_id, queue_id) unique index
+UNUSED_PROXY_IDS_QUERY = """
+    SELECT s.proxy_id FROM details s
+    WHERE s.queue_id = %(seed_queue_id)s
+    AND s.active = %(active)s
+    AND s.random_key >= %(key_from)s AND s.random_key < %(key_to)s
+    AND s.proxy_id <> ALL(%(excluded_pids)s::int[])
+    AND NOT EXISTS (SELECT 1 FROM details d WHERE d.proxy_id = s.proxy_id AND d.queue_id = %(queue_id)s)
+    ORDER BY s.random_key
+    LIMIT %(limit)s
+    """
+
 class PostgresManager(object):
     def __init__(self):
-        connect_params = configuration.db_config
-        connect_params.update({'cursor_factory':DictCursor})
-        self.connect_params = connect_params
-        self.connect_attempts = 0
+        self.pool = get_db_pool()
 
-    def new_connection(self):
-        if self.connect_attempts < MAX_DB_CONNECT_ATTEMPTS:
-            try:
-                conn = psycopg2.connect(**self.connect_params)
-                conn.set_session(autocommit=True)
-            except Exception as e:
-                self.connect_attempts +=1
-
-
-                time.sleep(DB_CONNECT_ATTEMPT_INTERVAL)
-                return self.new_connection()
+    @contextmanager
+    def connection(self):
+        conn = self.pool.getconn()
+        try:
+            yield conn
+        finally:
+            self.pool.putconn(conn)
 
-            return conn
-        else:
-            raise Exception("Failed to connect to the database.")
-    
+    @contextmanager
     def cursor(self):
-        return self.new_connection().cursor()
+        with self.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as conn:
+            conn.autocommit = False
+            cursor = conn.cursor()
+            try:
+                yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                if not conn.closed:
+                    conn.autocommit = True
+
+    def stream_rows(self,query,params=None,itersize=None):
+        # rows from a server side cursor, fetched itersize at a time rather
+        # than all at once
+        with self.connection() as conn:
+            conn.autocommit = False
+            cursor = conn.cursor(name='stream_rows')
+            cursor.itersize = itersize or STREAM_ITERSIZE
+            try:
+                cursor.execute(query,params)
+                for row in cursor:
+                    yield row
+            finally:
+                cursor.close()
+                conn.rollback()
+                conn.autocommit = True
 
     def do_query(self, query, params=None):
-        cursor = self.cursor()
-        cursor.execute(query,params)
-        try:
-            data = cursor.fetchall()
-            return data
-        except Exception:
-            pass
-        cursor.close()
+        with self.cursor() as cursor:
+            cursor.execute(query,params)
+            if cursor.description is not None:
+                return cursor.fetchall()
 
     def update_detail(self,obj,cursor=None):
         table_name = sql.Identifier('details')
@@ -174,32 +341,32 @@ class PostgresManager(object):
         self.insert_object(proxy,'proxies','proxy_id',cursor)
 
     def init_seed_details(self):
-        seed_count = self.do_query("SELECT COUNT(*) as c FROM details WHERE queue_id=%(queue_id)s", {'queue_id':SEED_QUEUE_ID})[0]['c']
-
-        cursor = self.cursor()
-        if seed_count == 0:
-            proxy_ids = [p['proxy_id'] for p in self.do_query("SELECT proxy_id FROM proxies")]
-            for proxy_id in proxy_ids:
-                insert_detail = "INSERT INTO details (proxy_id,queue_id) VALUES (%(proxy_id)s, %(queue_id)s);"
-                params = {'proxy_id': proxy_id, 'queue_id': SEED_QUEUE_ID}
-                cursor.execute(insert_detail,params)
+        # every query runs on the one cursor, checking a second connection out
+        # of the pool while holding this one can deadlock a busy pool
+        with self.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) as c FROM details WHERE queue_id=%(queue_id)s", {'queue_id':SEED_QUEUE_ID})
+            seed_count = cursor.fetchone()['c']
+            if seed_count == 0:
+                cursor.execute("SELECT proxy_id FROM proxies")
+                proxy_ids = [p['proxy_id'] for p in cursor.fetchall()]
+                for proxy_id in proxy_ids:
+                    insert_detail = "INSERT INTO details (proxy_id,queue_id) VALUES (%(proxy_id)s, %(queue_id)s);"
+                    params = {'proxy_id': proxy_id, 'queue_id': SEED_QUEUE_ID}
+                    cursor.execute(insert_detail,params)
 
-        
-        query = """
-        BEGIN;
-        LOCK TABLE details IN EXCLUSIVE MODE;
-        SELECT setval('details_detail_id_seq', COALESCE((SELECT MAX(detail_id)+1 FROM details),1), false);
-        COMMIT;
-        """
-        
-        cursor.execute(query)
-        cursor.close()
+            
+            # never move the sequence backwards, ids may already be reserved by IdAllocator
+            query = """
+            BEGIN;
+            LOCK TABLE details IN EXCLUSIVE MODE;
+            SELECT setval('details_detail_id_seq', GREATEST((SELECT MAX(detail_id) FROM details), (SELECT last_value FROM details_detail_id_seq)));
+            COMMIT;
+            """
+            
+            cursor.execute(query)
 
         
-    def get_seed_details(self):
-        self.init_seed_details()
-
-        params = {'seed_queue_id': SEED_QUEUE_ID}
+    def seed_detail_queries(self):
         query= """
             SELECT * FROM details 
             WHERE queue_id=%(queue_id)s
@@ -208,14 +375,14 @@ class PostgresManager(object):
             ORDER BY last_used ASC
             LIMIT %(limit)s;
             """
-        a_params = {"queue_id":SEED_QUEUE_ID, "active":True,"limit": INITIAL_SEED_COUNT}
-        ia_params = {"queue_id":SEED_QUEUE_ID, "active":False,"limit": INITIAL_SEED_COUNT}
-        a_params['last_used_cutoff'] = LAST_USED_CUTOFF
-        ia_params['last_used_cutoff'] = LAST_USED_CUTOFF
-        active =  [Detail(**d) for d in self.do_query(query,a_params)]
-        inactive = [Detail(**d) for d in self.do_query(query,ia_params)]
-        
-        return active + inactive
+        return [(query, {"queue_id":SEED_QUEUE_ID, "active":active, "limit": INITIAL_SEED_COUNT, "last_used_cutoff": LAST_USED_CUTOFF}) for active in (True, False)]
+
+    def get_seed_details(self):
+        self.init_seed_details()
+        details = []
+        for query, params in self.seed_detail_queries():
+            details.extend(Detail(**d) for d in self.do_query(query,params))
+        return details
 
     def get_non_seed_details(self,queue_id):
         if queue_id is None:
@@ -250,52 +417,30 @@ class PostgresManager(object):
 
         return active + inactive
 
-    def get_unused_proxy_ids(self,queue,count,excluded_pids):
-        
-        query = None
-        excluded_pids.append(-1)
-        excluded_pids.append(-2)
-
+    def get_unused_proxy_ids(self,queue,count,excluded_pids,cursor=None):
+        # samples seed queue proxies (active ones first) that have no detail
+        # in queue yet.  every detail has a random_key and the seed details
+        # are read in random_key order from a random starting point, wrapping
+        # around once, so the sample comes off the (queue_id, active,
+        # random_key) index instead of sorting the seed queue.
         params = {
             'seed_queue_id': SEED_QUEUE_ID,
-            'limit': count,
-            'active': True,
-            'excluded_pids': tuple(excluded_pids)
+            'queue_id': queue.id() if queue.id() is not None else -1,
+            'excluded_pids': [int(pid) for pid in excluded_pids],
         }
-        
-        if queue.id() is None:
-            query = """
-                SELECT proxy_id FROM details 
-                WHERE queue_id = %(seed_queue_id)s
-                AND active = %(active)s
-                AND proxy_id NOT IN %(excluded_pids)s
-                ORDER BY RANDOM()
-                LIMIT %(limit)s
-                """
-            
-        else:
-            params['queue_id'] = queue.id()
-            query = """
-                SELECT proxy_id FROM details 
-                WHERE queue_id = %(seed_queue_id)s 
-                AND proxy_id NOT IN ( SELECT proxy_id FROM details WHERE queue_id = %(queue_id)s )
-                AND proxy_id NOT IN %(excluded_pids)s
-                AND active = %(active)s
-                ORDER BY RANDOM()
-                LIMIT %(limit)s
-                """
-
-        
-
-        pids = [pid[0] for pid in self.do_query(query,params)]
-        
-        if len(pids) < count:
-            params['count'] = count - len(pids)
-            params['active'] = False
-            result = self.do_query(query,params)
-            for ipid in result:
-                pids.append(ipid[0])
-
+        start = random.random()
+        pids = []
+        for active in (True, False):
+            for window in ((start, 1.0), (0.0, start)):
+                if len(pids) >= count:
+                    return pids
+                params.update({'active': active, 'key_from': window[0], 'key_to': window[1], 'limit': count - len(pids)})
+                if cursor is not None:
+                    cursor.execute(UNUSED_PROXY_IDS_QUERY,params)
+                    rows = cursor.fetchall()
+                else:
+                    rows = self.do_query(UNUSED_PROXY_IDS_QUERY,params)
+                pids.extend(row[0] for row in rows)
         return pids
 
     def init_seed_queues(self):
@@ -320,19 +465,22 @@ class PostgresManager(object):
         elif(db_agg[0]['queue_id'] != AGGREGATE_QUEUE_ID):
             raise Exception("aggregate queue_id mismatch.  aggregate_queue should be set to %s  Check app_config.json" % db_agg[0]['queue_id'])
 
-        cursor = self.cursor()
         query = """
         BEGIN;
         LOCK TABLE queues IN EXCLUSIVE MODE;
-        SELECT setval('queues_queue_id_seq', COALESCE((SELECT MAX(queue_id)+1 FROM queues),1), false);
+        SELECT setval('queues_queue_id_seq', GREATEST((SELECT MAX(queue_id) FROM queues), (SELECT last_value FROM queues_queue_id_seq)));
         COMMIT;
         """
-        cursor.execute(query)
-        cursor.close()
+        with self.cursor() as cursor:
+            cursor.execute(query)
 
         
 
 
+    def reserve_ids(self,sequence,count):
+        query = "SELECT nextval(%(sequence)s) FROM generate_series(1, %(count)s)"
+        return [row[0] for row in self.do_query(query, {'sequence': sequence, 'count': count})]
+
     def get_queues(self):
         self.init_seed_queues()
         return [Queue(**r) for r in self.do_query("SELECT * FROM queues;")]
@@ -344,28 +492,22 @@ class PostgresManager(object):
     def get_detail_by_queue_and_proxy(self,queue_id,proxy_id):
         query = "SELECT * FROM details WHERE proxy_id=%(proxy_id)s AND queue_id=%(queue_id)s"
         params = {'queue_id': queue_id, 'proxy_id':proxy_id}
-        cursor = self.cursor()
-        cursor.execute(query,params)
-        detail_data = cursor.fetchone()
+        with self.cursor() as cursor:
+            cursor.execute(query,params)
+            detail_data = cursor.fetchone()
         if detail_data is None:
-            cursor.close()
             return None
-        detail = Detail(**detail_data)
-        cursor.close()
-        return detail
+        return Detail(**detail_data)
 
     def get_proxy_by_address_and_port(self,address,port):
         query = "SELECT * FROM proxies where address=%(address)s AND port=%(port)s"
         params = {'address': address, 'port':port}
-        cursor = self.cursor()
-        cursor.execute(query,params)
-        proxy_data = cursor.fetchone()
+        with self.cursor() as cursor:
+            cursor.execute(query,params)
+            proxy_data = cursor.fetchone()
         if proxy_data is None:
-            cursor.close()
             return None
-        proxy = Proxy(**proxy_data)
-        cursor.close()
-        return proxy
+        return Proxy(**proxy_data)
 
     
 
@@ -373,7 +515,8 @@ class PostgresManager(object):
 
 class Redis(redis.Redis):
     def __init__(self,*args,**kwargs):
-        pool = redis.BlockingConnectionPool(decode_responses=True, *args, **kwargs)
+        kwargs.setdefault('decode_responses', True)
+        pool = redis.BlockingConnectionPool(*args, **kwargs)
         super().__init__(connection_pool=pool)
 
 class RedisDetailQueueEmpty(Exception):
@@ -382,45 +525,60 @@ class RedisDetailQueueInvalid(Exception):
     pass
 
 class RedisDetailQueue(object):
-    def __init__(self,queue,active=True):
-        self.redis_mgr = RedisManager()
+    def __init__(self,queue,active=True,redis_mgr=None):
+        if redis_mgr is None:
+            redis_mgr = RedisManager()
+        self.redis_mgr = redis_mgr
 
         self.redis = self.redis_mgr.redis
         self.queue = queue
         self.active = active
-        active_clause = "active"
+        self.redis_key = self.queue_redis_key(self.queue.queue_key, active)
+        self.cooldown_key = self.cooldown_redis_key(self.queue.queue_key, active)
+
+    @staticmethod
+    def queue_clause(active):
+        # ranked queues keep active and inactive details in one sorted set
+        # scored by reliability, so the active flag does not pick a queue
+        if RANKED_QUEUES:
+            return "ranked"
         if not active:
-            active_clause = "inactive"
-        self.redis_key = 'redis_%s_detail_queue_%s' % (active_clause, self.queue.queue_key)
+            return "inactive"
+        return "active"
+
+    @staticmethod
+    def queue_redis_key(queue_key,active):
+        return 'redis_%s_detail_queue_%s' % (RedisDetailQueue.queue_clause(active), queue_key)
 
+    @staticmethod
+    def cooldown_redis_key(queue_key,active):
+        # sorted set of details used less than PROXY_INTERVAL seconds ago,
+        # scored by the epoch time they become eligible again
+        return 'redis_%s_detail_cooldown_%s' % (RedisDetailQueue.queue_clause(active), queue_key)
+
+    @staticmethod
+    def eligible_time(detail):
+        return detail.last_used_epoch + PROXY_INTERVAL
 
 
     def reload(self):
         details = self.redis_mgr.get_all_queue_details(self.queue.queue_key)
         self.clear()
         for detail in details:
-            if detail.active == self.active:
+            if RANKED_QUEUES or detail.active == self.active:
                 self.enqueue(detail)
 
 
     def _update_blacklist_status(self,detail):
         if detail.blacklisted:
-            last_used = detail.last_used
-            now = datetime.utcnow()
-            delta_t = now - last_used
-            if delta_t.seconds > BLACKLIST_TIME and detail.blacklisted_count < MAX_BLACKLIST_COUNT:
-                self.loger.info("unblacklisting detail")
+            if time.time() - detail.last_used_epoch > BLACKLIST_TIME and detail.blacklisted_count < MAX_BLACKLIST_COUNT:
+                logger.info("unblacklisting detail")
                 detail.blacklisted = False
                 self.redis_mgr.update_detail(detail)
         
     
     def is_empty(self):
-        if not self.redis.exists(self.redis_key):
-            return True
-        elif self.redis.llen(self.redis_key) == 0:
-            return True
-        else:
-            return False
+        return self.length() == 0
 
     def enqueue(self,detail):
         self._update_blacklist_status(detail)
@@ -440,50 +598,119 @@ class RedisDetailQueue(object):
         if detail_queue_key != self.queue.queue_key:
             raise RedisDetailQueueInvalid("No such queue key for detail")
         
-        if detail.active != self.active:
+        if detail.active != self.active and not RANKED_QUEUES:
             destination_queue = 'active'
             current_queue = "inactive"
             if self.active:
                 destination_queue = 'inactive'
                 current_queue = "active"
 
-            correct_queue = RedisDetailQueue(self.queue, active=detail.active)
+            correct_queue = RedisDetailQueue(self.queue, active=detail.active, redis_mgr=self.redis_mgr)
             return correct_queue.enqueue(detail)
             
-        
-        self.redis.rpush(self.redis_key,detail_key)
-
+        eligible_time = self.eligible_time(detail)
+        if eligible_time > time.time() or RANKED_QUEUES:
+            # ranked details are scored when they are promoted from the cooldown set
+            self.redis.zadd(self.cooldown_key,{detail_key: eligible_time})
+        else:
+            self.redis.rpush(self.redis_key,detail_key)
 
+    def promote(self):
+        return self.redis_mgr.scripts.promote_cooldown(keys=[self.redis_key, self.cooldown_key], args=[time.time(), COOLDOWN_PROMOTE_LIMIT])
 
     def dequeue(self):
-        if self.is_empty():
-            raise RedisDetailQueueEmpty("No proxies available for queue key %s" % self.queue.queue_key)
-
-        detail = Detail(**self.redis.hgetall(self.redis.lpop(self.redis_key)))
-        return detail
+        if RANKED_QUEUES:
+            draw = self.redis_mgr.draw_ranked_detail(self.queue)
+            if draw.detail is None:
+                raise RedisDetailQueueEmpty("No proxies available for queue key %s" % self.queue.queue_key)
+            return draw.detail
+
+        # only details whose cooldown has passed are ever in the list; anything
+        # that was pushed while still cooling down goes back to the cooldown set
+        self.promote()
+        now = time.time()
+        while True:
+            detail_key = self.redis.lpop(self.redis_key)
+            if detail_key is None:
+                raise RedisDetailQueueEmpty("No proxies available for queue key %s" % self.queue.queue_key)
+            detail_data = self.redis.hgetall(detail_key)
+            if not detail_data:
+                continue
+            detail = Detail.from_redis(detail_data, detail_key)
+            eligible_time = self.eligible_time(detail)
+            if eligible_time <= now:
+                return detail
+            self.redis.zadd(self.cooldown_key,{detail_key: eligible_time})
 
     def length(self):
-        return self.redis.llen(self.redis_key)
+        if RANKED_QUEUES:
+            return self.redis.zcard(self.redis_key) + self.redis.zcard(self.cooldown_key)
+        return self.redis.llen(self.redis_key) + self.redis.zcard(self.cooldown_key)
 
     def clear(self):
-        self.redis.delete(self.redis_key)
+        self.redis.delete(self.redis_key, self.cooldown_key)
     
 
+class DetailDraw(object):
+    def __init__(self,result):
+        found, active_length, inactive_length, queue_count, drawn_active, detail_data, proxy_data = result
+        self.active_length = int(active_length)
+        self.inactive_length = int(inactive_length)
+        self.queue_count = int(queue_count)
+        self.active = bool(int(drawn_active))
+        self.detail = None
+        self.proxy = None
+        if int(found):
+            self.detail = Detail.from_redis(self.pairs_to_dict(detail_data))
+            self.proxy = Proxy.from_redis(self.pairs_to_dict(proxy_data), self.detail.proxy_key)
+
+    @classmethod
+    def batch(cls,result):
+        # a batch result carries one drawn_active, detail, proxy triple per
+        # detail drawn after the shared queue lengths
+        found = int(result[0])
+        if found == 0:
+            return [cls(result)]
+        return [cls([1] + list(result[1:4]) + list(result[4 + 3*i:7 + 3*i])) for i in range(found)]
+
+    @classmethod
+    def empty(cls,active_length,inactive_length,queue_count):
+        return cls((0, active_length, inactive_length, queue_count, 0, [], []))
+
+    @staticmethod
+    def outcome_detail(detail_data):
+        # record_outcome replies with the updated hash, or nothing if the
+        # detail is no longer cached
+        if not detail_data:
+            return None
+        return Detail.from_redis(DetailDraw.pairs_to_dict(detail_data))
+
+    @staticmethod
+    def pairs_to_dict(flat):
+        return dict(zip(flat[::2], flat[1::2]))
+
+
 class RedisManager(object):
     def __init__(self):
-        self.redis = Redis(**configuration.redis_config)
+        self.redis = get_redis()
+        self.scripts = RedisScripts(self.redis)
         self.dbh = PostgresManager()
+        self.id_allocator = IdAllocator(self.redis, self.dbh, ID_BLOCK_SIZE)
 
-        if len(self.redis.keys()) == 0:
+        if self.redis.dbsize() == 0:
             lock = self.redis.lock('syncing')
             if lock.acquire(blocking=True, blocking_timeout=0):
-                self.redis.client_setname('syncer')
-                self.sync_from_db()
-                self.redis.client_setname('')
-                lock.release()
+                # connections are pooled, so the syncer is tracked per thread
+                # rather than with CLIENT SETNAME on a single connection
+                _sync_state.is_syncer = True
+                try:
+                    self.sync_from_db()
+                finally:
+                    _sync_state.is_syncer = False
+                    lock.release()
 
     def is_sync_client(self):
-        return self.redis.client_getname() == 'syncer'
+        return getattr(_sync_state, 'is_syncer', False)
 
     def is_syncing(self):
         return self.redis.get('syncing') is not None
@@ -492,77 +719,37 @@ class RedisManager(object):
 
     @block_if_syncing
     def sync_from_db(self):
-
-        self.redis.set("%s_%s" % (TEMP_ID_COUNTER, 'q'),0)
-        self.redis.set("%s_%s" % (TEMP_ID_COUNTER, 'p'),0)
-        self.redis.set("%s_%s" % (TEMP_ID_COUNTER, 'd'),0)
-
-        queues = self.dbh.get_queues()
-
-
-
-
-        for q in queues:
-            self.register_queue(q)
-
-
-        proxies = self.dbh.get_proxies()
-
-
-        for p in proxies:
-            self.register_proxy(p)
-
-        
-
-        seed_details = self.dbh.get_seed_details()
-
-
-
-
-        seed_queue = self.get_queue_by_id(SEED_QUEUE_ID)
-        seed_rdq = RedisDetailQueue(seed_queue)
-
-        for seed_detail in seed_details:
-            registered_detail = self.register_detail(seed_detail,bypass_db_check=True)
-
-
-
-
-        #other_details = []
-        """
-        for q in queues:
-
-            if q.queue_id != SEED_QUEUE_ID and q.queue_id != AGGREGATE_QUEUE_ID:
-                details = self.dbh.get_non_seed_details(queue_id=q.queue_id)
-                other_details.extend(details)
-        
-        
-
-
-        for d in other_details:
-            self.register_detail(d)
-
-        """
+        # queues, proxies and seed details are streamed from postgres and
+        # written in pipelines, see BulkLoader
+        BulkLoader(self).load()
 
     
     @block_if_syncing
-    def register_object(self,key,obj):
-        redis_key = key
+    def register_object(self,key,obj,id_attr):
         if obj.id() is None:
-            temp_counter_key = "%s_%s" % (TEMP_ID_COUNTER, key)
-            redis_key += 't_%s' % self.redis.incr(temp_counter_key)
-        else:
-            redis_key += '_%s' % obj.id()
+            # new objects get their permanent id up front, so their key never changes
+            setattr(obj, id_attr, self.id_allocator.allocate(key))
+        redis_key = '%s_%s' % (key, obj.id())
         
         self.redis.hmset(redis_key,obj.to_dict(redis_format=True))
         return redis_key
 
     @block_if_syncing
     def register_queue(self,queue):
-        queue_key = self.register_object('q',queue)
+        is_new = queue.id() is None
+        queue_key = self.register_object('q',queue,'queue_id')
         self.redis.hmset(queue_key, {'queue_key': queue_key})
-
-        return Queue(**self.redis.hgetall(queue_key))
+        if not self.redis.hsetnx(QUEUE_DOMAIN_INDEX_KEY,queue.domain,queue_key):
+            # another client registered this domain first, discard ours
+            existing_key = self.redis.hget(QUEUE_DOMAIN_INDEX_KEY,queue.domain)
+            if existing_key != queue_key:
+                self.redis.delete(queue_key)
+                queue_key = existing_key
+                is_new = False
+        if is_new:
+            self.redis.sadd(NEW_QUEUES_SET_KEY,queue_key)
+
+        return Queue.from_redis(self.redis.hgetall(queue_key), queue_key)
     
     @queue_lock
     def initialize_queue(self,queue):
@@ -578,9 +765,13 @@ class RedisManager(object):
 
     @block_if_syncing
     def register_proxy(self,proxy):
-        proxy_key = self.register_object('p',proxy)
+        is_new = proxy.id() is None
+        proxy_key = self.register_object('p',proxy,'proxy_id')
         self.redis.hmset(proxy_key, {'proxy_key': proxy_key})
-        return Proxy(**self.redis.hgetall(proxy_key))
+        self.redis.hset(PROXY_ADDRESS_INDEX_KEY, self.proxy_address_field(proxy.address,proxy.port), proxy_key)
+        if is_new:
+            self.redis.sadd(NEW_PROXIES_SET_KEY,proxy_key)
+        return Proxy.from_redis(self.redis.hgetall(proxy_key), proxy_key)
     
     @block_if_syncing
     def register_detail(self,detail,bypass_db_check=False):
@@ -607,28 +798,32 @@ class RedisManager(object):
             raise DetailExistsException("Detail is already registered.")
             # return Detail(**self.redis.hgetall(detail_key))
         else:
+            is_new = detail.detail_id is None
+            if is_new:
+                detail.detail_id = self.id_allocator.allocate('d')
             redis_data = detail.to_dict(redis_format=True)
             self.redis.hmset(detail_key,redis_data)
-            if not bypass_db_check:
+            self.index_detail(detail_key,detail.queue_key,detail.latency_hist)
+            if is_new:
                 self.redis.sadd(NEW_DETAILS_SET_KEY,detail_key)
         
-        rdq = RedisDetailQueue(self.get_queue_by_key(detail.queue_key),active=detail.active)
+        rdq = RedisDetailQueue(self.get_queue_by_key(detail.queue_key),active=detail.active,redis_mgr=self)
         detail = self.get_detail(detail_key)
         rdq.enqueue(detail)
         return detail
 
     @block_if_syncing
     def get_detail(self,redis_detail_key):
-        return Detail(**self.redis.hgetall(redis_detail_key))
+        return Detail.from_redis(self.redis.hgetall(redis_detail_key), redis_detail_key)
 
     @block_if_syncing
     def get_all_queues(self):
-        return [Queue(**self.redis.hgetall(q)) for q in self.redis.keys('q*')]
+        return self.hgetall_many(self.redis.hvals(QUEUE_DOMAIN_INDEX_KEY), Queue)
 
     def get_queue_by_domain(self,domain):
-        queue_dict = {q.domain: q for q in self.get_all_queues()}
-        if domain in queue_dict:
-            return queue_dict[domain]
+        queue_key = self.redis.hget(QUEUE_DOMAIN_INDEX_KEY,domain)
+        if queue_key is not None:
+            return self.get_queue_by_key(queue_key)
         
         return self.register_queue(Queue(domain=domain))
 
@@ -637,46 +832,320 @@ class RedisManager(object):
         lookup_key = "%s_%s" % ('q',qid)
         if not self.redis.exists(lookup_key):
             raise Exception("No such queue with id %s" % qid)
-        return Queue(**self.redis.hgetall(lookup_key))
+        return Queue.from_redis(self.redis.hgetall(lookup_key), lookup_key)
 
     def get_queue_by_key(self,queue_key):
-        return Queue(**self.redis.hgetall(queue_key))
+        return Queue.from_redis(self.redis.hgetall(queue_key), queue_key)
 
     def get_proxy(self,proxy_key):
-        return Proxy(**self.redis.hgetall(proxy_key))
+        return Proxy.from_redis(self.redis.hgetall(proxy_key), proxy_key)
 
     def update_detail(self,detail):
         self.redis.hmset(detail.detail_key,detail.to_dict(redis_format=True))
         self.redis.sadd(CHANGED_DETAILS_SET_KEY,detail.detail_key)
 
-    def get_proxy_by_address_and_port(self,address,port):
-        proxy_keys = self.redis.keys('p*')
-        all_proxy_data = [self.redis.hgetall(pkey) for pkey in proxy_keys]
-        for pd in all_proxy_data:
-            if str(pd['address']) == str(address):
-                if str(pd['port']) == str(port):
-                    return Proxy(**pd)
+    def unblacklist_detail(self,detail_key):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hset(detail_key, 'blacklisted', '0')
+        pipe.sadd(CHANGED_DETAILS_SET_KEY, detail_key)
+        pipe.execute()
+
+    # keys and args for the draw and outcome scripts are built by these
+    # staticmethods so AsyncRedisManager runs exactly the same calls
+    @staticmethod
+    def draw_details_call(queue,target_active_count,count):
+        keys = [
+            RedisDetailQueue.queue_redis_key(queue.queue_key, True),
+            RedisDetailQueue.queue_redis_key(queue.queue_key, False),
+            RedisDetailQueue.cooldown_redis_key(queue.queue_key, True),
+            RedisDetailQueue.cooldown_redis_key(queue.queue_key, False),
+            QUEUE_DETAIL_COUNT_KEY,
+            CHANGED_DETAILS_SET_KEY
+        ]
+        args = [queue.queue_key, time.time(), PROXY_INTERVAL, BLACKLIST_TIME, MAX_BLACKLIST_COUNT, MIN_QUEUE_SIZE, target_active_count, random.random(), DRAW_MAX_ATTEMPTS, COOLDOWN_PROMOTE_LIMIT, count]
+        return keys, args
+
+    @staticmethod
+    def draw_ranked_detail_call(queue,count=1):
+        keys = [
+            RedisDetailQueue.queue_redis_key(queue.queue_key, True),
+            RedisDetailQueue.cooldown_redis_key(queue.queue_key, True),
+            QUEUE_DETAIL_COUNT_KEY,
+            CHANGED_DETAILS_SET_KEY
+        ]
+        args = [
+            queue.queue_key, time.time(), PROXY_INTERVAL, BLACKLIST_TIME, MAX_BLACKLIST_COUNT,
+            RANKED_TOP_BAND, RANKED_EXPLORE_PCT, random.random(), random.random(), DRAW_MAX_ATTEMPTS,
+            COOLDOWN_PROMOTE_LIMIT, RANKED_LATENCY_REF, RANKED_RECENCY_HALF_LIFE, count
+        ]
+        return keys, args
+
+    @staticmethod
+    def in_flight_key(proxy_key):
+        return "%s%s" % (PROXY_IN_FLIGHT_PREFIX, proxy_key)
+
+    @staticmethod
+    def new_lease():
+        # a lease id and the epoch time it expires
+        return uuid.uuid4().hex, time.time() + IN_FLIGHT_LEASE_TTL
+
+    @staticmethod
+    def record_outcome_call(detail,success,load_time,requeue,lease=None,now=None):
+        # lease is the in flight lease taken when the proxy was dispatched,
+        # released with the outcome
+        keys = [detail.detail_key, CHANGED_DETAILS_SET_KEY, RedisManager.in_flight_key(detail.proxy_key)]
+        success_arg = ''
+        if success is not None:
+            success_arg = '1' if success else '0'
+        args = [
+            success_arg, format_redis_timestamp(now or datetime.utcnow()), load_time, BLACKLIST_THRESHOLD, int(DECREMENT_BLACKLIST), int(requeue),
+            RedisDetailQueue.cooldown_redis_key('', True), RedisDetailQueue.cooldown_redis_key('', False), PROXY_INTERVAL,
+            lease or '',
+            bucket_index(load_time) + 1, LATENCY_EWMA_ALPHA, LATENCY_BUCKET_COUNT, QUEUE_LATENCY_PREFIX
+        ]
+        return keys, args
+
+    def draw_detail(self,queue,target_active_count):
+        return self.draw_details(queue,target_active_count,1)[0]
 
+    @block_if_syncing
+    def draw_details(self,queue,target_active_count,count):
+        keys, args = self.draw_details_call(queue,target_active_count,count)
+        return DetailDraw.batch(self.scripts.draw_detail(keys=keys, args=args))
+
+    def draw_ranked_detail(self,queue):
+        return self.draw_ranked_details(queue,1)[0]
+
+    @block_if_syncing
+    def draw_ranked_details(self,queue,count):
+        keys, args = self.draw_ranked_detail_call(queue,count)
+        return DetailDraw.batch(self.scripts.draw_ranked_detail(keys=keys, args=args))
+
+    def lease_in_flight(self,proxy_key):
+        # returns the lease id, record_outcome releases it
+        lease, expires = self.new_lease()
+        in_flight_key = self.in_flight_key(proxy_key)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(in_flight_key, {lease: expires})
+        pipe.expire(in_flight_key, IN_FLIGHT_LEASE_TTL)
+        pipe.execute()
+        return lease
+
+    def get_in_flight(self,proxy_keys):
+        # live leases per proxy key, expired ones are pruned on the way
+        if not proxy_keys:
+            return []
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for proxy_key in proxy_keys:
+            pipe.zremrangebyscore(self.in_flight_key(proxy_key), '-inf', now)
+            pipe.zcard(self.in_flight_key(proxy_key))
+        return pipe.execute()[1::2]
+
+    def record_outcome(self,detail,success,load_time,requeue=True,lease=None):
+        # counters are incremented server side so concurrent callbacks on the
+        # same detail cannot overwrite each other.  load_time is in ms
+        keys, args = self.record_outcome_call(detail,success,load_time,requeue,lease)
+        return DetailDraw.outcome_detail(self.scripts.record_outcome(keys=keys, args=args))
 
-        return None
+    def get_proxy_by_address_and_port(self,address,port):
+        proxy_key = self.redis.hget(PROXY_ADDRESS_INDEX_KEY, self.proxy_address_field(address,port))
+        if proxy_key is None:
+            return None
+        return self.get_proxy(proxy_key)
 
     def get_all_queue_details(self, queue_key):
-        key_match = 'd_%s*' % queue_key
-        keys = self.redis.keys(key_match)
-        details = [Detail(**self.redis.hgetall(key)) for key in keys]
-        return details
+        detail_keys = self.redis.smembers(self.queue_details_key(queue_key))
+        return self.hgetall_many(detail_keys, Detail)
 
     def get_queue_count(self,queue):
-        key_match = 'd_%s*' % queue.queue_key
-        return len(self.redis.keys(key_match))
-        
-            
+        count = self.redis.hget(QUEUE_DETAIL_COUNT_KEY, queue.queue_key)
+        if count is None:
+            return 0
+        return int(count)
+
+    def get_all_detail_keys(self):
+        queue_keys = self.redis.hvals(QUEUE_DOMAIN_INDEX_KEY)
+        pipe = self.redis.pipeline(transaction=False)
+        for queue_key in queue_keys:
+            pipe.smembers(self.queue_details_key(queue_key))
+        detail_keys = set()
+        for members in pipe.execute():
+            detail_keys.update(members)
+        return detail_keys
+
+    def hgetall_many(self,keys,obj_class):
+        keys = list(keys)
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return [obj_class.from_redis(data, key) for key, data in zip(keys, pipe.execute()) if data]
+
+    @staticmethod
+    def queue_details_key(queue_key):
+        return "%s%s" % (QUEUE_DETAILS_PREFIX, queue_key)
+
+    @staticmethod
+    def proxy_address_field(address,port):
+        return "%s:%s" % (address,port)
+
+    def index_detail(self,detail_key,queue_key,latency_hist=()):
+        if self.redis.sadd(self.queue_details_key(queue_key), detail_key):
+            self.redis.hincrby(QUEUE_DETAIL_COUNT_KEY, queue_key, 1)
+            # a queue's latency histogram is the sum of its details'
+            for bucket, count in enumerate(latency_hist, 1):
+                if count:
+                    self.redis.hincrby(QUEUE_LATENCY_PREFIX + queue_key, bucket, count)
+
+    def get_queue_latency(self,queue_key):
+        counts = self.redis.hgetall(QUEUE_LATENCY_PREFIX + queue_key)
+        return [int(counts.get(str(bucket), 0)) for bucket in range(1, LATENCY_BUCKET_COUNT + 1)]
+
+    def snapshot_dirty_sets(self):
+        snapshot_keys = ["%s%s" % (k, SNAPSHOT_SUFFIX) for k in DIRTY_SET_KEYS]
+        return self.scripts.snapshot_dirty_sets(keys=list(DIRTY_SET_KEYS) + snapshot_keys)
+
+    def scan_pages(self,match,fields,count=1000):
+        # yields (keys, values) per SCAN page, values being the hmget of
+        # fields for each key, read in one pipelined round trip per page
+        cursor = 0
+        while True:
+            cursor, keys = self.redis.scan(cursor, match=match, count=count)
+            if keys:
+                pipe = self.redis.pipeline(transaction=False)
+                for key in keys:
+                    pipe.hmget(key, *fields)
+                yield keys, pipe.execute()
+            if cursor == 0:
+                return
+
+    def build_indexes(self):
+        # one-off migration for caches populated before the indexes existed.
+        # uses SCAN rather than KEYS so the server is never blocked for long.
+        logger.info("building redis indexes...")
+        pipe = self.redis.pipeline(transaction=False)
+        for queue_keys, values in self.scan_pages('q_*', ('domain',)):
+            for queue_key, (domain,) in zip(queue_keys, values):
+                if domain is not None:
+                    pipe.hset(QUEUE_DOMAIN_INDEX_KEY,domain,queue_key)
+            pipe.execute()
+
+        for proxy_keys, values in self.scan_pages('p_*', ('address', 'port')):
+            for proxy_key, (address, port) in zip(proxy_keys, values):
+                if address is not None:
+                    pipe.hset(PROXY_ADDRESS_INDEX_KEY, self.proxy_address_field(address,port), proxy_key)
+            pipe.execute()
+
+        queue_details = {}
+        for detail_keys, values in self.scan_pages('d_*', ('queue_key',)):
+            for detail_key, (queue_key,) in zip(detail_keys, values):
+                if queue_key is not None:
+                    queue_details.setdefault(queue_key,[]).append(detail_key)
+
+        pipe.delete(QUEUE_DETAIL_COUNT_KEY)
+        for queue_key, detail_keys in queue_details.items():
+            pipe.delete(self.queue_details_key(queue_key))
+            pipe.sadd(self.queue_details_key(queue_key), *detail_keys)
+            pipe.hset(QUEUE_DETAIL_COUNT_KEY, queue_key, len(detail_keys))
+        pipe.execute()
+        logger.info("indexed %s queues, %s proxies, %s details" % (self.redis.hlen(QUEUE_DOMAIN_INDEX_KEY), self.redis.hlen(PROXY_ADDRESS_INDEX_KEY), sum(len(v) for v in queue_details.values())))
+
+
+class BulkLoader(object):
+    # warms a cold cache.  rows are streamed from postgres and written in
+    # pipelines of batch_size objects: the hashes, the indexes and the queue
+    # pushes register_queue/register_proxy/register_detail would do, without
+    # reading anything back.  only for an empty cache, it does not dedupe
+    # against objects already registered.
+    def __init__(self,redis_mgr,batch_size=BULK_LOAD_BATCH_SIZE):
+        self.redis_mgr = redis_mgr
+        self.redis = redis_mgr.redis
+        self.db_mgr = redis_mgr.dbh
+        self.batch_size = batch_size
+        self.socks_proxy_keys = set()
+
+    def write(self,name,objects,add):
+        start = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        count = 0
+        for obj in objects:
+            add(pipe,obj)
+            count += 1
+            if count % self.batch_size == 0:
+                pipe.execute()
+        pipe.execute()
+        elapsed = time.time() - start
+        rate = count / elapsed if elapsed > 0 else count
+        logger.info("loaded %s %s in %.2f seconds (%.0f/sec)" % (count, name, elapsed, rate))
+        return count
+
+    def add_queue(self,pipe,queue):
+        redis_data = queue.to_dict(redis_format=True)
+        redis_data['queue_key'] = queue.queue_key
+        pipe.hset(queue.queue_key, mapping=redis_data)
+        pipe.hset(QUEUE_DOMAIN_INDEX_KEY, queue.domain, queue.queue_key)
+
+    def add_proxy(self,pipe,proxy):
+        redis_data = proxy.to_dict(redis_format=True)
+        redis_data['proxy_key'] = proxy.proxy_key
+        pipe.hset(proxy.proxy_key, mapping=redis_data)
+        pipe.hset(PROXY_ADDRESS_INDEX_KEY, RedisManager.proxy_address_field(proxy.address,proxy.port), proxy.proxy_key)
+        if 'socks' in proxy.protocol:
+            self.socks_proxy_keys.add(proxy.proxy_key)
+
+    def add_detail(self,pipe,detail):
+        detail_key = detail.detail_key
+        queue_key = detail.queue_key
+        if detail.blacklisted and time.time() - detail.last_used_epoch > BLACKLIST_TIME and detail.blacklisted_count < MAX_BLACKLIST_COUNT:
+            detail.blacklisted = False
+            pipe.sadd(CHANGED_DETAILS_SET_KEY, detail_key)
+
+        pipe.hset(detail_key, mapping=detail.to_dict(redis_format=True))
+        pipe.sadd(RedisManager.queue_details_key(queue_key), detail_key)
+        pipe.hincrby(QUEUE_DETAIL_COUNT_KEY, queue_key, 1)
+        for bucket, count in enumerate(detail.latency_hist, 1):
+            if count:
+                pipe.hincrby(QUEUE_LATENCY_PREFIX + queue_key, bucket, count)
+
+        # as RedisDetailQueue.enqueue
+        if detail.blacklisted or detail.proxy_key in self.socks_proxy_keys:
+            return
+        eligible_time = RedisDetailQueue.eligible_time(detail)
+        if eligible_time > time.time() or RANKED_QUEUES:
+            pipe.zadd(RedisDetailQueue.cooldown_redis_key(queue_key, detail.active), {detail_key: eligible_time})
+        else:
+            pipe.rpush(RedisDetailQueue.queue_redis_key(queue_key, detail.active), detail_key)
+
+    def load(self):
+        start = time.time()
+        self.db_mgr.init_seed_queues()
+        self.db_mgr.init_seed_details()
+        count = self.write('queues', (Queue(**r) for r in self.db_mgr.stream_rows("SELECT * FROM queues")), self.add_queue)
+        count += self.write('proxies', (Proxy(**r) for r in self.db_mgr.stream_rows("SELECT * FROM proxies")), self.add_proxy)
+        for query, params in self.db_mgr.seed_detail_queries():
+            count += self.write('seed details', (Detail(**r) for r in self.db_mgr.stream_rows(query,params)), self.add_detail)
+
+        elapsed = time.time() - start
+        rate = count / elapsed if elapsed > 0 else count
+        logger.info("warmed the cache with %s objects in %.2f seconds (%.0f/sec)" % (count, elapsed, rate))
+        return count
 
 
 class StorageManager(object):
     def __init__(self):
         self.redis_mgr = RedisManager()
         self.db_mgr = PostgresManager()
+        self.outcome_stream = None
+        if OUTCOME_STREAM:
+            self.outcome_stream = OutcomeStream(self.redis_mgr.redis, OUTCOME_STREAM_MAXLEN)
+        self.outcome_buffer = None
+        if OUTCOME_WRITE_BEHIND:
+            self.outcome_buffer = get_outcome_buffer(self.redis_mgr, OUTCOME_FLUSH_INTERVAL_MS, OUTCOME_FLUSH_BATCH_SIZE, OUTCOME_BUFFER_MAX, self.outcome_stream)
+
+    def close(self):
+        # writes any buffered outcomes, call when the crawl is finished
+        if self.outcome_buffer is not None:
+            self.outcome_buffer.close()
 
     def is_syncing(self):
         return self.redis_mgr.is_syncing()
@@ -687,10 +1156,9 @@ class StorageManager(object):
             
             new_proxy = self.redis_mgr.register_proxy(Proxy(address,port,protocol))
 
-            new_detail = Detail(proxy_key=new_proxy.proxy_key, queue_id=SEED_QUEUE_ID)
+            new_detail = Detail(proxy_id=new_proxy.proxy_id, queue_id=SEED_QUEUE_ID)
             try:
-                self.redis_mgr.register_detail(new_detail)
-                self.redis_mgr.redis.sadd(NEW_DETAILS_SET_KEY,new_detail.detail_key)
+                self.redis_mgr.register_detail(new_detail,bypass_db_check=True)
             except DetailExistsException:
                 pass
             
@@ -721,70 +1189,63 @@ class StorageManager(object):
             self.redis_mgr.register_detail(new_detail,bypass_db_check=True)
 
     
-    def sync_to_db(self):
-        logging.info("STARTING SYNC")
-        new_queues = [Queue(**self.redis_mgr.redis.hgetall(q)) for q in self.redis_mgr.redis.keys("qt_*")]
-        new_proxies = [Proxy(**self.redis_mgr.redis.hgetall(p)) for p in self.redis_mgr.redis.keys("pt_*")]
-        new_detail_keys = set(self.redis_mgr.redis.keys('d_qt*') + self.redis_mgr.redis.keys('d_*pt*'))
-        for ndk in new_detail_keys:
-            self.redis_mgr.redis.sadd(NEW_DETAILS_SET_KEY, ndk)
-        
-        new_details = [Detail(**self.redis_mgr.redis.hgetall(d)) for d in list(new_detail_keys)]
-
-        cursor = self.db_mgr.cursor()
-
-        queue_keys_to_id = {}
-        proxy_keys_to_id = {}
-        for q in new_queues:
-            self.db_mgr.insert_queue(q,cursor)
-            queue_id = cursor.fetchone()[0]
-            queue_keys_to_id[q.queue_key] = queue_id
-
-        for p in new_proxies:
-            try:
-                self.db_mgr.insert_proxy(p,cursor)
-                proxy_id = cursor.fetchone()[0]
-                proxy_keys_to_id[p.proxy_key] = proxy_id
-            except psycopg2.errors.UniqueViolation as e:
-
-                # existing_proxy = self.db_mgr.get_proxy_by_address_and_port(p.address,p.port)
-                proxy_keys_to_id[p.proxy_key] = None
-
-
-        for d in new_details:
-            if d.proxy_id is None:
-                new_proxy_id = proxy_keys_to_id[d.proxy_key]
-                if new_proxy_id is None:
-
-                    continue
-                else:
-                    d.proxy_id = new_proxy_id
-            if d.queue_id is None:
-                d.queue_id = queue_keys_to_id[d.queue_key]
-            self.db_mgr.insert_detail(d,cursor)
-        
-
-        changed_detail_keys = self.redis_mgr.redis.sdiff('changed_details','new_details')      
-        changed_details = [Detail(**self.redis_mgr.redis.hgetall(d)) for d in self.redis_mgr.redis.sdiff('changed_details','new_details')]
-        
+    def get_dirty_objects(self,set_keys):
+        # set_keys are the new queue, new proxy, new detail and changed detail sets
+        new_queue_set, new_proxy_set, new_detail_set, changed_detail_set = set_keys
+        redis = self.redis_mgr.redis
+        new_queues = self.redis_mgr.hgetall_many(redis.smembers(new_queue_set), Queue)
+        new_proxies = self.redis_mgr.hgetall_many(redis.smembers(new_proxy_set), Proxy)
+        new_details = self.redis_mgr.hgetall_many(redis.smembers(new_detail_set), Detail)
+        changed_details = self.redis_mgr.hgetall_many(redis.sdiff(changed_detail_set,new_detail_set), Detail)
         for changed in changed_details:
             if(changed.queue_id is None or changed.proxy_id is None):
                 raise Exception("Unable to get a queue_id or proxy_id for an existing detail")
-            
-            self.db_mgr.update_detail(changed)
-            
+        return new_queues, new_proxies, new_details, changed_details
+
+    def sync_to_db(self):
+        logging.info("STARTING SYNC")
+        new_queues, new_proxies, new_details, changed_details = self.get_dirty_objects(DIRTY_SET_KEYS)
 
+        if BULK_SYNC:
+            BulkSync(self.db_mgr).sync(new_queues,new_proxies,new_details,changed_details)
+        else:
+            self.sync_rows(new_queues,new_proxies,new_details,changed_details)
 
-        cursor.close()
         self.redis_mgr.redis.flushall()
         logging.info("SYNC COMPLETE")
         return True
 
-        
+    def sync_incremental(self):
+        # writes only the objects marked dirty since the last sync and leaves
+        # the cache (and the spiders drawing from it) in place
+        logging.info("STARTING INCREMENTAL SYNC")
+        sizes = self.redis_mgr.snapshot_dirty_sets()
+        logging.info("%s new queues, %s new proxies, %s new details and %s changed details to sync" % tuple(sizes))
+
+        snapshot_keys = ["%s%s" % (k, SNAPSHOT_SUFFIX) for k in DIRTY_SET_KEYS]
+        BulkSync(self.db_mgr).sync(*self.get_dirty_objects(snapshot_keys))
+        self.redis_mgr.redis.delete(*snapshot_keys)
+        logging.info("INCREMENTAL SYNC COMPLETE")
+        return True
 
+    def sync_rows(self,new_queues,new_proxies,new_details,changed_details):
+        skipped_proxy_ids = set()
 
-        
-        
-        
+        with self.db_mgr.cursor() as cursor:
+            for q in new_queues:
+                self.db_mgr.insert_queue(q,cursor)
 
+            for p in new_proxies:
+                try:
+                    self.db_mgr.insert_proxy(p,cursor)
+                except psycopg2.errors.UniqueViolation as e:
+                    # already in the database under another id
+                    skipped_proxy_ids.add(p.proxy_id)
 
+            for d in new_details:
+                if d.proxy_id in skipped_proxy_ids:
+                    continue
+                self.db_mgr.insert_detail(d,cursor)
+            
+            for changed in changed_details:
+                self.db_mgr.update_detail(changed,cursor)
@@ -29,10 +29,14 @@ def format_redis_boolean(bool_val):
     else:
         raise Exception("invalid boolean")
 
+# timestamps are naive utc datetimes in python and postgres, and whole epoch
+# seconds in redis
+EPOCH = datetime(1970,1,1)
+
 def format_redis_timestamp(datetime_object):
     if type(datetime_object) != datetime:
         raise Exception("invalid type while formatting datetime to str")
-    return datetime_object.isoformat()
+    return str(int((datetime_object - EPOCH).total_seconds()))
 
 def parse_boolean(val):
     if(val == '1' or val == 1 or val == True):
@@ -46,7 +50,15 @@ def parse_timestamp(timestamp_val):
     if type(timestamp_val) == datetime:
         return timestamp_val
 
+    if type(timestamp_val) in (int, float):
+        return datetime.utcfromtimestamp(timestamp_val)
+
     if type(timestamp_val) == str:
+        try:
+            return datetime.utcfromtimestamp(float(timestamp_val))
+        except ValueError:
+            pass
+        # iso strings, as written to redis by older versions
         try:
             return datetime.strptime(timestamp_val, "%Y-%m-%dT%H:%M:%S.%f")
         except ValueError:
@@ -54,3 +66,15 @@ def parse_timestamp(timestamp_val):
 
     else:
         raise Exception("Invalid type for proxy object timestamp")
+
+def parse_epoch(timestamp_val):
+    # epoch seconds of anything parse_timestamp takes, without the datetime
+    # round trip for the epoch values stored in redis
+    if type(timestamp_val) == int:
+        return timestamp_val
+    if type(timestamp_val) == str:
+        try:
+            return int(timestamp_val)
+        except ValueError:
+            pass
+    return int((parse_timestamp(timestamp_val) - EPOCH).total_seconds())
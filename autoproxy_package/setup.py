@@ -25,4 +25,10 @@ setup(
         'redis',
         'psycopg2-binary'
     ],
+    extras_require={
+        'bandit': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': ['autoproxy-snapshot = scrapy_autoproxy.snapshot:main'],
+    },
 )
@@ -26,6 +26,12 @@ CREATE TABLE details (
     "blacklisted_count" INTEGER DEFAULT 0,
     "lifetime_good" INTEGER DEFAULT 0,
     "lifetime_bad" INTEGER DEFAULT 0,
+    "latency_ewma" REAL DEFAULT 0,
+    "latency_hist" INT[] DEFAULT '{}',
+    "random_key" DOUBLE PRECISION DEFAULT random(),
     CONSTRAINT proxy_queue_unique UNIQUE("proxy_id","queue_id")
     
 );
+
+CREATE INDEX details_queue_active_last_used_idx ON details ("queue_id", "active", "last_used");
+CREATE INDEX details_queue_active_random_key_idx ON details ("queue_id", "active", "random_key");
@@ -0,0 +1,14 @@
+-- latency tracking per detail.  load_time was stored in whole seconds and is
+-- now in milliseconds, like its 60000 default.  the conversion only runs the
+-- first time, together with adding latency_ewma, so running this again
+-- leaves load_time alone.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'details' AND column_name = 'latency_ewma') THEN
+        ALTER TABLE details ADD COLUMN "latency_ewma" REAL DEFAULT 0;
+        UPDATE details SET load_time = load_time * 1000 WHERE load_time < 1000;
+    END IF;
+END
+$$;
+ALTER TABLE details ADD COLUMN IF NOT EXISTS "latency_hist" INT[] DEFAULT '{}';
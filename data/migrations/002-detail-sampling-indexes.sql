@@ -0,0 +1,7 @@
+-- random_key gives every detail a fixed random position, so the seed queue
+-- can be sampled in random order off an index (see get_unused_proxy_ids).
+-- existing rows each get their own random() value.
+ALTER TABLE details ADD COLUMN IF NOT EXISTS "random_key" DOUBLE PRECISION DEFAULT random();
+CREATE INDEX IF NOT EXISTS details_queue_active_last_used_idx ON details ("queue_id", "active", "last_used");
+CREATE INDEX IF NOT EXISTS details_queue_active_random_key_idx ON details ("queue_id", "active", "random_key");
+ANALYZE details;
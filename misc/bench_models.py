@@ -0,0 +1,65 @@
+# times building Detail/Proxy objects from their redis hashes and writing
+# them back, per object and per proxied request.  a request decodes its
+# detail and proxy when drawn and the detail again from record_outcome's
+# reply, reads the keys a few times and encodes the detail once when it is
+# requeued.  no redis is needed, the hashes are built in memory in the format
+# the checked out version writes.
+#
+#   python misc/bench_models.py --number 100000
+import sys
+import timeit
+import argparse
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+from scrapy_autoproxy.proxy_objects import Proxy, Detail
+
+KEY_READS_PER_REQUEST = 6
+
+
+def decoder(obj_class):
+    # older versions have no from_redis codec
+    from_redis = getattr(obj_class, 'from_redis', None)
+    if from_redis is None:
+        return lambda data, key: obj_class(**data)
+    return from_redis
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    detail = Detail(active=True, load_time=850, bad_count=1, lifetime_good=120, lifetime_bad=14, latency_ewma=912.5, latency_hist=[0] * 10 + [3] * 11, proxy_id=1234, queue_id=56, detail_id=78901)
+    proxy = Proxy('10.1.2.3', 8080, 'http', proxy_id=1234)
+    detail_data = {k: str(v) for k, v in detail.to_dict(redis_format=True).items()}
+    proxy_data = {k: str(v) for k, v in proxy.to_dict(redis_format=True).items()}
+    detail_key = detail.detail_key
+    proxy_key = proxy.proxy_key
+    decode_detail = decoder(Detail)
+    decode_proxy = decoder(Proxy)
+
+    def request():
+        drawn = decode_detail(detail_data, detail_key)
+        decode_proxy(proxy_data, proxy_key)
+        updated = decode_detail(detail_data, None)
+        for i in range(KEY_READS_PER_REQUEST // 2):
+            updated.detail_key
+            updated.proxy_key
+        updated.to_dict(redis_format=True)
+
+    cases = (
+        ('decode detail', lambda: decode_detail(detail_data, detail_key)),
+        ('decode proxy', lambda: decode_proxy(proxy_data, proxy_key)),
+        ('encode detail', lambda: detail.to_dict(redis_format=True)),
+        ('detail_key', lambda: detail.detail_key),
+        ('per request', request),
+    )
+    logging.info("detail hash: %s" % detail_data)
+    for name, fn in cases:
+        best = min(timeit.repeat(fn, number=args.number, repeat=args.repeat))
+        logging.info("%-14s %8.2f us" % (name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
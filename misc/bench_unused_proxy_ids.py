@@ -0,0 +1,92 @@
+# times get_unused_proxy_ids against the ORDER BY RANDOM() query it replaced,
+# on a seed queue of --proxies proxies.  the rows are generated inside one
+# transaction that is rolled back at the end, so the database is left as it
+# was (schema migrations must already be applied).
+#
+#   python misc/bench_unused_proxy_ids.py --proxies 1000000
+import sys
+import time
+import argparse
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+from scrapy_autoproxy.storage_manager import PostgresManager, SEED_QUEUE_ID
+from scrapy_autoproxy.proxy_objects import Queue
+
+LEGACY_QUERY = """
+    SELECT proxy_id FROM details
+    WHERE queue_id = %(seed_queue_id)s
+    AND proxy_id NOT IN ( SELECT proxy_id FROM details WHERE queue_id = %(queue_id)s )
+    AND proxy_id NOT IN %(excluded_pids)s
+    AND active = %(active)s
+    ORDER BY RANDOM()
+    LIMIT %(limit)s
+    """
+
+POPULATE = """
+INSERT INTO proxies (address, port)
+SELECT 'bench-' || i, 8080 FROM generate_series(1, %(proxies)s) AS i;
+
+INSERT INTO details (proxy_id, queue_id, active)
+SELECT proxy_id, %(seed_queue_id)s, random() < 0.2 FROM proxies WHERE address LIKE 'bench-%%';
+
+INSERT INTO queues (domain) VALUES ('bench.example.com');
+
+INSERT INTO details (proxy_id, queue_id)
+SELECT proxy_id, (SELECT queue_id FROM queues WHERE domain = 'bench.example.com') FROM proxies
+WHERE address LIKE 'bench-%%' AND random() < 0.1;
+
+ANALYZE proxies;
+ANALYZE details;
+"""
+
+
+def timed(fn,samples):
+    times = []
+    for i in range(samples):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000, times[-1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--proxies', type=int, default=1000000)
+    parser.add_argument('--count', type=int, default=400)
+    parser.add_argument('--excluded', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=5)
+    args = parser.parse_args()
+
+    db_mgr = PostgresManager()
+    db_mgr.init_seed_queues()
+    with db_mgr.transaction() as cursor:
+        start = time.time()
+        cursor.execute(POPULATE, {'proxies': args.proxies, 'seed_queue_id': SEED_QUEUE_ID})
+        logging.info("generated %s seed proxies in %.1f seconds" % (args.proxies, time.time() - start))
+
+        cursor.execute("SELECT queue_id, domain FROM queues WHERE domain = 'bench.example.com'")
+        queue = Queue(**cursor.fetchone())
+        cursor.execute("SELECT proxy_id FROM details WHERE queue_id = %s LIMIT %s", (SEED_QUEUE_ID, args.excluded))
+        excluded = [row[0] for row in cursor.fetchall()]
+
+        def legacy():
+            params = {'seed_queue_id': SEED_QUEUE_ID, 'queue_id': queue.id(), 'excluded_pids': tuple(excluded + [-1]), 'active': True, 'limit': args.count}
+            cursor.execute(LEGACY_QUERY, params)
+            pids = cursor.fetchall()
+            if len(pids) < args.count:
+                params['active'] = False
+                cursor.execute(LEGACY_QUERY, params)
+
+        def sampled():
+            db_mgr.get_unused_proxy_ids(queue, args.count, excluded, cursor=cursor)
+
+        for name, fn in (('order by random()', legacy), ('random_key index', sampled)):
+            median, worst = timed(fn, args.samples)
+            logging.info("%-18s median %8.1f ms   max %8.1f ms" % (name, median, worst))
+
+        cursor.connection.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,2 @@
+from scrapy_autoproxy.storage_manager import RedisManager
+RedisManager().build_indexes()
@@ -0,0 +1 @@
+select q.domain, h.bucket, sum(h.c) as c from details d join queues q on q.queue_id = d.queue_id cross join lateral unnest(d.latency_hist) with ordinality as h(c, bucket) group by q.domain, h.bucket order by q.domain, h.bucket;
@@ -0,0 +1,6 @@
+import sys
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+from scrapy_autoproxy.storage_manager import RedisManager
+from scrapy_autoproxy.outcome_stream import OutcomeAggregator
+OutcomeAggregator(RedisManager()).run()
@@ -0,0 +1,6 @@
+import sys
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+from scrapy_autoproxy.storage_manager import StorageManager
+from scrapy_autoproxy.queue_refill import QueueRefillWorker
+QueueRefillWorker(StorageManager()).run()
@@ -32,6 +32,9 @@ SCRAPYD_PASSWORD = config[deploy_section_env]['password']
 MAX_JOBS = int(config['autoproxy:scheduler']['max_jobs'])
 SYNC_INTERVAL = int(config['autoproxy:scheduler']['sync_interval'])
 SCRAPYD_JOB_TIMEOUT = int(config['autoproxy:scheduler']['job_timeout'])
+# 'full' stops all jobs, syncs and flushes the cache.  'incremental' syncs only
+# the dirty details while the spiders keep running.
+SYNC_MODE = config['autoproxy:scheduler'].get('sync_mode','full')
 
 
 class Task(object):
@@ -227,6 +230,7 @@ class SpiderScheduler(object):
             
 
 tq = TaskQueue()
+sync_tq = TaskQueue()
 
 if __name__ == "__main__":
     scheduler = SpiderScheduler()
@@ -261,6 +265,12 @@ if __name__ == "__main__":
         now = datetime.datetime.now()
         scheduler.start_time = now
         scheduler.allow_new_jobs = True
+
+    def do_incremental_sync():
+        logging.info("STARTING INCREMENTAL SYNC...")
+        storage_mgr = StorageManager()
+        storage_mgr.sync_incremental()
+        logging.info("INCREMENTAL SYNC COMPLETE")
         
 
 
@@ -275,7 +285,12 @@ if __name__ == "__main__":
         start = scheduler.start_time
         elapsed = now - start
         logging.info("elapsed time since last sync: %s" % elapsed.seconds)
-        if elapsed.seconds > SYNC_INTERVAL and scheduler.allow_new_jobs:
+        if elapsed.seconds > SYNC_INTERVAL and SYNC_MODE == 'incremental':
+            logging.info("enqueuing incremental sync task")
+            scheduler.start_time = now
+            sync_tq.enqueue(Task(fn=do_incremental_sync))
+
+        elif elapsed.seconds > SYNC_INTERVAL and scheduler.allow_new_jobs:
             logging.info("enqueuing sync task")
             scheduler.allow_new_jobs = False
             tq.enqueue(Task(fn=do_sync))
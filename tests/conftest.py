@@ -0,0 +1,94 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the package, and the scrapy project with the middlewares
+sys.path.insert(0, os.path.join(ROOT, 'autoproxy_package'))
+sys.path.insert(0, os.path.join(ROOT, 'autoproxy'))
+
+from scrapy_autoproxy import storage_manager
+from scrapy_autoproxy.proxy_objects import Queue, Proxy, Detail
+from scrapy_autoproxy.storage_manager import SEED_QUEUE_ID, AGGREGATE_QUEUE_ID, SEED_QUEUE_DOMAIN, AGGREGATE_QUEUE_DOMAIN
+
+
+class MemoryPostgresManager(object):
+    # the PostgresManager calls the redis side makes, answered from rows kept
+    # in memory.  starts out as a freshly initialized database: the seed and
+    # aggregate queues and one seed detail per proxy.
+    def __init__(self,proxy_count=20):
+        self.queues = [
+            {'queue_id': SEED_QUEUE_ID, 'domain': SEED_QUEUE_DOMAIN},
+            {'queue_id': AGGREGATE_QUEUE_ID, 'domain': AGGREGATE_QUEUE_DOMAIN},
+        ]
+        self.proxies = [{'proxy_id': i, 'address': '10.0.0.%s' % i, 'port': 8080, 'protocol': 'http'} for i in range(1, proxy_count + 1)]
+        self.details = [{'detail_id': i, 'proxy_id': i, 'queue_id': SEED_QUEUE_ID, 'active': i % 2 == 0} for i in range(1, proxy_count + 1)]
+        self.sequences = {}
+
+    def init_seed_queues(self):
+        pass
+
+    def init_seed_details(self):
+        pass
+
+    def seed_detail_queries(self):
+        return [('seed details', {'active': active}) for active in (True, False)]
+
+    def stream_rows(self,query,params=None,itersize=None):
+        if query == 'seed details':
+            return [d for d in self.details if d['queue_id'] == SEED_QUEUE_ID and d['active'] == params['active']]
+        if 'queues' in query:
+            return list(self.queues)
+        return list(self.proxies)
+
+    def reserve_ids(self,sequence,count):
+        start = self.sequences.get(sequence, 1000)
+        self.sequences[sequence] = start + count
+        return list(range(start, start + count))
+
+    def get_non_seed_details(self,queue_id):
+        return [Detail(**d) for d in self.details if d['queue_id'] == queue_id]
+
+    def get_detail_by_queue_and_proxy(self,queue_id,proxy_id):
+        return None
+
+    def get_unused_proxy_ids(self,queue,count,excluded_pids):
+        used = set(d['proxy_id'] for d in self.details if d['queue_id'] == queue.id())
+        used.update(int(pid) for pid in excluded_pids)
+        return [p['proxy_id'] for p in self.proxies if p['proxy_id'] not in used][:count]
+
+
+@pytest.fixture
+def redis_server():
+    return fakeredis.FakeServer()
+
+@pytest.fixture
+def redis(monkeypatch,redis_server):
+    # every client get_redis hands out talks to one in memory server
+    server = redis_server
+    def fake_redis(**params):
+        return fakeredis.FakeRedis(server=server, decode_responses=params.get('decode_responses', True))
+    monkeypatch.setattr(storage_manager, 'Redis', fake_redis)
+    monkeypatch.setattr(storage_manager, '_redis_clients', {})
+    return storage_manager.get_redis()
+
+@pytest.fixture
+def db(monkeypatch):
+    db = MemoryPostgresManager()
+    monkeypatch.setattr(storage_manager, 'PostgresManager', lambda: db)
+    return db
+
+@pytest.fixture
+def redis_mgr(redis, db):
+    # the cache is warmed from db on construction
+    return storage_manager.RedisManager()
+
+@pytest.fixture
+def queue(redis_mgr):
+    # a queue with one detail per seed proxy, all of them drawable
+    queue = redis_mgr.register_queue(Queue(domain='example.com'))
+    for proxy_id in range(1, 11):
+        redis_mgr.register_detail(Detail(proxy_id=proxy_id, queue_id=queue.id(), active=proxy_id % 2 == 0), bypass_db_check=True)
+    return queue
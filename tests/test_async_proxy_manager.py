@@ -0,0 +1,76 @@
+import asyncio
+from types import SimpleNamespace
+
+import fakeredis
+import pytest
+
+from scrapy_autoproxy import async_proxy_manager, async_storage_manager, queue_refill
+from scrapy_autoproxy.async_proxy_manager import AsyncProxyManager
+from scrapy_autoproxy.outcome_stream import OutcomeAggregator, OUTCOME_STREAM_KEY, QUEUE_STATS_PREFIX
+from scrapy_autoproxy.proxy_objects import Queue
+from scrapy_autoproxy.queue_refill import QueueRefillWorker, REFILL_REQUESTS_KEY
+from scrapy_autoproxy.redis_scripts import RedisScripts
+from scrapy_autoproxy.selection_policies import SELECTION_POLICIES
+from scrapy_autoproxy.storage_manager import StorageManager
+
+
+@pytest.fixture
+def manager(monkeypatch,redis_server,redis_mgr):
+    # call it from the test's event loop: before python 3.10 the asyncio
+    # locks of a redis.asyncio pool bind to the loop current when it is made
+    def build(engine):
+        monkeypatch.setattr(async_proxy_manager, 'GET_PROXY_ENGINE', engine)
+        manager = AsyncProxyManager()
+        redis_mgr_async = manager.storage_mgr.redis_mgr
+        redis_mgr_async.redis = fakeredis.FakeAsyncRedis(server=redis_server, decode_responses=True)
+        redis_mgr_async.scripts = RedisScripts(redis_mgr_async.redis)
+        manager.storage_mgr._storage_mgr = SimpleNamespace(redis_mgr=redis_mgr)
+        return manager
+    return build
+
+
+def test_unknown_engine_is_rejected_at_construction(manager):
+    with pytest.raises(Exception):
+        manager('nope')
+
+@pytest.mark.parametrize('engine', ['lua', 'thompson', 'p2c'])
+def test_draw_many_uses_the_configured_engine(manager,queue,engine):
+    async def draw():
+        proxy_mgr = manager(engine)
+        return proxy_mgr, await proxy_mgr.draw_many(queue, 3)
+    proxy_mgr, draws = asyncio.run(draw())
+    assert len(draws) == 3
+    assert len(set(draw.detail.detail_key for draw in draws)) == 3
+    if engine == 'lua':
+        # drawn by the async script call
+        assert proxy_mgr.policy is None
+    else:
+        assert type(proxy_mgr.policy) is SELECTION_POLICIES[engine]
+
+def test_refill_worker_and_outcome_stream(monkeypatch,manager,redis_mgr):
+    monkeypatch.setattr(queue_refill, 'QUEUE_REFILL_WORKER', True)
+    monkeypatch.setattr(async_storage_manager, 'OUTCOME_STREAM', True)
+    worker = QueueRefillWorker(StorageManager(), low_watermark=8, high_watermark=12)
+    def wait(queue,timeout):
+        # the worker picks up the request made after the empty draw
+        assert worker.try_refill(redis_mgr.redis.lpop(REFILL_REQUESTS_KEY)) == 12
+        return True
+    queue = redis_mgr.register_queue(Queue(domain='example.org'))
+
+    async def crawl():
+        proxy_mgr = manager('lua')
+        storage_mgr = proxy_mgr.storage_mgr
+        storage_mgr.outcome_stream.redis = storage_mgr.redis_mgr.redis
+        proxy_mgr.sync_refiller(storage_mgr.sync_storage_manager()).client.wait = wait
+        proxy = await proxy_mgr.get_proxy('http://example.org/')
+        await proxy.callback(True, latency=0.2)
+        return proxy
+    proxy = asyncio.run(crawl())
+    # appended to the stream, not recorded
+    assert redis_mgr.redis.xlen(OUTCOME_STREAM_KEY) == 1
+    assert redis_mgr.get_detail(proxy.detail.detail_key).lifetime_good == proxy.detail.lifetime_good
+
+    aggregator = OutcomeAggregator(redis_mgr, consumer='test', block_ms=None)
+    aggregator.create_group()
+    assert aggregator.process_batch() == 1
+    assert redis_mgr.redis.hget(QUEUE_STATS_PREFIX + queue.queue_key, 'good') == '1'
@@ -0,0 +1,52 @@
+import time
+
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, RedisDetailQueueEmpty, PROXY_INTERVAL
+
+
+def rdq(redis_mgr,queue,active=False):
+    return RedisDetailQueue(queue, active=active, redis_mgr=redis_mgr)
+
+def cached_detail(redis_mgr,queue,proxy_id,last_used):
+    detail_key = 'd_%s_p_%s' % (queue.queue_key, proxy_id)
+    redis_mgr.redis.hset(detail_key, 'last_used', int(last_used))
+    return redis_mgr.get_detail(detail_key)
+
+
+def test_enqueue_cools_down_recently_used_details(redis_mgr,queue):
+    inactive = rdq(redis_mgr, queue)
+    inactive.clear()
+    now = time.time()
+    recent = cached_detail(redis_mgr, queue, 1, now)
+    rested = cached_detail(redis_mgr, queue, 3, now - PROXY_INTERVAL - 1)
+    inactive.enqueue(recent)
+    inactive.enqueue(rested)
+
+    assert redis_mgr.redis.lrange(inactive.redis_key, 0, -1) == [rested.detail_key]
+    assert redis_mgr.redis.zscore(inactive.cooldown_key, recent.detail_key) == recent.last_used_epoch + PROXY_INTERVAL
+    # cooling down details still count towards the queue's length
+    assert inactive.length() == 2
+
+def test_promote_moves_eligible_details_in_eligibility_order(redis_mgr,queue):
+    inactive = rdq(redis_mgr, queue)
+    inactive.clear()
+    now = time.time()
+    redis_mgr.redis.zadd(inactive.cooldown_key, {'d_later': now - 10, 'd_first': now - 100, 'd_waiting': now + 100})
+
+    assert inactive.promote() == 2
+    assert redis_mgr.redis.lrange(inactive.redis_key, 0, -1) == ['d_first', 'd_later']
+    assert redis_mgr.redis.zrange(inactive.cooldown_key, 0, -1) == ['d_waiting']
+
+def test_dequeue_sends_cooling_details_back(redis_mgr,queue):
+    inactive = rdq(redis_mgr, queue)
+    inactive.clear()
+    now = time.time()
+    recent = cached_detail(redis_mgr, queue, 5, now)
+    # pushed straight to the list, as an older process would
+    redis_mgr.redis.rpush(inactive.redis_key, recent.detail_key)
+
+    try:
+        inactive.dequeue()
+        assert False, "dequeued a detail still cooling down"
+    except RedisDetailQueueEmpty:
+        pass
+    assert redis_mgr.redis.zscore(inactive.cooldown_key, recent.detail_key) == recent.last_used_epoch + PROXY_INTERVAL
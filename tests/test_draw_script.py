@@ -0,0 +1,70 @@
+import time
+
+from scrapy_autoproxy.selection_policies import TARGET_ACTIVE_COUNT
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, CHANGED_DETAILS_SET_KEY, BLACKLIST_TIME, PROXY_INTERVAL
+
+
+def queued_keys(redis_mgr,queue,active=False):
+    return redis_mgr.redis.lrange(RedisDetailQueue.queue_redis_key(queue.queue_key, active), 0, -1)
+
+def detail_key(queue,proxy_id):
+    return 'd_%s_p_%s' % (queue.queue_key, proxy_id)
+
+
+# the queue fixture's active queue is below min_queue_size, so every draw
+# comes from the inactive queue: proxies 1, 3, 5, 7 and 9
+
+def test_batch_draw_pops_distinct_details(redis_mgr,queue):
+    draws = redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, 3)
+    assert len(draws) == 3
+    keys = [draw.detail.detail_key for draw in draws]
+    assert len(set(keys)) == 3
+    for draw in draws:
+        assert draw.proxy.proxy_key == draw.detail.proxy_key
+        assert not draw.active
+        assert draw.detail.detail_key not in queued_keys(redis_mgr, queue)
+    assert len(queued_keys(redis_mgr, queue)) == 2
+    assert len(queued_keys(redis_mgr, queue, True)) == 5
+
+def test_empty_queue_returns_one_empty_draw(redis_mgr,queue):
+    assert len(redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, 10)) == 5
+    draws = redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, 2)
+    assert len(draws) == 1
+    assert draws[0].detail is None
+    assert draws[0].queue_count == 10
+
+def test_blacklisted_details_are_dropped_or_unblacklisted(redis_mgr,queue):
+    now = int(time.time())
+    for proxy_id in range(1, 11):
+        redis_mgr.redis.hset(detail_key(queue, proxy_id), mapping={'blacklisted': '1', 'blacklisted_count': 1, 'last_used': now - 60})
+    expired = detail_key(queue, 3)
+    redis_mgr.redis.hset(expired, 'last_used', now - BLACKLIST_TIME - 60)
+
+    draws = redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, 10)
+    assert [draw.detail.detail_key for draw in draws] == [expired]
+    assert not draws[0].detail.blacklisted
+    assert redis_mgr.redis.sismember(CHANGED_DETAILS_SET_KEY, expired)
+    assert queued_keys(redis_mgr, queue) == []
+
+def test_details_still_cooling_down_go_to_the_cooldown_set(redis_mgr,queue):
+    now = int(time.time())
+    cooling = detail_key(queue, 1)
+    redis_mgr.redis.hset(cooling, 'last_used', now)
+
+    drawn = [draw.detail.detail_key for draw in redis_mgr.draw_details(queue, TARGET_ACTIVE_COUNT, 10)]
+    assert cooling not in drawn
+    assert len(drawn) == 4
+    cooldown_key = RedisDetailQueue.cooldown_redis_key(queue.queue_key, False)
+    assert redis_mgr.redis.zscore(cooldown_key, cooling) == now + PROXY_INTERVAL
+
+def test_ranked_batch_draw_pops_distinct_details(redis_mgr,queue):
+    # a ranked queue is one sorted set per queue, in the active queue's key
+    ranked_key = RedisDetailQueue.queue_redis_key(queue.queue_key, True)
+    redis_mgr.redis.delete(ranked_key)
+    redis_mgr.redis.zadd(ranked_key, {detail_key(queue, proxy_id): proxy_id for proxy_id in range(1, 11)})
+
+    draws = redis_mgr.draw_ranked_details(queue, 3)
+    keys = [draw.detail.detail_key for draw in draws]
+    assert len(set(keys)) == 3
+    assert redis_mgr.redis.zcard(ranked_key) == 7
+    assert all(draw.queue_count == 10 for draw in draws)
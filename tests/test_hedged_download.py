@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('twisted')
+pytest.importorskip('scrapy')
+
+from scrapy import Request
+from scrapy.http import Response
+from twisted.internet import defer, task
+from twisted.internet.error import TimeoutError
+
+from autoproxy.middlewares import HedgedDownload, AutoproxyDownloaderMiddleware
+
+
+class FakeProxy(object):
+    def __init__(self,name):
+        self.name = name
+        self.outcomes = []
+
+    def callback(self,success,latency=None,requeue=None):
+        self.outcomes.append((success, requeue))
+
+    def urlify(self):
+        return 'http://%s:8080' % self.name
+
+
+class FakeEngine(object):
+    # every leg's download is a Deferred the test fires by hand
+    def __init__(self):
+        self.downloads = []
+
+    def download(self,request,spider):
+        d = defer.Deferred()
+        self.downloads.append((request, d))
+        return d
+
+
+class FakeMiddleware(object):
+    # the parts of AutoproxyDownloaderMiddleware a HedgedDownload uses, with
+    # its own exception classification
+    record_exception = AutoproxyDownloaderMiddleware.record_exception
+
+    def __init__(self,proxies,delay=0.5,budget=True):
+        self.reactor = task.Clock()
+        self.crawler = SimpleNamespace(engine=FakeEngine())
+        self.proxies = list(proxies)
+        self.delay = delay
+        self.budget = budget
+        self.responses = []
+
+    def run(self,fn,*args):
+        return fn(*args)
+
+    def hedge_plan(self,request):
+        return self.proxies.pop(0), self.delay
+
+    def get_proxy(self,request_url):
+        return self.proxies.pop(0)
+
+    def take_hedge(self):
+        return self.budget
+
+    def set_proxy(self,request,proxy):
+        request.meta['proxy'] = proxy.urlify()
+        request.meta['proxy_obj'] = proxy
+
+    def record_response(self,request,response,spider):
+        self.responses.append((request.meta['proxy_obj'], response))
+
+
+def start(mw):
+    request = Request('http://example.com/')
+    results = []
+    HedgedDownload(mw, request, SimpleNamespace()).start().addBoth(results.append)
+    return request, results
+
+
+def test_first_response_wins_and_the_other_leg_is_cancelled():
+    primary, hedge = FakeProxy('primary'), FakeProxy('hedge')
+    mw = FakeMiddleware([primary, hedge])
+    request, results = start(mw)
+    mw.reactor.advance(mw.delay)
+    assert len(mw.crawler.engine.downloads) == 2
+
+    leg, d = mw.crawler.engine.downloads[1]
+    response = Response(request.url)
+    d.callback(response)
+    assert results == [response]
+    assert request.meta['proxy_obj'] is hedge
+    # the loser is slow rather than bad: neutral, but requeued
+    assert primary.outcomes == [(None, True)]
+    assert hedge.outcomes == []
+
+def test_both_legs_failing():
+    primary, hedge = FakeProxy('primary'), FakeProxy('hedge')
+    mw = FakeMiddleware([primary, hedge])
+    request, results = start(mw)
+    mw.reactor.advance(mw.delay)
+
+    mw.crawler.engine.downloads[0][1].errback(TimeoutError())
+    # recorded as handle_exception would, the hedge may still win
+    assert primary.outcomes == [(False, None)]
+    assert results == []
+
+    mw.crawler.engine.downloads[1][1].errback(TimeoutError())
+    # the last leg is left to process_exception, which records and retries it
+    assert results[0].check(TimeoutError)
+    assert request.meta['proxy_obj'] is hedge
+    assert hedge.outcomes == []
+
+def test_no_hedge_once_the_budget_is_spent():
+    primary = FakeProxy('primary')
+    mw = FakeMiddleware([primary], budget=False)
+    request, results = start(mw)
+    mw.reactor.advance(mw.delay)
+    assert len(mw.crawler.engine.downloads) == 1
+
+    response = Response(request.url)
+    mw.crawler.engine.downloads[0][1].callback(response)
+    assert results == [response]
+    assert request.meta['proxy_obj'] is primary
@@ -0,0 +1,39 @@
+import threading
+
+import pytest
+
+from scrapy_autoproxy.id_allocator import IdAllocator, ID_SEQUENCES
+
+
+@pytest.fixture
+def allocator(redis,db):
+    return IdAllocator(redis, db, 5)
+
+
+def test_ids_come_from_reserved_blocks(allocator,db,redis):
+    ids = [allocator.allocate('d') for i in range(7)]
+    assert ids == list(range(1000, 1007))
+    # two blocks of 5 reserved, the rest waits in the pool
+    assert db.sequences[ID_SEQUENCES['d']] == 1010
+    assert redis.llen(IdAllocator.pool_key('d')) == 3
+
+def test_each_prefix_has_its_own_sequence(allocator):
+    assert allocator.allocate('q') == 1000
+    assert allocator.allocate('p') == 1000
+
+def test_unknown_prefix_is_rejected(allocator):
+    with pytest.raises(Exception):
+        allocator.allocate('x')
+
+def test_concurrent_allocations_never_repeat(allocator):
+    ids = []
+    def allocate():
+        for i in range(20):
+            ids.append(allocator.allocate('d'))
+    threads = [threading.Thread(target=allocate) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(ids) == 80
+    assert len(set(ids)) == 80
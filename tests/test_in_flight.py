@@ -0,0 +1,51 @@
+import time
+from types import SimpleNamespace
+
+from scrapy_autoproxy.proxy_objects import ProxyObject
+from scrapy_autoproxy.selection_policies import PowerOfTwoChoicesPolicy, MAX_PROXY_CONCURRENCY
+from scrapy_autoproxy.storage_manager import RedisDetailQueue
+
+
+def proxy_object(redis_mgr,queue,proxy_id):
+    detail = redis_mgr.get_detail('d_%s_p_%s' % (queue.queue_key, proxy_id))
+    redis_mgr.redis.lrem(RedisDetailQueue.queue_redis_key(queue.queue_key, detail.active), 1, detail.detail_key)
+    storage_mgr = SimpleNamespace(redis_mgr=redis_mgr, outcome_buffer=None, outcome_stream=None)
+    return ProxyObject(detail, storage_mgr, RedisDetailQueue(queue, active=detail.active, redis_mgr=redis_mgr))
+
+
+def test_callback_releases_the_dispatch_lease(redis_mgr,queue):
+    proxy = proxy_object(redis_mgr, queue, 1)
+    proxy.dispatch()
+    assert redis_mgr.get_in_flight([proxy.detail.proxy_key]) == [1]
+    proxy.callback(True, latency=0.2)
+    assert redis_mgr.get_in_flight([proxy.detail.proxy_key]) == [0]
+
+def test_outcome_without_a_lease_leaves_others_in_flight(redis_mgr,queue):
+    proxy = proxy_object(redis_mgr, queue, 2)
+    redis_mgr.lease_in_flight(proxy.detail.proxy_key)
+    redis_mgr.record_outcome(proxy.detail, True, 100)
+    assert redis_mgr.get_in_flight([proxy.detail.proxy_key]) == [1]
+
+def test_expired_leases_stop_counting(redis_mgr,queue):
+    proxy_key = proxy_object(redis_mgr, queue, 3).detail.proxy_key
+    redis_mgr.lease_in_flight(proxy_key)
+    # a request whose callback never came
+    redis_mgr.redis.zadd(redis_mgr.in_flight_key(proxy_key), {'lost': time.time() - 1})
+    assert redis_mgr.get_in_flight([proxy_key]) == [1]
+    assert redis_mgr.redis.zscore(redis_mgr.in_flight_key(proxy_key), 'lost') is None
+    assert redis_mgr.redis.ttl(redis_mgr.in_flight_key(proxy_key)) > 0
+
+def test_p2c_skips_proxies_at_max_concurrency(redis_mgr,queue):
+    busy = set()
+    for proxy_id in range(1, 10):
+        proxy_key = redis_mgr.get_detail('d_%s_p_%s' % (queue.queue_key, proxy_id)).proxy_key
+        for i in range(MAX_PROXY_CONCURRENCY):
+            redis_mgr.lease_in_flight(proxy_key)
+        busy.add(proxy_key)
+
+    policy = PowerOfTwoChoicesPolicy(redis_mgr)
+    draws = [policy.draw(queue) for i in range(20)]
+    drawn = [draw.proxy.proxy_key for draw in draws if draw.detail is not None]
+    # only proxy 10 has room, and once drawn it is out of the queue
+    assert len(drawn) == 1
+    assert drawn[0] not in busy
@@ -0,0 +1,34 @@
+from scrapy_autoproxy.proxy_objects import Queue, Proxy, Detail
+from scrapy_autoproxy.storage_manager import RedisManager, QUEUE_DOMAIN_INDEX_KEY, PROXY_ADDRESS_INDEX_KEY, QUEUE_DETAIL_COUNT_KEY
+
+
+def test_build_indexes_from_an_unindexed_cache(redis,db):
+    # a cache from before the indexes: only the object hashes.  a non empty
+    # cache is not warmed from the database
+    queues = [Queue(domain='site%s.com' % i, queue_id=i) for i in (5, 6)]
+    proxies = [Proxy('10.1.%s.%s' % (i // 250, i % 250), 3128, 'http', proxy_id=i) for i in range(1, 1501)]
+    pipe = redis.pipeline(transaction=False)
+    for obj in queues + proxies:
+        pipe.hset(obj.queue_key if isinstance(obj, Queue) else obj.proxy_key, mapping=obj.to_dict(redis_format=True))
+    for proxy_id in range(1, 4):
+        detail = Detail(queue_id=5, proxy_id=proxy_id)
+        pipe.hset(detail.detail_key, mapping=detail.to_dict(redis_format=True))
+    pipe.execute()
+
+    redis_mgr = RedisManager()
+    redis_mgr.build_indexes()
+
+    assert redis.hlen(QUEUE_DOMAIN_INDEX_KEY) == 2
+    assert redis.hlen(PROXY_ADDRESS_INDEX_KEY) == 1500
+    assert redis_mgr.get_queue_by_domain('site6.com').queue_key == 'q_6'
+    proxy = redis_mgr.get_proxy_by_address_and_port('10.1.4.2', 3128)
+    assert proxy.proxy_key == 'p_1002'
+    assert redis_mgr.get_proxy_by_address_and_port('10.9.9.9', 3128) is None
+    assert redis_mgr.get_queue_count(queues[0]) == 3
+    assert redis_mgr.get_queue_count(queues[1]) == 0
+    assert len(redis_mgr.get_all_queue_details('q_5')) == 3
+
+def test_build_indexes_replaces_stale_counts(redis_mgr,queue):
+    redis_mgr.redis.hset(QUEUE_DETAIL_COUNT_KEY, queue.queue_key, 99)
+    redis_mgr.build_indexes()
+    assert redis_mgr.get_queue_count(queue) == 10
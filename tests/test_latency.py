@@ -0,0 +1,29 @@
+from scrapy_autoproxy.latency import LATENCY_BUCKETS_MS, LATENCY_BUCKET_COUNT, bucket_index, histogram_quantile, merge_histograms, adaptive_timeout
+
+
+def histogram(*latencies_ms):
+    counts = [0] * LATENCY_BUCKET_COUNT
+    for latency in latencies_ms:
+        counts[bucket_index(latency)] += 1
+    return counts
+
+
+def test_quantile_is_the_bucket_upper_bound():
+    counts = histogram(*([100] * 99 + [5000]))
+    assert histogram_quantile(counts, 0.5) == LATENCY_BUCKETS_MS[bucket_index(100)]
+    assert histogram_quantile(counts, 1.0) == LATENCY_BUCKETS_MS[bucket_index(5000)]
+    assert histogram_quantile([0] * LATENCY_BUCKET_COUNT, 0.5) is None
+
+def test_histograms_merge_by_adding_counts():
+    merged = merge_histograms([histogram(100), ','.join(map(str, histogram(100, 900))), ''])
+    assert merged == histogram(100, 100, 900)
+
+def test_adaptive_timeout_between_floor_and_cap():
+    fast = histogram(*([50] * 10))
+    slow = histogram(*([40000] * 10))
+    assert adaptive_timeout(fast, 3.0, 2.0, 30.0, 8.0, 5) == 2.0
+    assert adaptive_timeout(slow, 3.0, 2.0, 30.0, 8.0, 5) == 30.0
+
+def test_probe_timeout_never_exceeds_the_cap():
+    assert adaptive_timeout(histogram(100), 3.0, 2.0, 30.0, 8.0, 5) == 8.0
+    assert adaptive_timeout(histogram(100), 3.0, 2.0, 5.0, 8.0, 5) == 5.0
@@ -0,0 +1,80 @@
+import logging
+import queue as thread_queue
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('twisted')
+pytest.importorskip('scrapy')
+
+from scrapy import Request
+from scrapy.core.downloader.middleware import DownloaderMiddlewareManager
+from scrapy.http import Response
+from scrapy.settings import Settings
+from twisted.internet import defer, task
+from twisted.internet.error import TimeoutError
+
+from autoproxy.middlewares import AutoproxyDownloaderMiddleware
+
+
+class ThreadReactor(task.Clock):
+    # deferToThreadPool hands a result back with callFromThread, the test
+    # runs those calls on its own thread as a reactor would
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.calls = thread_queue.Queue()
+
+    def callFromThread(self,f,*args,**kwargs):
+        self.calls.put((f, args, kwargs))
+
+    def wait(self,d):
+        results = []
+        d.addBoth(results.append)
+        while not results:
+            f, args, kwargs = self.calls.get(timeout=5)
+            f(*args, **kwargs)
+        return results[0]
+
+
+@pytest.fixture
+def mw(redis_mgr,queue):
+    crawler = SimpleNamespace(settings=Settings({'AUTOPROXY_NONBLOCKING': True, 'AUTOPROXY_THREADPOOL_SIZE': 2}))
+    mw = AutoproxyDownloaderMiddleware(crawler)
+    mw.reactor = ThreadReactor()
+    yield mw
+    mw.threadpool.stop()
+
+@pytest.fixture
+def spider():
+    return SimpleNamespace(allowed_domains=['example.com'], logger=logging.getLogger('test'))
+
+def download(mw,spider,result):
+    # the request through scrapy's middleware manager, with a download
+    # handler that returns result
+    request = Request('http://example.com/')
+    d = DownloaderMiddlewareManager(mw).download(lambda request, spider: result(request), request, spider)
+    return request, mw.reactor.wait(d)
+
+def outcomes(redis_mgr,proxy):
+    detail = redis_mgr.get_detail(proxy.detail.detail_key)
+    return detail.lifetime_good, detail.lifetime_bad
+
+
+def test_response_goes_through_the_threadpool(mw,spider,redis_mgr):
+    request, response = download(mw, spider, lambda request: defer.succeed(Response(request.url, status=200)))
+    assert isinstance(response, Response)
+    proxy = request.meta['proxy_obj']
+    assert request.meta['proxy'] == proxy.urlify()
+    assert outcomes(redis_mgr, proxy) == (1, 0)
+
+def test_timeout_is_recorded_and_retried_through_the_threadpool(mw,spider,redis_mgr):
+    proxies = []
+    def timed_out(request):
+        proxies.append(request.meta['proxy_obj'])
+        return defer.fail(TimeoutError())
+    request, retry = download(mw, spider, timed_out)
+    # process_exception's retry, sent back to the scheduler
+    assert retry is request
+    assert request.meta['autoproxy_tries'] == 1
+    assert 'proxy_obj' not in request.meta
+    assert outcomes(redis_mgr, proxies[0]) == (0, 1)
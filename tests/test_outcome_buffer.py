@@ -0,0 +1,88 @@
+import pytest
+import redis as redis_py
+
+from scrapy_autoproxy import outcome_buffer
+from scrapy_autoproxy.outcome_buffer import OutcomeWriteBehind, get_outcome_buffer
+from scrapy_autoproxy.storage_manager import RedisDetailQueue
+
+
+@pytest.fixture
+def buffer(redis_mgr):
+    # flushed by hand: no worker thread, nothing flushes inline
+    buffer = OutcomeWriteBehind(redis_mgr, batch_size=1000, max_buffered=1000)
+    buffer.worker = object()
+    return buffer
+
+def drawn_detail(redis_mgr,queue,proxy_id):
+    detail = redis_mgr.get_detail('d_%s_p_%s' % (queue.queue_key, proxy_id))
+    redis_mgr.redis.lrem(RedisDetailQueue.queue_redis_key(queue.queue_key, detail.active), 1, detail.detail_key)
+    return detail
+
+def fail_next_flush(redis_mgr):
+    pipeline = redis_mgr.redis.pipeline
+    def failing_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        def execute(*args, **kwargs):
+            del redis_mgr.redis.pipeline
+            raise redis_py.exceptions.ConnectionError("down")
+        pipe.execute = execute
+        return pipe
+    redis_mgr.redis.pipeline = failing_pipeline
+
+
+def test_flush_writes_outcomes_in_order(redis_mgr,queue,buffer):
+    detail = drawn_detail(redis_mgr, queue, 1)
+    buffer.add(detail, True, 100, True)
+    buffer.add(detail, False, 200, True)
+    buffer.add(detail, True, 300, True)
+    assert redis_mgr.get_detail(detail.detail_key).lifetime_good == 0
+
+    assert buffer.flush() == 3
+    updated = redis_mgr.get_detail(detail.detail_key)
+    assert (updated.lifetime_good, updated.lifetime_bad) == (2, 1)
+    assert updated.load_time == 300
+
+def test_failed_flush_keeps_the_batch_in_front(redis_mgr,queue,buffer):
+    detail = drawn_detail(redis_mgr, queue, 2)
+    buffer.add(detail, True, 100, True)
+    buffer.add(detail, True, 200, True)
+    fail_next_flush(redis_mgr)
+    with pytest.raises(redis_py.exceptions.ConnectionError):
+        buffer.flush()
+    buffer.add(detail, True, 300, True)
+    assert [outcome[2] for outcome in buffer.outcomes] == [100, 200, 300]
+
+    assert buffer.flush() == 3
+    updated = redis_mgr.get_detail(detail.detail_key)
+    assert updated.lifetime_good == 3
+    assert updated.load_time == 300
+
+def test_restore_keeps_the_bound(redis_mgr,queue,buffer):
+    detail = drawn_detail(redis_mgr, queue, 3)
+    buffer.max_buffered = 3
+    buffer.add(detail, True, 300, True)
+    buffer.add(detail, True, 400, True)
+    buffer.restore([(detail, True, load_time, True, None, None) for load_time in (100, 200)])
+    # the oldest are dropped
+    assert [outcome[2] for outcome in buffer.outcomes] == [200, 300, 400]
+
+def test_add_logs_a_failed_inline_flush(redis_mgr,queue,buffer):
+    detail = drawn_detail(redis_mgr, queue, 4)
+    buffer.max_buffered = 2
+    buffer.add(detail, True, 100, True)
+    fail_next_flush(redis_mgr)
+    buffer.add(detail, True, 200, True)
+    assert len(buffer.outcomes) == 2
+
+def test_one_buffer_per_process(monkeypatch,redis_mgr,queue):
+    monkeypatch.setattr(outcome_buffer, '_outcome_buffer', None)
+    buffer = get_outcome_buffer(redis_mgr)
+    assert get_outcome_buffer(redis_mgr) is buffer
+    # the flush thread starts with the first outcome
+    assert buffer.worker is None
+    buffer.add(drawn_detail(redis_mgr, queue, 5), True, 100, True)
+    assert buffer.worker.is_alive()
+
+    buffer.close()
+    assert not buffer.outcomes
+    assert get_outcome_buffer(redis_mgr) is not buffer
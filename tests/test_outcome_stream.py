@@ -0,0 +1,84 @@
+import pytest
+
+from scrapy_autoproxy.outcome_stream import OutcomeStream, OutcomeAggregator, OUTCOME_STREAM_KEY, OUTCOME_GROUP, OUTCOME_DEAD_LETTER_KEY, QUEUE_STATS_PREFIX
+
+
+@pytest.fixture
+def stream(redis_mgr):
+    return OutcomeStream(redis_mgr.redis)
+
+@pytest.fixture
+def aggregator(redis_mgr):
+    aggregator = OutcomeAggregator(redis_mgr, consumer='test', block_ms=None, claim_idle_ms=0, max_deliveries=3)
+    aggregator.create_group()
+    return aggregator
+
+def detail(redis_mgr,queue,proxy_id):
+    return redis_mgr.get_detail('d_%s_p_%s' % (queue.queue_key, proxy_id))
+
+def pending_count(redis_mgr):
+    return redis_mgr.redis.xpending(OUTCOME_STREAM_KEY, OUTCOME_GROUP)['pending']
+
+
+def test_aggregator_applies_and_acks_events(redis_mgr,queue,stream,aggregator):
+    d = detail(redis_mgr, queue, 1)
+    stream.append(d, True, 100, True)
+    stream.append(d, False, 300, True)
+
+    assert aggregator.process_batch() == 2
+    updated = detail(redis_mgr, queue, 1)
+    assert (updated.lifetime_good, updated.lifetime_bad) == (1, 1)
+    stats = redis_mgr.redis.hgetall(QUEUE_STATS_PREFIX + queue.queue_key)
+    assert stats == {'requests': '2', 'good': '1', 'bad': '1', 'load_time_total': '400'}
+    assert pending_count(redis_mgr) == 0
+
+def test_failing_events_stay_pending_then_go_to_the_dead_letter_stream(redis_mgr,queue,stream,aggregator):
+    stream.append(detail(redis_mgr, queue, 2), True, 100, True)
+    bad_id = redis_mgr.redis.xadd(OUTCOME_STREAM_KEY, {'q': queue.queue_key, 's': '1'})
+
+    # the good event is applied, the malformed one is left pending
+    assert aggregator.process_batch() == 1
+    assert pending_count(redis_mgr) == 1
+    for delivery in range(2):
+        assert aggregator.process_batch() == 0
+        assert pending_count(redis_mgr) == 1
+
+    aggregator.process_batch()
+    assert pending_count(redis_mgr) == 0
+    dead = redis_mgr.redis.xrange(OUTCOME_DEAD_LETTER_KEY)
+    assert len(dead) == 1
+    assert dead[0][1]['id'] == bad_id
+    assert dead[0][1]['q'] == queue.queue_key
+
+def test_trim_keeps_unacked_events(redis_mgr,queue,stream,aggregator):
+    read = [stream.append(detail(redis_mgr, queue, proxy_id), True, 100, True) for proxy_id in (3, 4)]
+    assert aggregator.process_batch() == 2
+    unread = stream.append(detail(redis_mgr, queue, 5), True, 100, True)
+
+    assert aggregator.trim() == 1
+    ids = [message_id for message_id, event in redis_mgr.redis.xrange(OUTCOME_STREAM_KEY)]
+    # kept from the group's last delivered id on
+    assert ids == [read[1], unread]
+
+def test_trim_stops_at_the_oldest_pending_event(redis_mgr,queue,stream,aggregator):
+    pending = redis_mgr.redis.xadd(OUTCOME_STREAM_KEY, {'q': queue.queue_key})
+    stream.append(detail(redis_mgr, queue, 6), True, 100, True)
+    assert aggregator.process_batch() == 1
+
+    assert aggregator.trim() == 0
+    assert redis_mgr.redis.xrange(OUTCOME_STREAM_KEY)[0][0] == pending
+
+def test_event_without_requeue_is_left_pending(redis_mgr,queue,stream,aggregator):
+    stream.append(detail(redis_mgr, queue, 7), True, 100, True)
+    redis_mgr.redis.xadd(OUTCOME_STREAM_KEY, {'q': queue.queue_key, 'p': 'p_8', 's': '1', 'l': 100, 't': '0'})
+    assert aggregator.process_batch() == 1
+    assert pending_count(redis_mgr) == 1
+
+def test_outcome_of_an_uncached_detail_is_acked_without_stats(redis_mgr,queue,stream,aggregator):
+    d = detail(redis_mgr, queue, 9)
+    redis_mgr.redis.delete(d.detail_key)
+    stream.append(d, True, 100, True)
+
+    assert aggregator.process_batch() == 0
+    assert pending_count(redis_mgr) == 0
+    assert not redis_mgr.redis.exists(QUEUE_STATS_PREFIX + queue.queue_key)
@@ -0,0 +1,39 @@
+import pytest
+
+from scrapy_autoproxy import proxy_manager
+from scrapy_autoproxy.proxy_manager import ProxyManager
+from scrapy_autoproxy.proxy_objects import Queue, Detail
+from scrapy_autoproxy.queue_refill import QueueRefiller
+
+
+@pytest.fixture
+def manager(monkeypatch,redis_mgr):
+    monkeypatch.setattr(proxy_manager, 'GET_PROXY_ENGINE', 'python')
+    manager = ProxyManager()
+    # refills are left to a worker, as with queue_refill_worker on
+    manager.refiller = QueueRefiller(manager.storage_mgr, use_worker=True)
+    return manager
+
+
+def test_both_queues_are_tried_after_waiting_for_a_refill(manager):
+    redis_mgr = manager.storage_mgr.redis_mgr
+    queue = redis_mgr.register_queue(Queue(domain='example.org'))
+    def refilled(queue):
+        # the worker's details landed in the active queue
+        redis_mgr.register_detail(Detail(proxy_id=2, queue_id=queue.id(), active=True), bypass_db_check=True)
+        return True
+    manager.wait_for_refill = refilled
+
+    proxy = manager.get_proxy('http://example.org/', dispatch=False)
+    assert proxy.detail.proxy_key == 'p_2'
+    assert proxy.rdq.active
+
+def test_python_engine_batches_are_one_script_call(manager,queue):
+    scripts = manager.storage_mgr.redis_mgr.scripts
+    calls = []
+    draw_detail = scripts.draw_detail
+    scripts.draw_detail = lambda **kwargs: calls.append(kwargs) or draw_detail(**kwargs)
+
+    proxies = manager.get_proxies('http://example.com/', 3)
+    assert len(calls) == 1
+    assert len(set(proxy.detail.detail_key for proxy in proxies)) == 3
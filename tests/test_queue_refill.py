@@ -0,0 +1,40 @@
+import psycopg2
+import pytest
+
+from scrapy_autoproxy.proxy_objects import Queue
+from scrapy_autoproxy.queue_refill import QueueRefillClient, QueueRefillWorker
+from scrapy_autoproxy.storage_manager import StorageManager, RedisDetailQueue, QUEUE_DETAIL_COUNT_KEY
+
+
+@pytest.fixture
+def worker(redis_mgr):
+    return QueueRefillWorker(StorageManager(), low_watermark=8, high_watermark=12)
+
+def inactive_length(redis_mgr,queue):
+    return RedisDetailQueue(queue, active=False, redis_mgr=redis_mgr).length()
+
+
+def test_refill_tops_up_to_the_high_watermark(redis_mgr,worker):
+    queue = redis_mgr.register_queue(Queue(domain='example.org'))
+    QueueRefillClient(redis_mgr).request(queue)
+    assert worker.refill(queue.queue_key) == 12
+    assert inactive_length(redis_mgr, queue) == 12
+    assert QueueRefillClient(redis_mgr).wait(queue, 1)
+    assert worker.scan() == []
+
+def test_stale_queue_keys_are_skipped(redis_mgr,queue,worker):
+    redis_mgr.redis.hset(QUEUE_DETAIL_COUNT_KEY, 'q_999', 3)
+    assert worker.scan() == [queue.queue_key]
+    assert worker.refill('q_999') == 0
+
+def test_a_failing_queue_does_not_stop_the_others(redis_mgr,queue,worker):
+    other = redis_mgr.register_queue(Queue(domain='example.org'))
+    create_new_details = worker.storage_mgr.create_new_details
+    def failing(queue,count):
+        if queue.domain == 'example.com':
+            raise psycopg2.OperationalError("server closed the connection")
+        return create_new_details(queue=queue, count=count)
+    worker.storage_mgr.create_new_details = failing
+
+    assert worker.try_refill(queue.queue_key) == 0
+    assert worker.try_refill(other.queue_key) > 0
@@ -0,0 +1,70 @@
+import time
+
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, CHANGED_DETAILS_SET_KEY, BLACKLIST_THRESHOLD, PROXY_INTERVAL
+
+
+def drawn_detail(redis_mgr,queue,proxy_id):
+    detail = redis_mgr.get_detail('d_%s_p_%s' % (queue.queue_key, proxy_id))
+    # as if drawn: out of its queue
+    redis_mgr.redis.lrem(RedisDetailQueue.queue_redis_key(queue.queue_key, detail.active), 1, detail.detail_key)
+    return detail
+
+def cooldown_score(redis_mgr,queue,detail,active):
+    return redis_mgr.redis.zscore(RedisDetailQueue.cooldown_redis_key(queue.queue_key, active), detail.detail_key)
+
+
+def test_success_updates_counters_and_requeues_after_interval(redis_mgr,queue):
+    detail = drawn_detail(redis_mgr, queue, 1)
+    before = int(time.time())
+    updated = redis_mgr.record_outcome(detail, True, 450)
+
+    assert updated.lifetime_good == 1
+    assert updated.load_time == 450
+    assert updated.latency_ewma == 450
+    assert updated.latency_samples() == 1
+    assert updated.active
+    assert updated.last_used_epoch >= before
+    assert updated.last_active_epoch == updated.last_used_epoch
+    assert redis_mgr.redis.sismember(CHANGED_DETAILS_SET_KEY, detail.detail_key)
+    # an inactive detail that succeeds moves to the active queue's cooldown
+    assert cooldown_score(redis_mgr, queue, detail, True) == updated.last_used_epoch + PROXY_INTERVAL
+    assert cooldown_score(redis_mgr, queue, detail, False) is None
+
+def test_failures_past_the_threshold_blacklist_the_detail(redis_mgr,queue):
+    detail = drawn_detail(redis_mgr, queue, 2)
+    for i in range(BLACKLIST_THRESHOLD):
+        updated = redis_mgr.record_outcome(detail, False, 0)
+        assert not updated.blacklisted
+        assert cooldown_score(redis_mgr, queue, detail, True) is not None
+
+    redis_mgr.redis.delete(RedisDetailQueue.cooldown_redis_key(queue.queue_key, True))
+    updated = redis_mgr.record_outcome(detail, False, 0)
+    assert updated.blacklisted
+    assert not updated.active
+    assert updated.blacklisted_count == 1
+    assert updated.lifetime_bad == BLACKLIST_THRESHOLD + 1
+    # a blacklisted detail is not requeued
+    assert cooldown_score(redis_mgr, queue, detail, True) is None
+    assert cooldown_score(redis_mgr, queue, detail, False) is None
+
+def test_success_decrements_blacklisted_count(redis_mgr,queue):
+    detail = drawn_detail(redis_mgr, queue, 3)
+    redis_mgr.redis.hset(detail.detail_key, 'blacklisted_count', 2)
+    assert redis_mgr.record_outcome(detail, True, 100).blacklisted_count == 1
+
+def test_neutral_outcome_only_touches_last_used(redis_mgr,queue):
+    detail = drawn_detail(redis_mgr, queue, 4)
+    updated = redis_mgr.record_outcome(detail, None, 100, requeue=False)
+
+    assert updated.lifetime_good == 0
+    assert updated.lifetime_bad == 0
+    assert updated.bad_count == 0
+    assert updated.last_used_epoch > detail.last_used_epoch
+    assert updated.last_active_epoch == detail.last_active_epoch
+    assert cooldown_score(redis_mgr, queue, detail, True) is None
+
+def test_outcome_for_an_uncached_detail_is_dropped(redis_mgr,queue):
+    detail = drawn_detail(redis_mgr, queue, 5)
+    redis_mgr.redis.delete(detail.detail_key)
+    assert redis_mgr.record_outcome(detail, True, 100) is None
+    assert not redis_mgr.redis.exists(detail.detail_key)
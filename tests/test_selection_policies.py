@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+from scrapy_autoproxy.selection_policies import SelectionPolicy, ThompsonSamplingPolicy, PowerOfTwoChoicesPolicy, get_selection_policy
+from scrapy_autoproxy.storage_manager import RedisDetailQueue, CHANGED_DETAILS_SET_KEY, BLACKLIST_TIME, MAX_BLACKLIST_COUNT
+
+
+def queued_keys(redis_mgr,queue):
+    keys = []
+    for active in (True, False):
+        keys.extend(redis_mgr.redis.lrange(RedisDetailQueue.queue_redis_key(queue.queue_key, active), 0, -1))
+    return keys
+
+def blacklist(redis_mgr,queue,proxy_id,seconds_ago,blacklisted_count=1):
+    detail_key = 'd_%s_p_%s' % (queue.queue_key, proxy_id)
+    redis_mgr.redis.hset(detail_key, mapping={'blacklisted': '1', 'blacklisted_count': blacklisted_count, 'last_used': int(time.time() - seconds_ago)})
+    return detail_key
+
+
+def test_policy_without_draw_fails_at_construction(redis_mgr):
+    class Incomplete(SelectionPolicy):
+        pass
+    with pytest.raises(TypeError):
+        Incomplete(redis_mgr)
+
+def test_unknown_policy_is_rejected(redis_mgr):
+    with pytest.raises(Exception):
+        get_selection_policy('nope', redis_mgr)
+
+def test_thompson_draw_claims_the_detail(redis_mgr,queue):
+    draw = ThompsonSamplingPolicy(redis_mgr).draw(queue)
+    assert draw.detail is not None
+    assert draw.proxy.proxy_key == draw.detail.proxy_key
+    assert draw.detail.detail_key not in queued_keys(redis_mgr, queue)
+
+def test_thompson_unblacklists_expired_details(redis_mgr,queue):
+    expired = blacklist(redis_mgr, queue, 3, BLACKLIST_TIME + 60)
+    for proxy_id in range(1, 11):
+        if proxy_id != 3:
+            blacklist(redis_mgr, queue, proxy_id, 60)
+
+    draw = ThompsonSamplingPolicy(redis_mgr).draw(queue)
+    assert draw.detail.detail_key == expired
+    assert not draw.detail.blacklisted
+    assert redis_mgr.redis.sismember(CHANGED_DETAILS_SET_KEY, expired)
+    # the details still blacklisted are out of the queue, as with the draw scripts
+    assert queued_keys(redis_mgr, queue) == []
+
+def test_thompson_keeps_details_blacklisted_too_often(redis_mgr,queue):
+    for proxy_id in range(1, 11):
+        blacklist(redis_mgr, queue, proxy_id, BLACKLIST_TIME + 60, MAX_BLACKLIST_COUNT)
+    assert ThompsonSamplingPolicy(redis_mgr).draw(queue).detail is None
+
+def test_thompson_batch_samples_the_candidates_once(redis_mgr,queue):
+    policy = ThompsonSamplingPolicy(redis_mgr)
+    calls = []
+    candidates = policy.candidates
+    policy.candidates = lambda rdqs: calls.append(rdqs) or candidates(rdqs)
+
+    draws = policy.draw_many(queue, 4)
+    keys = [draw.detail.detail_key for draw in draws]
+    assert len(calls) == 1
+    assert len(set(keys)) == 4
+    assert not set(keys) & set(queued_keys(redis_mgr, queue))
+
+def test_p2c_batch_draws_distinct_details(redis_mgr,queue):
+    draws = PowerOfTwoChoicesPolicy(redis_mgr).draw_many(queue, 4)
+    keys = [draw.detail.detail_key for draw in draws]
+    assert len(set(keys)) == 4
+    assert not set(keys) & set(queued_keys(redis_mgr, queue))
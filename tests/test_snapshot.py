@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from scrapy_autoproxy import snapshot
+from scrapy_autoproxy.storage_manager import RedisManager
+
+
+@pytest.fixture
+def snapshot_path(tmpdir):
+    return str(tmpdir.join('cache.snapshot'))
+
+def cache(redis):
+    return {key: redis.dump(key) for key in redis.scan_iter() if not snapshot.is_excluded(key.encode())}
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_snapshot_round_trip(redis_mgr,queue,snapshot_path,compress):
+    redis = redis_mgr.redis
+    redis.expire(queue.queue_key, 3600)
+    redis_mgr.lease_in_flight('p_1')
+    before = cache(redis)
+
+    count = snapshot.save(snapshot_path, compress=compress)
+    assert count == len(before)
+    assert snapshot.validate(snapshot_path) == count
+
+    redis.set('added_later', 1)
+    redis.delete(queue.queue_key)
+    assert snapshot.restore(snapshot_path, flush=True) == count
+    assert cache(redis) == before
+    assert 0 < redis.ttl(queue.queue_key) <= 3600
+    # in flight leases belong to the processes running at the time
+    assert not redis.exists(RedisManager.in_flight_key('p_1'))
+
+def test_restore_without_flush_keeps_other_keys(redis_mgr,queue,snapshot_path):
+    snapshot.save(snapshot_path)
+    redis_mgr.redis.set('added_later', 1)
+    snapshot.restore(snapshot_path)
+    assert redis_mgr.redis.get('added_later') == '1'
+
+@pytest.mark.parametrize('corrupt', ['truncated', 'no end marker', 'not a snapshot'])
+def test_bad_snapshot_leaves_the_cache_alone(redis_mgr,queue,snapshot_path,corrupt):
+    redis = redis_mgr.redis
+    snapshot.save(snapshot_path)
+    with open(snapshot_path, 'rb') as f:
+        data = f.read()
+    data = {
+        'truncated': data[:len(data) // 2],
+        'no end marker': data[:-4],
+        'not a snapshot': b'{"keys": []}',
+    }[corrupt]
+    with open(snapshot_path, 'wb') as f:
+        f.write(data)
+    before = cache(redis)
+
+    with pytest.raises(Exception):
+        snapshot.restore(snapshot_path, flush=True)
+    assert cache(redis) == before
+    assert not redis.exists('syncing')
+
+def test_truncated_gzip_snapshot_is_rejected(redis_mgr,queue,snapshot_path):
+    snapshot.save(snapshot_path, compress=True)
+    os.truncate(snapshot_path, os.path.getsize(snapshot_path) // 2)
+    with pytest.raises(Exception, match='corrupt|truncated'):
+        snapshot.validate(snapshot_path)